@@ -1,22 +1,32 @@
 import asyncio
 from asyncio.locks import Semaphore
 from typing import Any, List, Optional
-import aiohttp
+from session import SessionManager
 from waiter import Waiter
-from reporter import Reporter
-from cacher import Cacher
+from reporter import Reporter, INFO
+from cacher import AsyncCacher, Cacher, CachePolicy, LRUIndex, STORAGES, parse_size
 from collector import Collector
+from frontier import Frontier
+from seen import SeenSet
+from metrics import Registry
+from downloader import Downloader
+from blobstore import BlobStore
 import bs4
+import htmlparse
 import urllib.parse
 import argparse
-import signal
 import os
 
 SITE_ENCODING = 'utf-8'
 
 
 def get_post_urls(html):
-    doc = bs4.BeautifulSoup(html, 'lxml')
+    if htmlparse.backend() == 'lxml':
+        return [
+            _X_A(e)[0].attrib['href']
+            for e in _X_HENTRY(htmlparse.parse(html))
+        ]
+    doc = htmlparse.soup(html)
     return [
         e.select_one('a')['href']
         for e in doc.select('.hentry')
@@ -24,7 +34,9 @@ def get_post_urls(html):
 
 
 def get_pict_urls(html):
-    doc = bs4.BeautifulSoup(html, 'lxml')
+    if htmlparse.backend() == 'lxml':
+        return [e.getparent().attrib['href'] for e in _X_PICT(htmlparse.parse(html))]
+    doc = htmlparse.soup(html)
     l = []
     e: bs4.element.Tag
     for e in doc.select('div.tw_matome > a > img'):
@@ -33,59 +45,67 @@ def get_pict_urls(html):
     return l
 
 
-async def download_file(url, filename, cacher: Cacher, useragent=''):
-    print(url)
-    async with aiohttp.request('get', url, headers={
-        'user-agent': useragent,
-    }) as res:
-        content = await res.read()
-        cacher.set(filename, content)
+_X_HENTRY = htmlparse.xpath(f"//*[{htmlparse.has_class('hentry')}]")
+_X_PICT = htmlparse.xpath(f"//div[{htmlparse.has_class('tw_matome')}]/a/img")
+_X_A = htmlparse.xpath('.//a')
 
 
 class Anicobin(Collector):
-    def __init__(self, reporter, waiter, outdir, useragent) -> None:
-        super(Anicobin, self).__init__()
+    def __init__(self, reporter, waiter, outdir, useragent, session: SessionManager = None,
+                 cache_backend: str = None,
+                 compression: str = None,
+                 lru: LRUIndex = None, cache_policy: CachePolicy = None, frontier: Frontier = None,
+                 seen: SeenSet = None) -> None:
+        super(Anicobin, self).__init__(session)
         self.reporter: Reporter = reporter
         self.waiter = waiter
         self.outdir = outdir
         self.useragent = useragent
-        self.cacher = Cacher(self.outdir)
+        self.cacher = AsyncCacher(Cacher(self.outdir, cache_backend, compression, lru))
+        self.cache_policy = cache_policy or CachePolicy()
+        self.frontier = frontier
+        self.seen = seen
         self.semaphore = Semaphore(2)
+        self.scheduler.configure('dlimage', priority=-1)
+        # まとめ記事は同じ画像を何度も載せるので内容で重複を除く
+        self.blobs = BlobStore(os.path.join(outdir, 'blobs'))
+        self.downloader = Downloader(self.waiter, self.semaphore, self.reporter, self.session, self.cacher,
+                                     blobs=self.blobs, flights=self.flights)
+
+    @staticmethod
+    def page_filename(url: str) -> str:
+        return urllib.parse.quote(url, safe='') + '.html'
 
     async def get(self, url):
-        filename = urllib.parse.quote(url, safe='') + '.html'
-        cache, _ = self.cacher.get(filename)
-        if cache:
-            html = cache
-        else:
-            await self.waiter.wait(url)
-            print('fetching', url)
-            async with aiohttp.request('get', url, headers={'user-agent': self.useragent}) as req:
-                content = await req.read()
-                html = content.decode(SITE_ENCODING)
-                self.cacher.set(filename, html)
+        html, _ = await self.fetch(url, self.page_filename(url), encoding=SITE_ENCODING)
 
         return html
 
-    async def collect(self, base_url, queue_size=3):
-        async def f(page):
-            print(page)
-            html, _ = await self.async_retry(3, self.get, f'{base_url}?p={page}')
-            result = []
-            for post_url in await self.run_in_executor(get_post_urls, html):
-                _html = await self.get(post_url)
-                urls = get_pict_urls(_html)
-                for url in urls:
-                    filename = urllib.parse.quote(url, safe='')
-                    content, _ = self.cacher.get(filename, binary=True)
-                    if not content:
-                        await self.add_future('dlimage', download_file(url, filename, self.cacher))
+    async def list_page(self, base_url, page):
+        self.reporter.report(INFO, f'page {page}')
+        list_url = f'{base_url}?p={page}'
+        html, _ = await self.async_retry(3, self.get, list_url)
+        result = []
+        for post_url in await self.parse(get_post_urls, html, filename=self.page_filename(list_url)):
+            _html = await self.get(post_url)
+            urls = await self.parse(get_pict_urls, _html, filename=self.page_filename(post_url))
+            for url in urls:
+                filename = urllib.parse.quote(url, safe='')
+                await self.add_job('dlimage', 'download_image', url, filename)
 
-                result.extend(urls)
+            result.extend(urls)
 
-            return len(result) > 0
+        return len(result) > 0
 
-        await self.queued_paging(1, 1000, lambda page: f(page), queue_size=queue_size)
+    async def download_image(self, url, filename):
+        # 前回までに保存したもの
+        if await self.cacher.aexists(filename):
+            return
+        await self.downloader.download_file(url, filename, headers={'user-agent': self.useragent})
+
+    async def collect(self, base_url, queue_size=3):
+        await self.queued_paging(1, 1000, lambda page: self.checkpointed('list_page', base_url, page),
+                                 queue_size=queue_size)
 
 
 if __name__ == "__main__":
@@ -94,14 +114,45 @@ if __name__ == "__main__":
     parser.add_argument('--wait', '-w', type=int, default=10, help='wait time in seconds')
     parser.add_argument('--dir', '-d', type=str, default='cache', help='cache directory')
     parser.add_argument('--useragent', '-ua', type=str, default='')
+    parser.add_argument('--cache_backend', choices=list(STORAGES.keys()), default=None, help='cache storage. default is auto detect')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=None, help='compress cached html')
+    parser.add_argument('--lru', type=str, default=None, help='in-memory index size of cached entries. `100000` entries or `512M` bytes')
+    parser.add_argument('--max_age', type=float, default=None, help='seconds until cached pages expire. default is never')
+    parser.add_argument('--revalidate', action='store_true', help='revalidate expired pages with ETag/Last-Modified')
+    parser.add_argument('--concurrency', type=int, default=None, help='max number of running tasks. default is unlimited')
+    parser.add_argument('--cache_policy', type=str, default='cache_policy.json', help='json file of max age per host')
+    parser.add_argument('--seen_capacity', type=int, default=1000000, help='expected number of jobs. sizes the in-memory filter of added jobs')
+    parser.add_argument('--metrics_port', type=int, default=None, help='serve metrics in prometheus text format on this port')
+    parser.add_argument('--progress', type=float, default=None, help='print a progress line every N seconds')
+    parser.add_argument('--resume', action='store_true', help='resume the previous run')
+    parser.add_argument('--parse_processes', type=int, default=None, help='size of the parser process pool. default is cpu count')
+    parser.add_argument('--parse_threads', type=int, default=None, help='size of the parser thread pool (lxml only)')
+    parser.add_argument('--parser', choices=htmlparse.BACKENDS, default=htmlparse.backend(), help='html parser for extractors. lxml is faster')
     parser.add_argument('url', type=str)
     args = parser.parse_args()
-    signal.signal(signal.SIGINT, lambda a, b: print('sigint') or exit(1))
+    htmlparse.set_backend(args.parser)
 
     c = Anicobin(
         reporter=Reporter(1),
         waiter=Waiter([args.wait]),
         outdir=args.dir,
         useragent=args.useragent,
+        cache_backend=args.cache_backend,
+        compression=args.compression,
+        lru=LRUIndex(*parse_size(args.lru)) if args.lru else None,
+        cache_policy=CachePolicy(args.max_age, args.revalidate, args.cache_policy),
+        frontier=Frontier(os.path.join(args.dir, 'frontier.sqlite3')),
+        seen=SeenSet(os.path.join(args.dir, 'seen.sqlite3'), capacity=args.seen_capacity),
     )
-    asyncio.run(c.run(c.collect(base_url=args.url, queue_size=args.queue_size)))
+    c.scheduler.set_limit(args.concurrency)
+    if args.metrics_port is not None or args.progress:
+        c.instrument(Registry())
+    c.parser.processes = args.parse_processes or c.parser.processes
+    c.parser.threads = args.parse_threads or c.parser.threads
+    asyncio.run(c.run(c.collect(base_url=args.url, queue_size=args.queue_size), resume=args.resume,
+                      metrics_port=args.metrics_port, progress=args.progress))
+    c.reporter.report(INFO, f'connections: {c.session.stats()}')
+    c.reporter.report(INFO, f'cache: {c.cacher.stats()}')
+    c.reporter.report(INFO, f'requests: {c.flights.stats()} seen: {c.seen.stats()}')
+    c.reporter.report(INFO, f'parser: {c.parser.stats()}')
+    c.reporter.report(INFO, f'downloads: {c.downloader.stats()} blobs: {c.blobs.stats()}')
@@ -0,0 +1,99 @@
+'''
+解析関数をプロセスプールで実行するときのIPCの比較
+html: HTMLをpickleして送る (従来のrun_in_executor)
+path: キャッシュのパスだけを送る
+path+batch: パスをまとめて送る
+
+    python -m bench.ipc -n 500 --size 150000 --batch 8 --concurrency 16
+'''
+import argparse
+import asyncio
+import os
+import pickle
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from cacher import Cacher
+from executor import PageExecutor, _run_batch
+from wear import parse_gallely
+
+
+def make_page(i: int, size: int) -> str:
+    items = ''.join(f'''<div class="like_mark" data-snapid="{i}{j}"><div class="img"><img data-originalretina="//wear.jp/img/{i}_{j}.jpg"></div>
+<div class="btn_save"><span>3</span></div><div class="btn_like"><span>5</span></div><a class="over" href="/snap/{i}{j}"></a>
+<span class="namefirst">F</span><span class="height">170cm</span></div>''' for j in range(30))
+    # 実際のページのようにスクリプトなどで埋める
+    filler = '<script>var x = "' + 'x' * max(size - len(items), 0) + '";</script>'
+    return f'<html><head>{filler}</head><body>{items}</body></html>'
+
+
+class CountingExecutor(PageExecutor):
+    '''
+    ワーカーとやりとりするバイト数を数える
+    '''
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.sent = 0
+        self.received = 0
+
+    def _send(self, fn):
+        batch = self._pending.get(fn, [])
+        calls = [(page, args) for page, args, _ in batch]
+        if calls:
+            self.sent += len(pickle.dumps((_run_batch, fn, calls)))
+        super()._send(fn)
+
+
+async def measure(pool, cacher: Cacher, pages: dict, by_path: bool, batch: int, concurrency: int):
+    executor = CountingExecutor(pool, by_path=by_path, batch_size=batch)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(key):
+        # 取得したHTMLは手元にある状態から測る
+        async with semaphore:
+            start = time.perf_counter()
+            result = await executor.run(parse_gallely, pages[key], None, path=cacher.content_path(key))
+            latencies.append(time.perf_counter() - start)
+        executor.received += len(pickle.dumps((True, result)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(key) for key in pages])
+    elapsed = time.perf_counter() - start
+    return executor, latencies, elapsed
+
+
+async def main(n: int, size: int, batch: int, workers: int, concurrency: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        cacher = Cacher(os.path.join(tmp, 'cache'))
+        pages = {f'page{i}.html': make_page(i, size) for i in range(n)}
+        for key, html in pages.items():
+            cacher.set(key, html)
+
+        pool = ProcessPoolExecutor(workers)
+        # ワーカーを起動しておく
+        await asyncio.get_event_loop().run_in_executor(pool, _run_batch, parse_gallely, [])
+
+        print(f'{"mode":12} {"sent/page":>10} {"recv/page":>10} {"p50 ms":>8} {"p99 ms":>8} {"pages/s":>8}')
+        for name, by_path, b in (('html', False, 1), ('path', True, 1), (f'path+{batch}', True, batch)):
+            executor, latencies, elapsed = await measure(pool, cacher, pages, by_path, b, concurrency)
+            latencies.sort()
+            print(f'{name:12} {executor.sent / n:>10.0f} {executor.received / n:>10.0f} '
+                  f'{statistics.median(latencies) * 1000:>8.1f} {latencies[int(len(latencies) * 0.99) - 1] * 1000:>8.1f} '
+                  f'{n / elapsed:>8.1f}')
+        pool.shutdown()
+        cacher.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('bench.ipc')
+    parser.add_argument('-n', type=int, default=500, help='number of pages')
+    parser.add_argument('--size', type=int, default=150000, help='bytes of a page')
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--concurrency', type=int, default=16, help='number of pages parsed at once')
+    args = parser.parse_args()
+    asyncio.run(main(args.n, args.size, args.batch, args.workers, args.concurrency))
@@ -0,0 +1,158 @@
+'''
+抽出関数のパーサの比較
+キャッシュに保存したページに全抽出関数をかけ、bs4の結果をゴールデンファイルとして保存し
+他のバックエンドが同じ結果を返すか確かめる。docs/secも測る
+tests/pages/の小さなページ (bench.serverの生成したもの) とそのゴールデンファイルはtests/test_extractors.pyで使う
+
+    python -m bench.parsers golden CACHE_DIR GOLDEN_DIR
+    python -m bench.parsers check CACHE_DIR GOLDEN_DIR
+    python -m bench.parsers bench CACHE_DIR -n 3
+'''
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import warnings
+
+from cacher import Cacher
+from page import Page
+import anicobin
+import htmlparse
+import netkeiba
+import wear
+
+EXTRACTORS = {
+    'wear.parse_gallely': lambda html: wear.parse_gallely(html, None),
+    'wear.parse_user': wear.parse_user,
+    'netkeiba.get_race_urls': netkeiba.get_race_urls,
+    'netkeiba.get_horse_urls': netkeiba.get_horse_urls,
+    'netkeiba.get_nextpage_data': netkeiba.get_nextpage_data,
+    'anicobin.get_post_urls': anicobin.get_post_urls,
+    'anicobin.get_pict_urls': anicobin.get_pict_urls,
+}
+
+
+# キャッシュにないことがある端のケース (空の503など) いつも含める
+EDGE_PAGES = {
+    '__empty__': Page(b''),
+    '__empty_str__': '',
+    '__blank__': Page(b' \n\t '),
+    '__comment__': Page(b'<!-- maintenance -->'),
+    '__comment_str__': '<!-- maintenance -->\n',
+}
+
+
+def load_pages(cache_dir: str):
+    '''
+    キャッシュからHTMLのページを読む 画像などは除く
+    '''
+    cacher = Cacher(cache_dir)
+    pages = {}
+    for key, has_content, _ in cacher.storage.entries():
+        if not has_content:
+            continue
+        # 抽出関数にはキャッシュしたままのバイト列を渡す
+        content, info = cacher.get(key, binary=True)
+        html = Page(content, (info or {}).get('encoding'))
+        try:
+            text = html.decode(html.encoding)
+        except UnicodeDecodeError:
+            continue
+        if '<' in text[:1024]:
+            pages[key] = html
+    cacher.close()
+    pages.update(EDGE_PAGES)
+    return pages
+
+
+def extract(name: str, html: str):
+    '''
+    結果をjsonで表せる形にする 例外は種類によらず同じとみなす
+    '''
+    try:
+        return json.loads(json.dumps(EXTRACTORS[name](html)))
+    except Exception:
+        return {'error': True}
+
+
+def extract_all(html: str) -> dict:
+    return {name: extract(name, html) for name in EXTRACTORS}
+
+
+def golden_path(golden_dir: str, key: str) -> str:
+    return os.path.join(golden_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def golden(pages: dict, golden_dir: str):
+    os.makedirs(golden_dir, exist_ok=True)
+    htmlparse.set_backend('bs4')
+    for key, html in pages.items():
+        with open(golden_path(golden_dir, key), 'wt', encoding='utf-8') as f:
+            json.dump({'key': key, 'results': extract_all(html)}, f, ensure_ascii=False)
+    print(f'{len(pages)} pages')
+
+
+def check(pages: dict, golden_dir: str) -> bool:
+    ok = True
+    for backend in htmlparse.BACKENDS:
+        htmlparse.set_backend(backend)
+        mismatches = 0
+        checked = 0
+        for key, html in pages.items():
+            path = golden_path(golden_dir, key)
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rt', encoding='utf-8') as f:
+                expected = json.load(f)['results']
+            checked += 1
+            for name, result in extract_all(html).items():
+                if result != expected.get(name):
+                    mismatches += 1
+                    print(f'mismatch {backend} {name} {key}')
+        print(f'{backend}: {checked} pages, {mismatches} mismatches')
+        ok = ok and mismatches == 0
+    return ok
+
+
+def bench(pages: dict, n: int):
+    # 結果が空でないページだけを各抽出関数の対象にする
+    htmlparse.set_backend('bs4')
+    targets = {}
+    for name in EXTRACTORS:
+        targets[name] = [html for html in pages.values() if extract(name, html) not in ([], {}, {'error': True})]
+
+    print(f'{"extractor":28} {"pages":>6} ' + ' '.join(f'{b + " docs/s":>14}' for b in htmlparse.BACKENDS))
+    for name, fn in EXTRACTORS.items():
+        htmls = targets[name]
+        if not htmls:
+            continue
+        rates = []
+        for backend in htmlparse.BACKENDS:
+            htmlparse.set_backend(backend)
+            start = time.perf_counter()
+            for _ in range(n):
+                for html in htmls:
+                    fn(html)
+            rates.append(len(htmls) * n / (time.perf_counter() - start))
+        print(f'{name:28} {len(htmls):>6} ' + ' '.join(f'{r:>14.1f}' for r in rates))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('bench.parsers')
+    parser.add_argument('command', choices=['golden', 'check', 'bench'])
+    parser.add_argument('cache_dir', help='cache directory of saved pages')
+    parser.add_argument('golden_dir', nargs='?', default='bench/golden', help='directory of golden files')
+    parser.add_argument('-n', type=int, default=3, help='repeat count of bench')
+    args = parser.parse_args()
+    # bs4の警告は比較に関係ないので消す
+    warnings.filterwarnings('ignore')
+
+    pages = load_pages(args.cache_dir)
+    if args.command == 'golden':
+        golden(pages, args.golden_dir)
+    elif args.command == 'check':
+        sys.exit(0 if check(pages, args.golden_dir) else 1)
+    else:
+        bench(pages, args.n)
@@ -0,0 +1,223 @@
+'''
+コレクタをローカルのサーバー (bench.server) に向けて待ち時間なしで走らせ、取得・解析・キャッシュの性能を測る
+サーバーは別プロセスで動かすので、CPU時間やメモリはコレクタの分だけ
+2回目以降 (--repeat) は前回のキャッシュを使う
+
+    pages/sec   取得したページ数 (キャッシュからのものを含む) / 秒
+    parse       解析関数の実行時間の合計と、解析プロセスのCPU時間
+    cpu         このプロセスのCPU時間 (user+sys)
+    rss         このプロセスと解析プロセスのピークのRSS
+    fds         開いているファイルディスクリプタの最大と終了後の数
+
+    python -m bench.run wear netkeiba anicobin --latency 0.01 --repeat 2 --parser lxml
+'''
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+import htmlparse
+from anicobin import Anicobin
+from bench.server import HOSTS
+from frontier import Frontier
+from netkeiba import Keiba
+from reporter import Reporter
+from seen import SeenSet
+from session import SessionManager
+from waiter import Waiter
+from wear import WearCollector
+
+SITES = ('wear', 'netkeiba', 'anicobin')
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def read_proc(pid, name: str):
+    try:
+        with open(f'/proc/{pid}/{name}', 'rt') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def rss_kb(pid) -> int:
+    status = read_proc(pid, 'status') or ''
+    for line in status.splitlines():
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+    return 0
+
+
+def cpu_seconds(pid) -> float:
+    stat = read_proc(pid, 'stat')
+    if stat is None:
+        return 0.0
+    # コマンド名に空白があってもいいように ')' の後ろから数える
+    fields = stat.rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def count_fds() -> int:
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return 0
+
+
+class Sampler():
+    '''
+    開いているfd数と解析プロセスのRSS・CPU時間を定期的に調べる
+    解析プロセスは終了すると読めないので最後に見た値を使う
+    '''
+
+    def __init__(self, collector, interval: float = 0.05) -> None:
+        self.collector = collector
+        self.interval = interval
+        self.max_fds = 0
+        self.max_worker_rss = 0
+        self.worker_cpu = {}
+
+    def sample(self):
+        self.max_fds = max(self.max_fds, count_fds())
+        pool = self.collector.parser._process_pool
+        if pool is None or not pool._processes:
+            return
+        pids = list(pool._processes)
+        self.max_worker_rss = max(self.max_worker_rss, sum(rss_kb(pid) for pid in pids))
+        for pid in pids:
+            self.worker_cpu[pid] = max(self.worker_cpu.get(pid, 0.0), cpu_seconds(pid))
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+
+def make_collector(site: str, outdir: str, session: SessionManager, args):
+    reporter = Reporter(args.loglevel)
+    # 待ち時間なし
+    waiter = Waiter(['0'])
+    if site == 'wear':
+        c = WearCollector(reporter, waiter, outdir, session=session, cache_backend=args.cache_backend,
+                          frontier=Frontier(os.path.join(outdir, 'frontier.sqlite3')),
+                          seen=SeenSet(os.path.join(outdir, 'seen.sqlite3')),
+                          paging_mode=args.paging)
+        return c, c.user_collector('https://wear.jp/users/', 1, args.pages)
+    if site == 'netkeiba':
+        c = Keiba(reporter, waiter, outdir, '', session=session, cache_backend=args.cache_backend,
+                  frontier=Frontier(os.path.join(outdir, 'frontier-race.sqlite3')),
+                  seen=SeenSet(os.path.join(outdir, 'seen-race.sqlite3')))
+        return c, c.collect(2020)
+    c = Anicobin(reporter, waiter, outdir, '', session=session, cache_backend=args.cache_backend,
+                 frontier=Frontier(os.path.join(outdir, 'frontier.sqlite3')),
+                 seen=SeenSet(os.path.join(outdir, 'seen.sqlite3')))
+    return c, c.collect('https://anicobin.ldblog.jp/')
+
+
+async def server_stats(port: int) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f'http://127.0.0.1:{port}/__stats__') as res:
+            return await res.json()
+
+
+async def run_once(site: str, outdir: str, port: int, args) -> dict:
+    session = SessionManager(rewrite={host: f'http://127.0.0.1:{port}' for host in HOSTS})
+    c, coro = make_collector(site, outdir, session, args)
+    if args.parse_processes:
+        c.parser.processes = args.parse_processes
+    # キャッシュから返したものも含めて取得したページを数える
+    fetched = 0
+    fetch = c.fetch
+
+    async def counted_fetch(*args, **kwargs):
+        nonlocal fetched
+        fetched += 1
+        return await fetch(*args, **kwargs)
+    c.fetch = counted_fetch
+
+    sampler = Sampler(c)
+    sampling = asyncio.ensure_future(sampler.run())
+
+    before = await server_stats(port)
+    cpu = time.process_time()
+    start = time.monotonic()
+    await c.run(coro)
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+    sampling.cancel()
+    sampler.sample()
+    after = await server_stats(port)
+
+    parsed = sum(c.parser.counts.values())
+    requests = {key: sum(statuses.values()) - sum(before.get(key, {}).values()) for key, statuses in after.items()}
+    return {
+        'seconds': round(elapsed, 3),
+        'pages': fetched,
+        'pages/sec': round(fetched / elapsed, 1) if elapsed else 0.0,
+        'parsed': parsed,
+        'requests': {key: n for key, n in requests.items() if n},
+        'parse': {'seconds': round(c.parser.seconds, 3), 'worker_cpu': round(sum(sampler.worker_cpu.values()), 3),
+                  **c.parser.counts},
+        'cpu': round(cpu, 3),
+        'rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'worker_rss_mb': round(sampler.max_worker_rss / 1024, 1),
+        'fds': {'max': sampler.max_fds},
+    }
+
+
+def start_server(args) -> subprocess.Popen:
+    command = [sys.executable, '-m', 'bench.server', '--port', '0',
+               '--latency', str(args.latency), '--error_rate', str(args.error_rate),
+               '--page_size', str(args.page_size), '--users_pages', str(args.pages),
+               '--search_pages', str(args.pages), '--list_pages', str(args.pages)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser('bench.run')
+    parser.add_argument('sites', nargs='*', help=f'{", ".join(SITES)}. default is all')
+    parser.add_argument('--pages', type=int, default=5, help='number of list pages of each site')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response delay of the server in seconds')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of 503 responses')
+    parser.add_argument('--page_size', type=int, default=60000)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per site. later runs use the cache of the first')
+    parser.add_argument('--parser', choices=htmlparse.BACKENDS, default=htmlparse.backend())
+    parser.add_argument('--parse_processes', type=int, default=None)
+    parser.add_argument('--cache_backend', default=None)
+    parser.add_argument('--paging', choices=['window', 'probe'], default='window')
+    parser.add_argument('--outdir', type=str, default=None, help='keep caches here instead of a temporary directory')
+    parser.add_argument('--loglevel', type=int, default=5)
+    args = parser.parse_args()
+    for site in args.sites:
+        if site not in SITES:
+            parser.error(f'unknown site {site}')
+    htmlparse.set_backend(args.parser)
+
+    server = start_server(args)
+    try:
+        port = json.loads(server.stdout.readline())['port']
+        for site in args.sites or SITES:
+            outdir = os.path.join(args.outdir, site) if args.outdir else tempfile.mkdtemp(prefix=f'bench-{site}-')
+            try:
+                for i in range(args.repeat):
+                    result = asyncio.run(run_once(site, outdir, port, args))
+                    # イベントループと解析プロセスを閉じたあとに残っているもの (漏れ)
+                    result['fds']['end'] = count_fds()
+                    print(json.dumps({'site': site, 'run': i + 1, **result}, ensure_ascii=False), flush=True)
+            finally:
+                if not args.outdir:
+                    shutil.rmtree(outdir, ignore_errors=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
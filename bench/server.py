@@ -0,0 +1,283 @@
+'''
+ベンチマーク用にwear.jp, netkeiba, livedoorブログを真似るローカルのHTTPサーバー
+リクエストのHostヘッダでサイトを切り替えるので、SessionManager(rewrite=...)で向ける
+ページは合成したもの (--record でコレクタのキャッシュがあればGETのページはそれを返す)
+
+    wear.jp              /users/?pageno=N, /<user>/?pageno=N 最後より先は?pagenoのないURLにリダイレクト
+    db.netkeiba.com      POST / (race_list, horse_list), /race/<id>/, /horse/<id>/ EUC-JIS-2004で返す
+    anicobin.ldblog.jp   /?p=N, /archives/<id>.html
+    画像                  wear.jp/img/..., livedoor.blogimg.jp/...
+
+/__stats__ はサイトごとのリクエスト数を返す
+
+    python -m bench.server --port 8080 --latency 0.02 --error_rate 0.01
+'''
+from collections import defaultdict
+from typing import Optional
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import urllib.parse
+from aiohttp import web
+from cacher import Cacher
+
+WEAR = 'wear.jp'
+NETKEIBA = 'db.netkeiba.com'
+ANICOBIN = 'anicobin.ldblog.jp'
+BLOGIMG = 'livedoor.blogimg.jp'
+HOSTS = (WEAR, NETKEIBA, ANICOBIN, BLOGIMG)
+
+NETKEIBA_ENCODING = 'euc_jis_2004'
+# EUC-JPにはない文字も混ぜる
+JOCKEYS = ['武豊', '髙田潤', '﨑山', 'ルメール', '横山典弘']
+HORSES = ['ディープインパクト', 'キタサンブラック', 'オルフェーヴル', '髙嶺の花', 'アーモンドアイ']
+
+
+def redirect(location: str) -> web.Response:
+    return web.Response(status=302, headers={'location': location})
+
+
+class ReplayServer():
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, page_size: int = 60000, image_size: int = 50000,
+                 users_pages: int = 5, users_per_page: int = 20, gallery_pages: int = 3, snaps_per_page: int = 10,
+                 search_pages: int = 3, list_pages: int = 5, posts_per_page: int = 5, images_per_post: int = 4,
+                 record: str = None, seed: int = 0) -> None:
+        '''
+        latency: 応答までの平均秒数 (指数分布)
+        error_rate: 503 (Retry-After: 0) を返す割合
+        page_size: HTMLをスクリプトで埋めてこの大きさにする
+        record: コレクタのキャッシュのディレクトリ あればGETのページはそこから返す
+        '''
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.image_size = image_size
+        self.users_pages = users_pages
+        self.users_per_page = users_per_page
+        self.gallery_pages = gallery_pages
+        self.snaps_per_page = snaps_per_page
+        self.search_pages = search_pages
+        self.list_pages = list_pages
+        self.posts_per_page = posts_per_page
+        self.images_per_post = images_per_post
+        self.cacher = Cacher(record) if record else None
+        self._random = random.Random(seed)
+        # (ホスト, 種類) -> {ステータス: 回数}
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/__stats__', self.stats)
+        app.router.add_route('*', '/{tail:.*}', self.handle)
+        return app
+
+    async def stats(self, request: web.Request):
+        return web.json_response({f'{host} {kind}': dict(statuses) for (host, kind), statuses in self.counts.items()})
+
+    async def handle(self, request: web.Request):
+        host = request.host.split(':')[0]
+        if self.latency > 0:
+            await asyncio.sleep(self._random.expovariate(1 / self.latency))
+        kind = 'image' if request.path.endswith('.jpg') else 'page'
+        if self._random.random() < self.error_rate:
+            response = web.Response(status=503, headers={'retry-after': '0'})
+        else:
+            response = await self.route(host, request)
+        self.counts[host, kind][response.status] += 1
+        return response
+
+    async def route(self, host: str, request: web.Request) -> web.StreamResponse:
+        path = request.path
+        if path.endswith('.jpg'):
+            return self.image(path)
+        recorded = self.recorded(host, request)
+        if recorded is not None:
+            return recorded
+        if host == WEAR:
+            return self.wear(request)
+        if host == NETKEIBA:
+            return await self.netkeiba(request)
+        if host == ANICOBIN:
+            return self.anicobin(request)
+        return web.Response(status=404)
+
+    def pad(self, body: str) -> str:
+        # 実際のページのようにスクリプトなどで埋める
+        filler = max(self.page_size - len(body), 0)
+        return f'<html><head><script>var x = "{"x" * filler}";</script></head><body>{body}</body></html>'
+
+    def html(self, body: str, encoding: str = 'utf-8') -> web.Response:
+        charset = 'EUC-JP' if encoding == NETKEIBA_ENCODING else encoding
+        return web.Response(body=self.pad(body).encode(encoding, 'xmlcharrefreplace'),
+                            content_type='text/html', charset=charset)
+
+    def recorded(self, host: str, request: web.Request) -> Optional[web.Response]:
+        if self.cacher is None or request.method != 'GET':
+            return None
+        url = f'https://{host}{request.path_qs}'
+        content, info = self.cacher.get(urllib.parse.quote(url, safe='') + '.html', binary=True)
+        if content is None:
+            return None
+        realurl = (info or {}).get('realurl', url)
+        if realurl != url:
+            return redirect(urllib.parse.urlsplit(realurl)._replace(scheme='', netloc='').geturl())
+        encoding = NETKEIBA_ENCODING if host == NETKEIBA else 'utf-8'
+        if (info or {}).get('encoding') != encoding:
+            # 以前のキャッシュはUTF-8に変換して保存している
+            content = content.decode((info or {}).get('encoding') or 'utf-8').encode(encoding, 'xmlcharrefreplace')
+        return web.Response(body=content, content_type='text/html',
+                            charset='EUC-JP' if host == NETKEIBA else encoding)
+
+    def image(self, path: str) -> web.Response:
+        # パスから決まる内容 (同じURLは同じ内容)
+        seed = hashlib.sha256(path.encode('utf-8')).digest()
+        body = b'\xff\xd8' + seed * (self.image_size // len(seed))
+        return web.Response(body=body, content_type='image/jpeg', headers={'etag': f'"{seed[:8].hex()}"'})
+
+    def wear(self, request: web.Request) -> web.Response:
+        path = request.path
+        paged = 'pageno' in request.query
+        page = int(request.query.get('pageno', '1'))
+        if path == '/users/':
+            if paged and page > self.users_pages:
+                return redirect('/users/')
+            users = ''.join(self.wear_user(f'u{page}_{i}', i) for i in range(self.users_per_page))
+            return self.html(f'<div id="list_1column"><ul>{users}</ul></div>')
+        user = path.strip('/')
+        if paged and page > self.gallery_pages:
+            return redirect(path)
+        return self.html(''.join(self.wear_snap(user, page, i) for i in range(self.snaps_per_page)))
+
+    @staticmethod
+    def wear_user(user: str, i: int) -> str:
+        user_type = ['<span class="wearista"></span>', '<span class="shopstaff"></span>', ''][i % 3]
+        shop = f'<p class="shopname">SHOP {i}</p>' if i % 3 == 1 else ''
+        return f'''<li class="list"><a class="over" href="/{user}/"></a>
+<h3 class="name">ユーザー {user}{user_type}</h3>{shop}
+<ul class="info"><li>{160 + i % 30}cm</li><li>東京都</li></ul><ul class="meta"><li>{i * 7} フォロワー</li></ul>
+<div class="fav_brand"><ul><li>BRAND{i % 5}</li><li>BRAND{i % 7}</li></ul></div></li>'''
+
+    @staticmethod
+    def wear_snap(user: str, page: int, i: int) -> str:
+        snapid = f'{user}{page:03d}{i:03d}'
+        return f'''<div class="like_mark" data-snapid="{snapid}"><div class="img">
+<img data-originalretina="//wear.jp/img/{user}/{snapid}.jpg"></div>
+<div class="btn_save"><span> {i * 3} </span></div><div class="btn_like"><span>{i * 5}</span></div>
+<a class="over" href="/{user}/{snapid}/"></a><span class="namefirst">{user}</span><span class="height">{160 + i}cm</span></div>'''
+
+    async def netkeiba(self, request: web.Request) -> web.Response:
+        path = request.path
+        if request.method == 'POST':
+            form = await request.post()
+            page = int(form.get('page', '1'))
+            pid = form.get('pid')
+            rows = 100 if page < self.search_pages else 37
+            if pid == 'race_list':
+                table = self.netkeiba_race_list(page, rows)
+            elif pid == 'horse_list':
+                table = self.netkeiba_horse_list(page, rows)
+            else:
+                return web.Response(status=400)
+            inputs = ''.join(f'<input type="hidden" name="{k}" value="{v}">' for k, v in form.items() if k != 'page')
+            return self.html(f'{table}<form name="sort" method="post">{inputs}</form>', NETKEIBA_ENCODING)
+        parts = path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'race':
+            return self.html(self.netkeiba_race(parts[1]), NETKEIBA_ENCODING)
+        if len(parts) == 2 and parts[0] == 'horse':
+            return self.html(self.netkeiba_horse(parts[1]), NETKEIBA_ENCODING)
+        return web.Response(status=404)
+
+    @staticmethod
+    def netkeiba_race_list(page: int, rows: int) -> str:
+        header = '<tr><th>開催日</th><th>開催</th><th>天気</th><th>R</th><th>レース名</th><th>距離</th></tr>'
+        body = ''.join(f'''<tr><td>2020/01/{i % 28 + 1:02d}</td><td>1東京{i % 8 + 1}</td><td>晴</td><td>{i % 12 + 1}</td>
+<td><a href="/race/2020{page:04d}{i:04d}/">レース{i}</a></td><td>芝{1200 + i % 10 * 200}</td></tr>''' for i in range(rows))
+        return f'<table class="race_table_01">{header}{body}</table>'
+
+    @staticmethod
+    def netkeiba_horse_list(page: int, rows: int) -> str:
+        header = '<tr><th></th><th>馬名</th><th>性</th><th>生年</th><th>厩舎</th><th>父</th><th>母</th></tr>'
+        body = ''.join(f'''<tr><td><input type="checkbox"></td><td><a href="/horse/2018{page:04d}{i:04d}/">{HORSES[i % 5]}{i}</a></td>
+<td>牡</td><td>2018</td><td><a href="/trainer/0{i:04d}/">[東] 調教師{i}</a></td><td>父{i}</td><td>母{i}</td></tr>''' for i in range(rows))
+        return f'<table class="race_table_01">{header}{body}</table>'
+
+    @staticmethod
+    def netkeiba_race(race_id: str) -> str:
+        header = ('<tr><th>着順</th><th>枠番</th><th>馬番</th><th>馬名</th><th>性齢</th><th>斤量</th><th>騎手</th>'
+                  '<th>タイム</th><th>着差</th><th>単勝</th><th>人気</th><th>馬体重</th><th>調教師</th></tr>')
+        body = ''.join(f'''<tr><td>{i + 1}</td><td>{i // 2 + 1}</td><td>{i + 1}</td>
+<td><a href="/horse/2017{i:06d}/">{HORSES[i % 5]}</a></td><td>牡{3 + i % 4}</td><td>5{i % 8}.0</td>
+<td><a href="/jockey/0{i:04d}/">{JOCKEYS[i % 5]}</a></td><td>1:3{i % 10}.{i % 9}</td><td>{'1/2' if i else ''}</td>
+<td>{1.5 + i * 2.3:.1f}</td><td>{i + 1}</td><td>4{80 + i}(+{i % 5})</td><td><a href="/trainer/0{i:04d}/">[西] 調教師{i}</a></td></tr>'''
+                       for i in range(16))
+        return f'<h1>レース {race_id}</h1><table class="race_table_01">{header}{body}</table>'
+
+    @staticmethod
+    def netkeiba_horse(horse_id: str) -> str:
+        header = '<tr><th>日付</th><th>開催</th><th>レース名</th><th>着順</th><th>騎手</th><th>距離</th></tr>'
+        body = ''.join(f'''<tr><td>2020/0{i + 1}/01</td><td>1東京{i + 1}</td><td><a href="/race/2020{i:08d}/">レース{i}</a></td>
+<td>{i + 1}</td><td><a href="/jockey/0{i:04d}/">{JOCKEYS[i % 5]}</a></td><td>ダ{1400 + i * 200}</td></tr>''' for i in range(8))
+        return f'<h1>{horse_id}</h1><table class="db_h_race_results">{header}{body}</table>'
+
+    def anicobin(self, request: web.Request) -> web.Response:
+        path = request.path
+        if path == '/':
+            page = int(request.query.get('p', '1'))
+            if page > self.list_pages:
+                return self.html('<p>no entries</p>')
+            return self.html(''.join(
+                f'<div class="hentry"><a href="https://{ANICOBIN}/archives/{page}{i:04d}.html">記事 {page}-{i}</a></div>'
+                for i in range(self.posts_per_page)))
+        if path.startswith('/archives/'):
+            post = path.rsplit('/', 1)[-1].split('.')[0]
+            return self.html(''.join(
+                f'<div class="tw_matome"><a href="https://{BLOGIMG}/anicobin/imgs/{post}_{i}.jpg"><img src="t.jpg"></a></div>'
+                for i in range(self.images_per_post)))
+        return web.Response(status=404)
+
+
+async def start(server: ReplayServer, host: str = '127.0.0.1', port: int = 0):
+    '''
+    return: (runner, 待ち受けているポート)
+    '''
+    runner = web.AppRunner(server.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+
+async def main(args):
+    server = ReplayServer(latency=args.latency, error_rate=args.error_rate, page_size=args.page_size,
+                          image_size=args.image_size, users_pages=args.users_pages, gallery_pages=args.gallery_pages,
+                          search_pages=args.search_pages, list_pages=args.list_pages, record=args.record, seed=args.seed)
+    runner, port = await start(server, args.host, args.port)
+    # 起動したことを親プロセスに知らせる
+    print(json.dumps({'port': port}), flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('bench.server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='0 picks a free port (printed as json)')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response delay in seconds')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--page_size', type=int, default=60000)
+    parser.add_argument('--image_size', type=int, default=50000)
+    parser.add_argument('--users_pages', type=int, default=5)
+    parser.add_argument('--gallery_pages', type=int, default=3)
+    parser.add_argument('--search_pages', type=int, default=3)
+    parser.add_argument('--list_pages', type=int, default=5)
+    parser.add_argument('--record', type=str, default=None, help='cache directory of a previous crawl to replay')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,79 @@
+'''
+Waiterのマイクロベンチマーク
+多数のコルーチンが同じホストを待つときの間隔の正確さとオーバーヘッドを測る
+
+    python -m bench.waiter -n 10000 --sec 0.0005
+'''
+import argparse
+import asyncio
+import time
+from typing import Dict
+import urllib.parse
+
+from waiter import ConstWaiter
+
+
+class LegacyWaiter():
+    '''
+    比較用: 以前のロックを持ったまま眠る実装
+    '''
+
+    def __init__(self, sec: float) -> None:
+        self.sec = sec
+        self._table: Dict[str, list] = {}
+
+    async def wait(self, url: str):
+        host = urllib.parse.urlparse(url).hostname
+        if host in self._table:
+            lock, _ = self._table[host]
+            await lock.acquire()
+            now = time.time()
+            if now > self._table[host][1] + self.sec:
+                self._table[host][1] = now
+            else:
+                await asyncio.sleep(max(self.sec - (now - self._table[host][1]), 0))
+                self._table[host][1] = time.time()
+            lock.release()
+        else:
+            self._table[host] = [asyncio.Lock(), time.time()]
+
+
+async def measure(waiter, n: int, sec: float):
+    times = []
+
+    async def request():
+        await waiter.wait('https://wear.jp/')
+        times.append(time.monotonic())
+
+    start = time.monotonic()
+    cpu = time.process_time()
+    await asyncio.gather(*[request() for _ in range(n)])
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+
+    times.sort()
+    # i番目のリクエストは最初から i*sec 以上あとでなければならない
+    # (イベントループの粒度の分だけ許容する)
+    violations = sum(1 for i, t in enumerate(times) if t - times[0] < i * sec - 0.001)
+    # 予定より遅れた分 (遅れが積み重なると全体が遅くなる)
+    lag = max(t - times[0] - i * sec for i, t in enumerate(times))
+    return {
+        'elapsed': round(elapsed, 3),
+        'expected': round((n - 1) * sec, 3),
+        'cpu': round(cpu, 3),
+        'max_lag': round(lag, 4),
+        'violations': violations,
+    }
+
+
+async def main(n: int, sec: float):
+    for name, waiter in (('slot', ConstWaiter(sec)), ('legacy', LegacyWaiter(sec))):
+        print(name, await measure(waiter, n, sec))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('bench.waiter')
+    parser.add_argument('-n', type=int, default=10000, help='number of waiting coroutines')
+    parser.add_argument('--sec', type=float, default=0.0005, help='interval per host')
+    args = parser.parse_args()
+    asyncio.run(main(args.n, args.sec))
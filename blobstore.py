@@ -0,0 +1,146 @@
+from typing import Dict, Optional, Tuple
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+
+class BlobStore():
+    '''
+    ダウンロードしたファイルを内容のハッシュ(sha256)で保存する
+    同じ内容のものはハードリンクで共有し、キャッシュのファイルもそのリンクにする
+    URL -> ハッシュ と (ETag, 大きさ) -> ハッシュ をSQLiteで持ち、
+    既知のものはダウンロードせずにリンクするだけにする
+    ファイル操作とSQLiteは同期的なので、Downloaderはスレッドプールから呼ぶ
+    '''
+    INDEX = 'index.sqlite3'
+    # 他のプロセスが書き込み中ならこの秒数まで待つ
+    BUSY_TIMEOUT = 30
+
+    def __init__(self, directory: str, commit_records: int = 100, commit_interval: float = 1.0) -> None:
+        '''
+        commit_records件たまるか、最初の未書き込みの記録からcommit_interval秒たったらまとめて書き込む
+        書き込むまでの間だけトランザクションを持つ (複数プロセスでインデックスを共有する)
+        '''
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.commit_records = commit_records
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        # 未書き込みの記録 url -> (hash, etag, size)
+        self._pending: Dict[str, Tuple[str, Optional[str], int]] = {}
+        self._pending_since = 0.0
+        self._db = sqlite3.connect(os.path.join(directory, self.INDEX), timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS urls (
+            url TEXT PRIMARY KEY,
+            hash TEXT,
+            etag TEXT,
+            size INTEGER)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS urls_etag ON urls (etag, size)')
+        self._db.commit()
+        self.url_hits = 0
+        self.etag_hits = 0
+        self.content_hits = 0
+        # ダウンロードしなかった分と、ダウンロードしたが重複して保存しなかった分
+        self.bytes_saved = 0
+        self.disk_saved = 0
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def _exists(self, digest: Optional[str]) -> bool:
+        return digest is not None and os.path.exists(self.blob_path(digest))
+
+    def lookup_url(self, url: str) -> Optional[str]:
+        with self._lock:
+            if url in self._pending:
+                row = self._pending[url][:1]
+            else:
+                row = self._db.execute('SELECT hash FROM urls WHERE url=?', (url,)).fetchone()
+        if row and self._exists(row[0]):
+            self.url_hits += 1
+            self.bytes_saved += os.path.getsize(self.blob_path(row[0]))
+            return row[0]
+        return None
+
+    def lookup_etag(self, etag: Optional[str], size: Optional[int]) -> Optional[str]:
+        '''
+        強いETagと大きさが一致する既知のファイル
+        '''
+        if not etag or etag.startswith('W/') or size is None:
+            return None
+        with self._lock:
+            row = next(((h,) for h, e, n in self._pending.values() if e == etag and n == size), None)
+            if row is None:
+                row = self._db.execute('SELECT hash FROM urls WHERE etag=? AND size=? LIMIT 1', (etag, size)).fetchone()
+        if row and self._exists(row[0]):
+            self.etag_hits += 1
+            self.bytes_saved += size
+            return row[0]
+        return None
+
+    def _record(self, url: str, digest: str, etag: Optional[str], size: int):
+        with self._lock:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending[url] = (digest, etag, size)
+            full = len(self._pending) >= self.commit_records
+        if full or time.monotonic() - self._pending_since >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._pending = self._pending, {}
+            if rows:
+                self._db.executemany('INSERT OR REPLACE INTO urls (url, hash, etag, size) VALUES (?, ?, ?, ?)',
+                                     [(url, *row) for url, row in rows.items()])
+                self._db.commit()
+
+    def link(self, digest: str, path: str, url: str = None, etag: str = None):
+        '''
+        pathを既存のblobへのリンクにする
+        '''
+        if os.path.exists(path):
+            os.remove(path)
+        blob = self.blob_path(digest)
+        try:
+            os.link(blob, path)
+        except OSError:
+            # 別のファイルシステムなど
+            shutil.copyfile(blob, path)
+        if url is not None:
+            self._record(url, digest, etag, os.path.getsize(blob))
+
+    def add(self, path: str, digest: str, url: str, etag: str = None):
+        '''
+        ダウンロードしたファイルを登録する
+        同じ内容がすでにあればpathはそのリンクに置き換える
+        '''
+        blob = self.blob_path(digest)
+        size = os.path.getsize(path)
+        if os.path.exists(blob):
+            self.content_hits += 1
+            self.disk_saved += size
+            self.link(digest, path)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+            except OSError:
+                shutil.copyfile(path, blob)
+        self._record(url, digest, etag, size)
+
+    def stats(self):
+        return {
+            'url_hits': self.url_hits,
+            'etag_hits': self.etag_hits,
+            'content_hits': self.content_hits,
+            'bytes_saved': self.bytes_saved,
+            'disk_saved': self.disk_saved,
+        }
+
+    def close(self):
+        self.flush()
+        self._db.close()
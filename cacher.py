@@ -1,6 +1,67 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, Optional, Tuple
+import argparse
+import asyncio
+import hashlib
+import time
+import urllib.parse
 import shutil
+import sqlite3
+import threading
 import os
 import json
+import gzip
+from metrics import NULL
+from page import Page
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 圧縮したエントリの先頭につけるヘッダ
+# テキストも画像もNULから始まることはないので非圧縮のエントリと共存できる
+COMPRESS_HEADER = b'\x00cz:'
+# entriesで情報をまだ読んでいないことを表す
+UNKNOWN = object()
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/xml', 'application/xhtml', 'application/javascript')
+
+
+def compress(content: bytes, method: str) -> bytes:
+    if method == 'gzip':
+        body = gzip.compress(content, 6)
+    elif method == 'zstd':
+        body = zstandard.ZstdCompressor(level=3).compress(content)
+    else:
+        raise ValueError(f'unknown compression {method}')
+    return COMPRESS_HEADER + method.encode('ascii') + b'\n' + body
+
+
+def decompress(content: bytes) -> bytes:
+    if not content.startswith(COMPRESS_HEADER):
+        return content
+    end = content.index(b'\n', len(COMPRESS_HEADER))
+    method = content[len(COMPRESS_HEADER):end].decode('ascii')
+    body = content[end+1:]
+    if method == 'gzip':
+        return gzip.decompress(body)
+    elif method == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is required to read zstd compressed cache')
+        return zstandard.ZstdDecompressor().decompress(body)
+    else:
+        raise ValueError(f'unknown compression {method}')
+
+
+def read_content(path: str, encoding: str = None) -> Page:
+    '''
+    キャッシュのファイルを直接読む (別プロセスから使う)
+    encoding: 保存したときの情報のencoding (なければ以前のようにUTF-8で保存したもの)
+    '''
+    with open(path, 'rb') as f:
+        return Page(decompress(f.read()), encoding)
 
 
 def tmp_save(path: str, content: str):
@@ -14,35 +75,610 @@ def tmp_save(path: str, content: str):
     shutil.move(tmppath, path)
 
 
+def fsync_path(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FlatStorage():
+    '''
+    1ディレクトリにファイル名そのままで保存する従来の形式
+    情報は<filename>.jsonに保存
+    '''
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def read(self, key: str) -> Optional[bytes]:
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def write(self, key: str, content: bytes):
+        tmp_save(self.path(key), content)
+
+    def commit(self, key: str, tmppath: str):
+        shutil.move(tmppath, self.path(key))
+
+    def read_info(self, key: str) -> Optional[dict]:
+        infopath = self.path(key)+'.json'
+        if not os.path.exists(infopath):
+            return None
+        with open(infopath, 'rt', encoding='utf-8') as f:
+            return json.loads(f.read())
+
+    def write_info(self, key: str, info: dict):
+        tmp_save(self.path(key)+'.json', json.dumps(info))
+
+    def sync(self, keys: Iterable[str]):
+        for key in keys:
+            for path in (self.path(key), self.path(key)+'.json'):
+                fsync_path(path)
+        fsync_path(self.cache_dir)
+
+    def entries(self) -> Iterator[Tuple[str, bool, Any]]:
+        '''
+        (key, 本体があるか, 情報)を列挙
+        本体のない.jsonは情報だけのエントリ
+        情報は読まずにUNKNOWNを返す
+        '''
+        names = set()
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                # インデックスやfrontierのSQLiteファイルは除く
+                if e.is_file() and not e.name.endswith('~') and '.sqlite3' not in e.name:
+                    names.add(e.name)
+        for name in names:
+            if name.endswith('.json') and name[:-5] in names:
+                continue
+            if name.endswith('.json'):
+                yield name[:-5], False, UNKNOWN
+            elif name+'.json' in names:
+                yield name, True, UNKNOWN
+            else:
+                yield name, True, None
+
+    def close(self):
+        pass
+
+
+class ShardedStorage():
+    '''
+    keyのハッシュでシャーディングしたサブディレクトリに保存
+    key -> 保存場所, status, realurl, 情報 はSQLiteのインデックスで管理
+    '''
+    INDEX = 'index.sqlite3'
+    # 他のプロセスが書き込み中ならこの秒数まで待つ
+    BUSY_TIMEOUT = 30
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        # Falseのときはsyncでまとめてコミットする
+        self.autocommit = True
+        self._lock = threading.Lock()
+        self._dirs = set()
+        self._db = sqlite3.connect(os.path.join(cache_dir, self.INDEX), timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            path TEXT,
+            status INTEGER,
+            realurl TEXT,
+            info TEXT)''')
+        self._db.commit()
+
+    @staticmethod
+    def relpath(key: str) -> str:
+        h = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(h[:2], h[2:4], h)
+
+    def path(self, key: str) -> str:
+        path = os.path.join(self.cache_dir, self.relpath(key))
+        dirname = os.path.dirname(path)
+        if dirname not in self._dirs:
+            os.makedirs(dirname, exist_ok=True)
+            self._dirs.add(dirname)
+        return path
+
+    def _lookup(self, key: str):
+        with self._lock:
+            return self._db.execute('SELECT path, info FROM entries WHERE key=?', (key,)).fetchone()
+
+    def _execute(self, sql: str, params: tuple):
+        with self._lock:
+            self._db.execute(sql, params)
+            if self.autocommit:
+                self._db.commit()
+
+    def exists(self, key: str) -> bool:
+        row = self._lookup(key)
+        return bool(row and row[0])
+
+    def read(self, key: str) -> Optional[bytes]:
+        row = self._lookup(key)
+        if not row or not row[0]:
+            return None
+        with open(os.path.join(self.cache_dir, row[0]), 'rb') as f:
+            return f.read()
+
+    def write(self, key: str, content: bytes):
+        tmp_save(self.path(key), content)
+        self._index_path(key)
+
+    def commit(self, key: str, tmppath: str):
+        shutil.move(tmppath, self.path(key))
+        self._index_path(key)
+
+    def _index_path(self, key: str):
+        self._execute('''INSERT INTO entries (key, path) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET path=excluded.path''', (key, self.relpath(key)))
+
+    def read_info(self, key: str) -> Optional[dict]:
+        row = self._lookup(key)
+        if not row or row[1] is None:
+            return None
+        return json.loads(row[1])
+
+    def write_info(self, key: str, info: dict):
+        self._execute('''INSERT INTO entries (key, status, realurl, info) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET status=excluded.status, realurl=excluded.realurl, info=excluded.info''',
+                      (key, info.get('status'), info.get('realurl'), json.dumps(info)))
+
+    def sync(self, keys: Iterable[str]):
+        for key in keys:
+            fsync_path(os.path.join(self.cache_dir, self.relpath(key)))
+        with self._lock:
+            self._db.commit()
+
+    def entries(self) -> Iterator[Tuple[str, bool, Any]]:
+        # 列挙中も書き込めるように別の接続で読む
+        db = sqlite3.connect(os.path.join(self.cache_dir, self.INDEX), timeout=self.BUSY_TIMEOUT)
+        try:
+            cursor = db.execute('SELECT key, path, info FROM entries')
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                for key, path, info in rows:
+                    yield key, path is not None, json.loads(info) if info is not None else None
+        finally:
+            db.close()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+STORAGES = {
+    'flat': FlatStorage,
+    'sharded': ShardedStorage,
+}
+
+
+class LRUIndex():
+    '''
+    存在が分かっているkeyと読み込んだ情報を保持するLRU
+    max_entriesかmax_bytesで大きさを制限する
+    '''
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None, shared: bool = False) -> None:
+        '''
+        shared: 他のプロセスも書き込むキャッシュ ないことは記憶しない (completeにもしない)
+        '''
+        self.max_entries = max_entries
+        self.shared = shared
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # 全エントリを読み込んであふれていなければ、ないkeyは存在しない
+        self.complete = False
+        self._data: 'OrderedDict[str, Tuple[bool, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(key: str, info) -> int:
+        size = 100 + len(key)
+        if info is not None and info is not UNKNOWN:
+            size += len(json.dumps(info))
+        return size
+
+    def _full(self) -> bool:
+        return (self.max_entries is not None and len(self._data) > self.max_entries) \
+            or (self.max_bytes is not None and self.size > self.max_bytes)
+
+    def put(self, key: str, has_content: bool = None, info=UNKNOWN) -> bool:
+        '''
+        has_content: Noneなら既存の値を残す (なければ不明)
+        info: UNKNOWNなら既存の値を残す
+        あふれて追い出したらFalse
+        '''
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= self._sizeof(key, old[1])
+                if has_content is None:
+                    has_content = old[0]
+                if info is UNKNOWN:
+                    info = old[1]
+            elif has_content is None and self.complete:
+                has_content = False
+            if self.shared:
+                # ないものは他のプロセスがあとで書くかもしれない
+                if has_content is False:
+                    has_content = None
+                if info is None:
+                    info = UNKNOWN
+            self._data[key] = (has_content, info)
+            self.size += self._sizeof(key, info)
+
+            evicted = False
+            while self._full():
+                k, (_, i) = self._data.popitem(last=False)
+                self.size -= self._sizeof(k, i)
+                self.complete = False
+                evicted = True
+            return not evicted
+
+    def lookup(self, key: str) -> Optional[Tuple[bool, Any]]:
+        '''
+        (本体があるか, 情報) 分からなければNone
+        本体があるかがNone, 情報がUNKNOWNのときはその部分だけ不明
+        '''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry
+            if self.complete:
+                self.hits += 1
+                return False, None
+            self.misses += 1
+            return None
+
+    def warm(self, storage):
+        '''
+        ストレージのインデックスからまとめて読み込む
+        '''
+        for key, has_content, info in storage.entries():
+            if not self.put(key, has_content, info):
+                return
+        self.complete = not self.shared
+
+    def stats(self):
+        return {'entries': len(self._data), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+def parse_size(size: str) -> Tuple[Optional[int], Optional[int]]:
+    '''
+    '100000' -> エントリ数, '512M' -> バイト数
+    '''
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if size[-1].upper() in units:
+        return None, int(float(size[:-1]) * units[size[-1].upper()])
+    return int(size), None
+
+
+def open_storage(cache_dir: str, backend: str = None):
+    # 指定がなければインデックスの有無で判定
+    if backend is None:
+        if os.path.exists(os.path.join(cache_dir, ShardedStorage.INDEX)):
+            backend = 'sharded'
+        else:
+            backend = 'flat'
+    return STORAGES[backend](cache_dir)
+
+
 class Cacher():
-    def __init__(self, cache_dir: str = 'cache') -> None:
+    def __init__(self, cache_dir: str = 'cache', backend: str = None, compression: str = None,
+                 lru: LRUIndex = None) -> None:
+        '''
+        compression: テキストのエントリを圧縮する ('gzip' or 'zstd')
+        lru: 存在確認と情報のメモリキャッシュ 起動時にインデックスから読み込む
+        '''
         if not os.path.exists(cache_dir):
             os.mkdir(cache_dir)
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstandard is required for zstd compression')
         self.cache_dir = cache_dir
+        self.compression = compression
+        self.storage = open_storage(cache_dir, backend)
+        self.lru = lru
+        if self.lru is not None:
+            self.lru.warm(self.storage)
 
     def get(self, filename: str, binary=False):
+        '''
+        binary: bytesのまま返す Falseなら情報のencoding (なければUTF-8) でデコードする
+        '''
         content, info = None, None
 
-        path = os.path.join(self.cache_dir, filename)
-        if os.path.exists(path):
-            if binary:
-                with open(path, 'rb') as f:
-                    content = f.read()
-            else:
-                with open(path, 'rt', encoding='utf-8') as f:
-                    content = f.read()
+        known = self.lru.lookup(filename) if self.lru is not None else None
+        if known is None or known[0] is not False:
+            content = self.storage.read(filename)
+
+        if known is not None and known[1] is not UNKNOWN:
+            info = known[1]
+        else:
+            info = self.storage.read_info(filename)
+
+        if content is not None:
+            content = decompress(content)
+            if not binary:
+                content = content.decode((info or {}).get('encoding') or 'utf-8')
 
-        infopath = os.path.join(self.cache_dir, filename+'.json')
-        if os.path.exists(infopath):
-            with open(infopath, 'rt', encoding='utf-8') as f:
-                info = json.loads(f.read())
+        if self.lru is not None:
+            self.lru.put(filename, content is not None, info)
 
         return content, info
 
-    def set(self, filename: str, content, info: dict = None):
-        path = os.path.join(self.cache_dir, filename)
-        tmp_save(path, content)
+    def set(self, filename: str, content, info: dict = None, content_type: str = None):
+        '''
+        str, Pageまたはテキストのcontent_typeのときだけ圧縮する
+        Pageは取得したままのバイト列を書く (エンコーディングはinfoに入れておく)
+        '''
+        if content_type is None and info:
+            content_type = info.get('content-type')
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+            content_type = content_type or 'text/plain'
+        elif isinstance(content, Page):
+            content_type = content_type or 'text/html'
+        if self.compression and content_type and content_type.startswith(COMPRESSIBLE_TYPES):
+            content = compress(content, self.compression)
+        self.storage.write(filename, content)
+
+        if info:
+            self.storage.write_info(filename, info)
+        if self.lru is not None:
+            self.lru.put(filename, True, info if info else UNKNOWN)
+
+    def set_info(self, filename: str, info: dict):
+        self.storage.write_info(filename, info)
+        if self.lru is not None:
+            self.lru.put(filename, None, info)
+
+    def known_exists(self, filename: str) -> Optional[bool]:
+        '''
+        ファイルシステムを見ずに分かるときだけ返す
+        '''
+        if self.lru is None:
+            return None
+        known = self.lru.lookup(filename)
+        return None if known is None else known[0]
+
+    def exists(self, filename: str) -> bool:
+        known = self.known_exists(filename)
+        if known is not None:
+            return known
+        return self._exists(filename)
+
+    def _exists(self, filename: str) -> bool:
+        exists = self.storage.exists(filename)
+        if self.lru is not None:
+            self.lru.put(filename, exists)
+        return exists
+
+    def content_path(self, filename: str) -> Optional[str]:
+        '''
+        本文のファイルのパス なければNone
+        '''
+        path = self.storage.path(filename)
+        return path if os.path.exists(path) else None
+
+    def tmp_path(self, filename: str) -> str:
+        '''
+        ストリーミングで書き込むときの一時ファイル
+        書き終わったらcommitする
+        '''
+        return self.storage.path(filename)+'~'
+
+    def commit(self, filename: str, tmppath: str):
+        self.storage.commit(filename, tmppath)
+        if self.lru is not None:
+            self.lru.put(filename, True)
+
+    def stats(self):
+        return self.lru.stats() if self.lru is not None else {}
+
+    def close(self):
+        self.storage.close()
+
+
+class CachePolicy():
+    '''
+    サイトごとのキャッシュの有効期限
+    max_ageがNoneなら期限なし
+    revalidateなら期限切れのときにETag/Last-Modifiedで条件付きリクエストする
+    '''
+
+    def __init__(self, max_age: float = None, revalidate: bool = False, policy_file: str = None) -> None:
+        self.revalidate = revalidate
+        self._table = {'*': max_age}
+        if policy_file and os.path.exists(policy_file):
+            with open(policy_file, 'rt', encoding='utf-8') as f:
+                obj: dict = json.load(f)
+                for host, age in obj.items():
+                    self._table[host] = None if age is None else float(age)
+
+    def max_age(self, url: str) -> Optional[float]:
+        host = urllib.parse.urlparse(url).hostname
+        if host in self._table:
+            return self._table[host]
+        return self._table['*']
+
+    def is_fresh(self, url: str, info: Optional[dict]) -> bool:
+        max_age = self.max_age(url)
+        if max_age is None:
+            return True
+        if not info or 'fetched' not in info:
+            return False
+        return time.time() - info['fetched'] < max_age
 
+    @staticmethod
+    def conditional_headers(info: Optional[dict]) -> dict:
+        headers = {}
         if info:
-            infopath = os.path.join(self.cache_dir, filename+'.json')
-            tmp_save(infopath, json.dumps(info))
+            if info.get('etag'):
+                headers['if-none-match'] = info['etag']
+            if info.get('last-modified'):
+                headers['if-modified-since'] = info['last-modified']
+        return headers
+
+
+# infoに保存するレスポンスヘッダ
+VALIDATOR_HEADERS = ('etag', 'last-modified', 'cache-control')
+
+
+class AsyncCacher():
+    '''
+    Cacherのファイル操作をスレッドプールで行いイベントループを止めない
+    fsyncはまとめて定期的に行う
+    '''
+
+    def __init__(self, cacher: Cacher, max_workers: int = 8, fsync_interval: float = 1.0, shared: bool = False) -> None:
+        '''
+        shared: 他のプロセスとインデックスを共有する 書き込みをすぐコミットしてロックを持ち続けない
+        '''
+        self.cacher = cacher
+        self.max_workers = max_workers
+        self.fsync_interval = fsync_interval
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix='cacher')
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._dirty = set()
+        self._flusher: Optional[asyncio.Task] = None
+        if isinstance(cacher.storage, ShardedStorage) and not shared:
+            cacher.storage.autocommit = False
+        self.instrument(NULL)
+
+    def instrument(self, registry):
+        self._m_queue = registry.histogram('crawler_cache_queue_seconds', 'time cache operations wait for a worker thread')
+        self._m_op = registry.histogram('crawler_cache_op_seconds', 'time of cache file operations', ('op',))
+
+    def _timed(self, fn, submitted: float, *args):
+        # ワーカースレッドで実行する
+        start = time.monotonic()
+        self._m_queue.observe(start - submitted)
+        try:
+            return fn(*args)
+        finally:
+            self._m_op.observe(time.monotonic() - start, fn.__name__.strip('_'))
+
+    async def _run(self, fn, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        submitted = time.monotonic()
+        async with self._semaphore:
+            return await asyncio.get_event_loop().run_in_executor(self._pool, self._timed, fn, submitted, *args)
+
+    def _mark_dirty(self, filename: str):
+        self._dirty.add(filename)
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.fsync_interval)
+        self._flusher = None
+        await self.flush()
+
+    async def flush(self):
+        keys, self._dirty = self._dirty, set()
+        await asyncio.get_event_loop().run_in_executor(self._pool, self.cacher.storage.sync, keys)
+
+    async def aget(self, filename: str, binary=False):
+        return await self._run(self.cacher.get, filename, binary)
+
+    async def aset(self, filename: str, content, info: dict = None, content_type: str = None):
+        await self._run(self.cacher.set, filename, content, info, content_type)
+        self._mark_dirty(filename)
+
+    async def aset_info(self, filename: str, info: dict):
+        await self._run(self.cacher.set_info, filename, info)
+        self._mark_dirty(filename)
+
+    async def aexists(self, filename: str) -> bool:
+        known = self.cacher.known_exists(filename)
+        if known is not None:
+            return known
+        return await self._run(self.cacher._exists, filename)
+
+    def tmp_path(self, filename: str) -> str:
+        return self.cacher.tmp_path(filename)
+
+    def content_path(self, filename: str) -> Optional[str]:
+        return self.cacher.content_path(filename)
+
+    async def acontent_path(self, filename: str) -> Optional[str]:
+        return await self._run(self.cacher.content_path, filename)
+
+    def stats(self):
+        return self.cacher.stats()
+
+    async def acommit(self, filename: str, tmppath: str):
+        await self._run(self.cacher.commit, filename, tmppath)
+        self._mark_dirty(filename)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        self._pool.shutdown()
+        self.cacher.close()
+
+
+def migrate(src: str, dst: str, backend: str = 'sharded', move: bool = False):
+    '''
+    キャッシュディレクトリを別の形式に変換する
+    '''
+    source = open_storage(src)
+    dest = Cacher(dst, backend).storage
+    n = 0
+    for key, has_content, info in source.entries():
+        if has_content:
+            if move:
+                dest.commit(key, source.path(key))
+            else:
+                tmppath = dest.path(key)+'~'
+                shutil.copyfile(source.path(key), tmppath)
+                dest.commit(key, tmppath)
+        if info is UNKNOWN:
+            info = source.read_info(key)
+        if info is not None:
+            dest.write_info(key, info)
+            if move and isinstance(source, FlatStorage):
+                os.remove(source.path(key)+'.json')
+        n += 1
+        if n % 10000 == 0:
+            print('migrated', n)
+    print('migrated', n)
+    source.close()
+    dest.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('cacher')
+    parser.add_argument('src', type=str, help='source cache directory')
+    parser.add_argument('dst', type=str, help='destination cache directory (may be the same as src with --move)')
+    parser.add_argument('--backend', '-b', choices=list(STORAGES.keys()), default='sharded')
+    parser.add_argument('--move', action='store_true', help='move files instead of copying')
+    args = parser.parse_args()
+
+    migrate(args.src, args.dst, args.backend, args.move)
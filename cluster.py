@@ -0,0 +1,324 @@
+'''
+N個のワーカープロセスでクロールする
+各ワーカーは自分のイベントループとCollectorを持ち、作業 (add_job) はshard_keyのハッシュで担当のワーカーに振り分ける
+親プロセスのCoordinatorがUnixソケットで作業を中継し、ホストごとの待ち時間 (Waiter) を全体で守る
+全ワーカーが暇になり、振り分けた作業がすべて受け取られたら終わる
+'''
+from typing import Callable, Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import time
+from metrics import NULL
+from waiter import Waiter
+
+
+def shard_path(path: str, index: Optional[int]) -> str:
+    '''
+    ワーカーごとのファイル frontier.sqlite3 -> frontier-0.sqlite3
+    '''
+    if index is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}-{index}{ext}'
+
+
+def shard_of(key: str, workers: int) -> int:
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % workers
+
+
+async def _send(writer: asyncio.StreamWriter, message: dict):
+    writer.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+
+
+class Coordinator():
+    '''
+    ワーカーからのメッセージ (1行1つのJSON)
+      hello {index}                       接続したワーカー番号
+      wait {id, url}                      待ってから {op: ok, id} を返す
+      feedback {url, status, latency, retry_after}
+      job {shard, tag, method, args}      担当のワーカーに送る
+      idle {received}                     手元の作業がなくなった (受け取った作業の数)
+      bye {received}                      終了する
+    '''
+
+    def __init__(self, path: str, workers: int, waiter: Waiter) -> None:
+        self.path = path
+        self.workers = workers
+        self.waiter = waiter
+        self._writers: Dict[int, asyncio.StreamWriter] = {}
+        # 接続前のワーカーへの作業
+        self._queued: Dict[int, List[dict]] = {i: [] for i in range(workers)}
+        self._routed = [0] * workers
+        self._received = [0] * workers
+        self._idle = [False] * workers
+        self._gone = [False] * workers
+        self._done: Optional[asyncio.Event] = None
+        self._closed: Optional[asyncio.Event] = None
+        self.waits = 0
+
+    async def serve(self, timeout: float = 60):
+        '''
+        timeout: 終了を伝えてからワーカーの切断を待つ秒数
+        '''
+        self._done = asyncio.Event()
+        self._closed = asyncio.Event()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self._handle, self.path)
+        try:
+            await self._done.wait()
+            for writer in self._writers.values():
+                await _send(writer, {'op': 'stop'})
+            if self._writers:
+                await asyncio.wait_for(self._closed.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f'cluster: workers {sorted(self._writers)} did not exit')
+        finally:
+            server.close()
+            os.remove(self.path)
+
+    def _check_done(self):
+        if all(self._gone[i] or (self._idle[i] and self._received[i] == self._routed[i]) for i in range(self.workers)):
+            self._done.set()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        index = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message['op']
+                if op == 'wait':
+                    asyncio.ensure_future(self._wait(writer, message))
+                elif op == 'feedback':
+                    self.waiter.feedback(message['url'], message['status'], message['latency'], message['retry_after'])
+                elif op == 'job':
+                    self._route(message)
+                elif op == 'idle':
+                    self._idle[index] = True
+                    self._received[index] = message['received']
+                    self._check_done()
+                elif op == 'bye':
+                    self._received[index] = message['received']
+                elif op == 'hello':
+                    index = message['index']
+                    self._writers[index] = writer
+                    for job in self._queued.pop(index, []):
+                        await _send(writer, job)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if index is not None:
+                # 落ちたワーカーの作業は失われる
+                lost = self._routed[index] - self._received[index]
+                if lost > 0 and not self._done.is_set():
+                    print(f'cluster: worker {index} exited with {lost} jobs not received')
+                self._gone[index] = True
+                self._writers.pop(index, None)
+                self._check_done()
+                if not self._writers:
+                    self._closed.set()
+            writer.close()
+
+    def _route(self, message: dict):
+        shard = message['shard']
+        self._routed[shard] += 1
+        self._idle[shard] = False
+        if self._gone[shard]:
+            print(f'cluster: worker {shard} has exited, dropped {message["method"]}')
+            self._received[shard] += 1
+            return
+        job = dict(message, op='job')
+        if shard in self._writers:
+            self._writers[shard].write(json.dumps(job, ensure_ascii=False).encode('utf-8') + b'\n')
+        else:
+            self._queued[shard].append(job)
+
+    async def _wait(self, writer: asyncio.StreamWriter, message: dict):
+        self.waits += 1
+        await self.waiter.wait(message['url'])
+        if not writer.is_closing():
+            await _send(writer, {'op': 'ok', 'id': message['id']})
+
+
+class ClusterClient():
+    '''
+    ワーカー側の接続 Collector.clusterに入れる
+    '''
+
+    def __init__(self, path: str, index: int, workers: int) -> None:
+        self.path = path
+        self.index = index
+        self.workers = workers
+        self.collector = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._calls: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._wake: Optional[asyncio.Event] = None
+        self._stopped = False
+        self.sent = 0
+        self.received = 0
+
+    def owner(self, key: Optional[str]) -> int:
+        '''
+        keyがNoneなら自分で処理する
+        '''
+        return self.index if key is None else shard_of(key, self.workers)
+
+    async def start(self, timeout: float = 30):
+        self._wake = asyncio.Event()
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # Coordinatorの起動を待つ
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+        await _send(self._writer, {'op': 'hello', 'index': self.index})
+        self._listener = asyncio.ensure_future(self._listen())
+
+    async def _listen(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                break
+            message = json.loads(line)
+            op = message['op']
+            if op == 'ok':
+                future = self._calls.pop(message['id'], None)
+                if future is not None and not future.done():
+                    future.set_result(None)
+            elif op == 'job':
+                asyncio.ensure_future(self._receive(message))
+            elif op == 'stop':
+                break
+        # 切断か終了の指示
+        self._stopped = True
+        self._wake.set()
+        for future in self._calls.values():
+            if not future.done():
+                future.set_result(None)
+
+    async def _receive(self, message: dict):
+        await self.collector._add_job(message['tag'], message['method'], message['args'])
+        # スケジュールしてから数える (数えた時点で暇でなくなっている)
+        self.received += 1
+        self._wake.set()
+
+    async def call_wait(self, url: str):
+        if self._writer is None or self._stopped:
+            return
+        self._next_id += 1
+        future = asyncio.get_event_loop().create_future()
+        self._calls[self._next_id] = future
+        await _send(self._writer, {'op': 'wait', 'id': self._next_id, 'url': url})
+        await future
+
+    def feedback(self, url: str, status: Optional[int], latency: float, retry_after: Optional[str]):
+        if self._writer is None or self._stopped:
+            return
+        self._writer.write(json.dumps({'op': 'feedback', 'url': url, 'status': status, 'latency': latency,
+                                       'retry_after': retry_after}).encode('utf-8') + b'\n')
+
+    async def send_job(self, shard: int, tag: str, method: str, args):
+        self.sent += 1
+        await _send(self._writer, {'op': 'job', 'shard': shard, 'tag': tag, 'method': method, 'args': list(args)})
+        await self._writer.drain()
+
+    async def join(self, scheduler):
+        '''
+        全体の作業が終わるまで待つ
+        '''
+        while not self._stopped:
+            self._wake.clear()
+            await scheduler.join()
+            await _send(self._writer, {'op': 'idle', 'received': self.received})
+            await self._wake.wait()
+        await scheduler.join()
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        if self._writer is not None:
+            # 受け取った作業はfrontierにあるので再開できる
+            await _send(self._writer, {'op': 'bye', 'received': self.received})
+            self._writer.close()
+
+
+class SharedWaiter():
+    '''
+    Coordinatorで待つWaiter 全ワーカーでホストごとの間隔を守る
+    '''
+
+    def __init__(self, client: ClusterClient) -> None:
+        self.client = client
+        self.instrument(NULL)
+
+    def instrument(self, registry):
+        self._m_sleep = registry.histogram('crawler_waiter_sleep_seconds', 'time spent waiting for a send slot', ('host',))
+
+    async def wait(self, url: str):
+        start = time.monotonic()
+        await self.client.call_wait(url)
+        self._m_sleep.observe(time.monotonic() - start, url.split('/')[2] if '//' in url else '')
+
+    def feedback(self, url: str, status: Optional[int], latency: float, retry_after: str = None):
+        self.client.feedback(url, status, latency, retry_after)
+
+
+def _worker(make: Callable, root: Callable, index: int, workers: int, path: str, finish: Optional[Callable], run_kwargs: dict):
+    client = ClusterClient(path, index, workers)
+    collector = make(index, SharedWaiter(client))
+    collector.cluster = client
+    client.collector = collector
+    # 最初の作業は0番だけが行う
+    coro = root(collector) if index == 0 else asyncio.sleep(0)
+    asyncio.run(collector.run(coro, **run_kwargs))
+    if finish is not None:
+        finish(collector)
+
+
+def run_cluster(make: Callable, root: Callable, workers: int, waiter: Waiter, path: str,
+                finish: Callable = None, **run_kwargs):
+    '''
+    make(index, waiter) -> Collector: ワーカーごとのCollectorを作る (frontierなどはshard_pathで分ける)
+    root(collector) -> coroutine: 0番のワーカーで最初に実行する
+    path: Unixソケットのパス
+    finish(collector): 各ワーカーの終了後に呼ぶ (統計の表示など)
+    run_kwargs: Collector.runの引数 metrics_portはワーカーごとにずらす
+    '''
+    # Collectorは送れないのでforkで引き継ぐ
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for index in range(workers):
+        kwargs = dict(run_kwargs)
+        if kwargs.get('metrics_port') is not None:
+            kwargs['metrics_port'] += index
+        process = context.Process(target=_worker, args=(make, root, index, workers, path, finish, kwargs), name=f'crawler-{index}')
+        process.start()
+        processes.append(process)
+
+    coordinator = Coordinator(path, workers, waiter)
+
+    async def serve():
+        # Ctrl-Cはワーカーがそれぞれ受けて終了するので、ここでは切断を待つ
+        asyncio.get_event_loop().add_signal_handler(signal.SIGINT, lambda: None)
+        await coordinator.serve()
+
+    try:
+        asyncio.run(serve())
+    finally:
+        for process in processes:
+            process.join()
+    return coordinator
@@ -1,77 +1,418 @@
 from asyncio.futures import Future
 import collections
-from concurrent.futures import ProcessPoolExecutor
-from typing import Deque, Dict
+import functools
+from typing import Deque, Dict, List, Optional
 import asyncio
-import os
+import signal
+import time
+import aiohttp
 import traceback
+import urllib.parse
+import metrics
+from session import SessionManager
+from scheduler import Scheduler
+from singleflight import SingleFlight, request_key
+from sink import RecordSink
+from blobstore import BlobStore
+from executor import ParseDispatcher
+from frontier import DONE, INFLIGHT, Frontier
+from page import Page
+from seen import SeenSet
+from cacher import AsyncCacher, CachePolicy, VALIDATOR_HEADERS
+from reporter import ERROR, INFO, NETWORK, WARN, Reporter
+from waiter import BACKOFF_STATUS, Waiter
 
 
 class Collector():
-    def __init__(self) -> None:
-        self._futures = set()
-        self._pool = ProcessPoolExecutor(os.cpu_count())
-        self._queues: Dict[str, asyncio.Queue] = {}
+    def __init__(self, session: SessionManager = None) -> None:
+        # 全リクエストで共有するセッション
+        self.session = session or SessionManager()
+        # サブクラスで設定する
+        self.cacher: Optional[AsyncCacher] = None
+        self.reporter: Optional[Reporter] = None
+        self.waiter: Optional[Waiter] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.useragent = ''
+        self.cache_policy = CachePolicy()
+        # 中断・再開のための記録 なければ記録しない
+        self.frontier: Optional[Frontier] = None
+        # 追加済みの作業 重複はスケジュールする前に落とす なければfrontierだけで判定
+        self.seen: Optional[SeenSet] = None
+        # 終了時に閉じるRecordSink
+        self.sinks: List[RecordSink] = []
+        # ダウンロードしたファイルの内容での重複除去 なければ使わない
+        self.blobs: Optional[BlobStore] = None
+        # タグごとの同時実行数・優先度は self.scheduler.configure で設定
+        self.scheduler = Scheduler()
+        # 同じURLへの同時のリクエストをまとめる
+        self.flights = SingleFlight()
+        # 解析関数の実行場所 (inline/thread/process) を選ぶ
+        self.parser = ParseDispatcher()
+        # 複数プロセスで動かすときの接続 (cluster.run_cluster で設定する)
+        self.cluster = None
+        self.instrument(metrics.NULL)
+
+    def instrument(self, registry):
+        '''
+        計測値をregistryに集める Collectorと、その時点で持っているcacher, waiter, downloader, parser
+        '''
+        self.metrics = registry
+        self._m_requests = registry.counter('crawler_requests_total', 'http requests of pages', ('host', 'status'))
+        self._m_latency = registry.histogram('crawler_request_seconds', 'time until response headers', ('host',))
+        self._m_bytes = registry.counter('crawler_response_bytes_total', 'received bytes of pages', ('host',))
+        self._m_cache = registry.counter('crawler_cache_total', 'pages served from cache (hit), fetched (miss) or revalidated', ('result',))
+        self._m_tasks = registry.counter('crawler_tasks_total', 'added tasks', ('tag',))
+        registry.gauge('crawler_tasks_running', 'running tasks', ('tag',),
+                       lambda: {(tag, ): s['running'] for tag, s in self.scheduler.stats().items()})
+        registry.gauge('crawler_tasks_pending', 'tasks waiting for a slot', ('tag',),
+                       lambda: {(tag, ): s['pending'] + s['waiting'] for tag, s in self.scheduler.stats().items()})
+        for part in (self.cacher, self.waiter, getattr(self, 'downloader', None), self.parser):
+            if part is not None:
+                part.instrument(registry)
 
     async def add_future(self, tag, coro):
-        if tag not in self._queues:
-            self._queues[tag] = asyncio.Queue(20)
+        self._m_tasks.inc(tag)
+        await self.scheduler.submit(tag, coro)
 
-        async def a():
-            try:
-                await coro
-            except Exception as e:
-                print('add_future', e, traceback.format_exc())
-            self._queues[tag].get_nowait()
-        await self._queues[tag].put(None)
-        self._futures.add(asyncio.ensure_future(a()))
+    async def fetch(self, url: str, filename: str, method='get', data=None, headers: dict = None,
+                    encoding: str = None, retries: int = 3):
+        '''
+        キャッシュが有効ならそれを使い、なければ取得してキャッシュする
+        本文はデコードせずに取得したままのバイト列 (Page) で返し、そのままキャッシュする
+        encodingがなければレスポンスのcharset (使えなければaiohttpの判定、なければUTF-8) をPage.encodingとinfoに入れる
+        429/503はretries回まで取り直す
+        同じリクエストが実行中ならその結果を共有する
+        return: (本文 (Page), 情報)
+        '''
+        return await self.flights.do(request_key(method, url, data), self._fetch,
+                                     url, filename, method, data, headers, encoding, retries)
+
+    async def _fetch(self, url: str, filename: str, method, data, headers: Optional[dict],
+                     encoding: Optional[str], retries: int):
+        content, info = await self.cacher.aget(filename, binary=True)
+        if content is not None:
+            content = Page(content, (info or {}).get('encoding'))
+            content.cached = True
+        if content is not None and self.cache_policy.is_fresh(url, info):
+            self.reporter.report(INFO, f'use cache {url}')
+            self._m_cache.inc('hit')
+            return content, info
+        host = urllib.parse.urlsplit(url).hostname
+
+        req_headers = {'user-agent': self.useragent}
+        req_headers.update(headers or {})
+        revalidate = content is not None and method == 'get' and self.cache_policy.revalidate
+        if revalidate:
+            req_headers.update(self.cache_policy.conditional_headers(info))
+
+        for attempt in range(retries + 1):
+            await self.waiter.wait(url)
+            async with self.semaphore:
+                self.reporter.report(INFO, f'fetching {url}', type=NETWORK)
+                start = time.monotonic()
+                try:
+                    async with self.session.request(method, url, headers=req_headers, data=data) as res:
+                        latency = time.monotonic() - start
+                        self.waiter.feedback(url, res.status, latency, res.headers.get('retry-after'))
+                        self._m_requests.inc(host, res.status)
+                        self._m_latency.observe(latency, host)
+                        if res.status in BACKOFF_STATUS and attempt < retries:
+                            # Waiterが待ち時間を伸ばすので取り直す
+                            self.reporter.report(WARN, f'{res.status} {url}', type=NETWORK)
+                            continue
+
+                        if revalidate and res.status == 304:
+                            # 変更なし 本文はキャッシュを使う
+                            self.reporter.report(INFO, f'not modified {url}', type=NETWORK)
+                            info = dict(info or {}, fetched=time.time())
+                            await self.cacher.aset_info(filename, info)
+                            self._m_cache.inc('revalidated')
+                            return content, info
+
+                        body = await res.read()
+                        self._m_bytes.inc(host, value=len(body))
+                        self._m_cache.inc('miss')
+                        # 宣言されたcharsetが使えなければaiohttpが判定する (以前のres.text()と同じ)
+                        content = Page(body, encoding or res.get_encoding())
+                        info = {'status': res.status, 'realurl': self.session.original_url(url, str(res.url)),
+                                'fetched': time.time(), 'encoding': content.encoding}
+                        for header in VALIDATOR_HEADERS:
+                            if header in res.headers:
+                                info[header] = res.headers[header]
+                        if res.status not in BACKOFF_STATUS:
+                            await self.cacher.aset(filename, content, info)
+                            content.cached = True
+                        return content, info
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    self.waiter.feedback(url, None, time.monotonic() - start)
+                    self._m_requests.inc(host, 'error')
+                    raise
 
     async def run_in_executor(self, fn, *args):
         loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(self._pool, fn, *args)
+        return await loop.run_in_executor(self.parser.process_pool, fn, *args)
+
+    async def parse(self, fn, html: str, *args, filename: str = None):
+        '''
+        fn(html, *args)をページの大きさと実測のコストに応じてinline/スレッド/別プロセスで実行する
+        別プロセスのとき、htmlがキャッシュに書いた (読んだ) ページならワーカーがfilenameのファイルから読む
+        '''
+        locate = None
+        if filename and self.cacher is not None and getattr(html, 'cached', False):
+            # パスは別プロセスに送るときだけスレッドで探す
+            locate = functools.partial(self.cacher.acontent_path, filename)
+        return await self.parser.run(fn, html, *args, locate=locate)
 
-    async def run(self, coro):
-        await self.add_future('run', coro)
-        await asyncio.wait(self._futures)
-        # await self.purge_finished_futures()
+    async def add_job(self, tag, method: str, *args):
+        '''
+        中断しても再開できる作業としてタスクを追加する
+        method: selfのメソッド名 args: JSONにできる引数
+        複数プロセスのときはshard_keyで決まる担当のワーカーに送る
+        '''
+        if self.cluster is not None:
+            shard = self.cluster.owner(self.shard_key(method, args))
+            if shard != self.cluster.index:
+                return await self.cluster.send_job(shard, tag, method, args)
+        await self._add_job(tag, method, args)
 
-    async def purge_finished_futures(self):
+    def shard_key(self, method: str, args) -> Optional[str]:
+        '''
+        作業を振り分けるキー 同じキーの作業は同じワーカーで行う Noneなら追加したワーカーで行う
+        既定は最初の引数 (たいていURL)
+        '''
+        return str(args[0]) if args else method
+
+    async def _add_job(self, tag, method: str, args):
+        key = Frontier.make_key(method, args)
+        if self.seen is not None and not self.seen.add(key):
+            return
+        if self.frontier is None:
+            return await self.add_future(tag, getattr(self, method)(*args))
+
+        # 記録があるものは終わっているか、すでにスケジュールされている
+        if self.seen is None and self.frontier.get(key) is not None:
+            return
+        self.frontier.add(key, tag, method, args)
+        await self.add_future(tag, self._run_job(key, method, args))
+
+    async def _run_job(self, key: str, method: str, args):
+        self.frontier.mark(key, INFLIGHT)
+        await getattr(self, method)(*args)
+        self.frontier.mark(key, DONE)
+
+    async def checkpointed(self, method: str, *args):
+        '''
+        結果を記録しておき、再開時は記録した結果を返す (再取得・再解析しない)
+        '''
+        if self.frontier is None:
+            return await getattr(self, method)(*args)
+
+        key = Frontier.make_key(method, args)
+        entry = self.frontier.get(key)
+        if entry is not None and entry[0] == DONE:
+            return entry[1]
+        self.frontier.add(key, None, method, args)
+        self.frontier.mark(key, INFLIGHT)
+        result = await getattr(self, method)(*args)
+        self.frontier.mark(key, DONE, result)
+        return result
+
+    async def _resume(self):
+        for key, tag, method, args in self.frontier.unfinished():
+            if self.seen is not None:
+                self.seen.add(key)
+            await self.add_future(tag, self._run_job(key, method, args))
+
+    def _checkpoint(self):
+        # seenにあってfrontierにない作業は再開時に失われるのでfrontierを先に書く
+        self.frontier.checkpoint()
+        if self.seen is not None:
+            self.seen.checkpoint()
+
+    async def _checkpointer(self, interval: float):
         while True:
-            if len(self._futures) == 0:
+            await asyncio.sleep(interval)
+            self._checkpoint()
+
+    async def run(self, coro, resume: bool = False, checkpoint_interval: float = 10,
+                  metrics_port: int = None, progress: float = None):
+        '''
+        resume: 前回の続きから (frontierが必要)
+        metrics_port: 計測値をPrometheusのテキスト形式で公開するポート (instrumentが必要)
+        progress: この秒数ごとに進み具合を1行で表示する (instrumentが必要)
+        '''
+        interrupted = False
+
+        def on_sigint():
+            nonlocal interrupted
+            # 解析プロセスに届いたものも同じループに伝わるので1回だけ
+            if interrupted:
                 return
+            interrupted = True
+            main.cancel()
+
+        main = asyncio.current_task()
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGINT, on_sigint)
+        checkpointer = None
+        metrics_server = None
+        progress_task = None
+        try:
+            if metrics_port is not None and self.metrics is not metrics.NULL:
+                metrics_server = await metrics.serve(self.metrics, port=metrics_port)
+            if progress and self.metrics is not metrics.NULL:
+                progress_task = asyncio.ensure_future(metrics.Progress(self.metrics, self.reporter, progress).run())
+            if self.seen is not None and not resume:
+                self.seen.reset()
+            if self.frontier is not None:
+                if resume:
+                    await self.add_future('run', self._resume())
+                else:
+                    self.frontier.reset()
+                checkpointer = asyncio.ensure_future(self._checkpointer(checkpoint_interval))
+            # リセットしてから他のワーカーの作業を受け取る
+            if self.cluster is not None:
+                await self.cluster.start()
+            await self.add_future('run', coro)
+            if self.cluster is not None:
+                await self.cluster.join(self.scheduler)
             else:
-                self._futures = {e for e in self._futures if not e.done()}
-            await asyncio.sleep(0.01)
+                await self.scheduler.join()
+        except asyncio.CancelledError:
+            await self.scheduler.cancel()
+            if not interrupted:
+                raise
+            self.reporter.report(WARN, 'sigint')
+        finally:
+            loop.remove_signal_handler(signal.SIGINT)
+            if checkpointer:
+                checkpointer.cancel()
+            if progress_task:
+                progress_task.cancel()
+            if metrics_server:
+                metrics_server.close()
+            if self.cluster is not None:
+                await self.cluster.close()
+            if self.frontier is not None:
+                self.frontier.close()
+            if self.seen is not None:
+                self.seen.close()
+            await self.session.close()
+            self.parser.close()
+            for sink in self.sinks:
+                sink.close()
+            if self.blobs is not None:
+                self.blobs.close()
+            if self.cacher:
+                await self.cacher.close()
+            self.reporter.flush()
 
     async def queued_paging(self, pagestart, pageend, mkcorofn,
                             queue_size=2):
 
-        pages = []
+        pages: Dict[int, asyncio.Task] = {}
         q = UnboundQueue(queue_size)
 
-        for page_num in range(pagestart, pageend+1):
-            async def worker(p):
+        def end(p):
+            q.end()
+            # 最後のページより先を取りに行っているものはすぐ止める
+            for page_num, page in pages.items():
+                if page_num > p:
+                    page.cancel()
+
+        async def worker(p):
+            try:
+                r = await mkcorofn(p)
+                q.decrement()
+                if r == False:
+                    end(p)
+            except Exception as e:
+                self.reporter.report(ERROR, f'queued_paging {traceback.format_exc()}')
+                end(p)
+
+        async def spawn():
+            for page_num in range(pagestart, pageend+1):
+                if await q.increment() == False:
+                    break
+                pages[page_num] = asyncio.create_task(worker(page_num))
+
+        await self._gather_pages(pages, spawn())
+
+    async def _gather_pages(self, pages: Dict[int, asyncio.Task], spawner=None):
+        try:
+            if spawner is not None:
+                await spawner
+            await asyncio.gather(*pages.values(), return_exceptions=True)
+        except asyncio.CancelledError:
+            # 中断されたらページのタスクも終わるまで待つ
+            for page in pages.values():
+                page.cancel()
+            await asyncio.gather(*pages.values(), return_exceptions=True)
+            raise
+
+    async def probe_last_page(self, pagestart, pageend, existsfn) -> int:
+        '''
+        existsfn(page) -> bool でページの有無を調べ、最後のページを指数探索と二分探索で求める
+        pagestartもなければpagestart-1
+        '''
+        if not await existsfn(pagestart):
+            return pagestart - 1
+
+        last, missing = pagestart, None
+        step = 1
+        while missing is None:
+            page = min(pagestart + step, pageend)
+            if page == last:
+                return last
+            if await existsfn(page):
+                last = page
+                step *= 2
+            else:
+                missing = page
+
+        while missing - last > 1:
+            page = (last + missing) // 2
+            if await existsfn(page):
+                last = page
+            else:
+                missing = page
+        return last
+
+    async def probed_paging(self, pagestart, pageend, mkcorofn, existsfn, concurrency=8):
+        '''
+        最後のページを先に調べてから範囲内のページを並列に取得する
+        mkcorofnがFalseを返したらそれより先のページは止める
+        '''
+        last = await self.probe_last_page(pagestart, pageend, existsfn)
+
+        pages: Dict[int, asyncio.Task] = {}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        def end(p):
+            for page_num, page in pages.items():
+                if page_num > p:
+                    page.cancel()
+
+        async def worker(p):
+            async with semaphore:
                 try:
                     r = await mkcorofn(p)
-                    q.decrement()
                     if r == False:
-                        q.end()
+                        end(p)
                 except Exception as e:
-                    print('queued_paging', traceback.format_exc())
-                    q.end()
-
-            if await q.increment() == False:
-                break
-            pages.append(asyncio.create_task(worker(page_num)))
+                    self.reporter.report(ERROR, f'probed_paging {traceback.format_exc()}')
+                    end(p)
 
-        await asyncio.gather(*pages)
+        for page_num in range(pagestart, last+1):
+            pages[page_num] = asyncio.create_task(worker(page_num))
+        await self._gather_pages(pages)
 
     async def async_retry(self, n: int, fn, *args, **kwargs):
         for _ in range(n):
             try:
                 return (await fn(*args), False)
             except Exception as e:
-                print(e)
+                self.reporter.report(WARN, f'async_retry {e}')
         return None, True
 
 
@@ -1,35 +1,281 @@
 from asyncio.locks import Semaphore
-from wsgiref import headers
-from reporter import ERROR, INFO, NETWORK, Reporter
-import aiofiles
-import shutil
-from waiter import Waiter
+from collections import defaultdict
+from typing import Dict, Optional
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import urllib.parse
 import aiohttp
+from reporter import ERROR, INFO, NETWORK, WARN, Reporter
+import aiofiles
+from blobstore import BlobStore
+from cacher import AsyncCacher
+from waiter import BACKOFF_STATUS, Waiter
+from session import SessionManager
+from singleflight import SingleFlight, request_key
+from metrics import NULL
+
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 1024 * 1024
+# bytes 開始-終了/全体
+RE_CONTENT_RANGE = re.compile(r'^bytes (\d+)-\d+/(\d+|\*)$')
+
+
+class DownloadError(Exception):
+    pass
+
+
+def expected_digests(headers) -> Dict[str, str]:
+    '''
+    レスポンスヘッダにある本文のハッシュ {アルゴリズム: hex}
+    Content-MD5, Digest, Repr-Digest
+    '''
+    digests = {}
+    if 'content-md5' in headers:
+        digests['md5'] = base64.b64decode(headers['content-md5']).hex()
+    for name in ('digest', 'repr-digest'):
+        for item in headers.get(name, '').split(','):
+            algo, _, value = item.strip().partition('=')
+            algo = algo.lower().replace('-', '')
+            if algo in ('md5', 'sha256', 'sha512') and value:
+                digests[algo] = base64.b64decode(value.strip(':')).hex()
+    return digests
 
 
 class Downloader():
-    def __init__(self, waiter: Waiter, semaphore: Semaphore, reporter: Reporter) -> None:
+    '''
+    途中まで書いた一時ファイルはRangeで続きから取得する
+    長さとハッシュを確かめ、失敗したらWaiterの間隔を守って待ってから取り直す
+    '''
+
+    def __init__(self, waiter: Waiter, semaphore: Semaphore, reporter: Reporter, session: SessionManager,
+                 cacher: AsyncCacher, retries: int = 3, backoff: float = 1.0, max_backoff: float = 60,
+                 blobs: BlobStore = None, flights: SingleFlight = None) -> None:
         self.waiter = waiter
         self.semaphore = semaphore
         self.reporter = reporter
+        self.session = session
+        self.cacher = cacher
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # 内容が同じファイルを共有する なければ使わない
+        self.blobs = blobs
+        # 同じファイルの同時のダウンロードをまとめる
+        self.flights = flights or SingleFlight()
+        # ホストごとの転送量
+        self._hosts: Dict[str, dict] = defaultdict(lambda: {
+            'files': 0, 'bytes': 0, 'seconds': 0.0, 'resumed': 0, 'retries': 0, 'errors': 0})
+        self.instrument(NULL)
 
-    async def download_file(self, url: str, path: str, headers={}):
+    def instrument(self, registry):
+        self._m_files = registry.counter('crawler_download_files_total', 'downloaded files', ('host',))
+        self._m_bytes = registry.counter('crawler_download_bytes_total', 'downloaded bytes', ('host',))
+        self._m_seconds = registry.histogram('crawler_download_seconds', 'time of a download attempt', ('host',))
+        self._m_retries = registry.counter('crawler_download_retries_total', 'download retries', ('host',))
+        self._m_errors = registry.counter('crawler_download_errors_total', 'downloads given up', ('host',))
+
+    @staticmethod
+    def _meta_path(temppath: str) -> str:
+        # 一時ファイルのETag/Last-Modified (キャッシュの列挙からは除かれる)
+        return temppath + '~'
+
+    def _load_meta(self, temppath: str) -> dict:
         try:
+            with open(self._meta_path(temppath), 'rt') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_meta(self, temppath: str, headers):
+        meta = {k: headers[k] for k in ('etag', 'last-modified') if k in headers}
+        with open(self._meta_path(temppath), 'wt') as f:
+            json.dump(meta, f)
+
+    def _discard(self, temppath: str):
+        for path in (temppath, self._meta_path(temppath)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    async def _in_thread(fn, *args):
+        # BlobStoreのファイル操作とSQLiteはイベントループの外で行う
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def _link_blob(self, digest: str, filename: str, url: str, etag: str = None) -> dict:
+        temppath = self.cacher.tmp_path(filename)
+        await self._in_thread(self.blobs.link, digest, temppath, url, etag)
+        size = os.path.getsize(temppath)
+        await self.cacher.acommit(filename, temppath)
+        self._discard(temppath)
+        return {'bytes': size, 'sha256': digest}
+
+    async def download_file(self, url: str, filename: str, headers={}) -> Optional[dict]:
+        '''
+        return: {'bytes': 大きさ, 'sha256': ハッシュ} 失敗したらNone
+        '''
+        # 保存先が違えば別のダウンロード
+        return await self.flights.do(f'{request_key("GET", url)} {filename}', self._download_file, url, filename, headers)
+
+    async def _download_file(self, url: str, filename: str, headers: dict) -> Optional[dict]:
+        if self.blobs is not None:
+            # 前に取得したURL
+            digest = await self._in_thread(self.blobs.lookup_url, url)
+            if digest is not None:
+                self.reporter.report(INFO, f'known blob {url}', type=NETWORK)
+                return await self._link_blob(digest, filename, url)
+
+        host = urllib.parse.urlparse(url).hostname
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self._hosts[host]['retries'] += 1
+                self._m_retries.inc(host)
+                delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
             await self.waiter.wait(url)
-            async with self.semaphore:
-                async with aiohttp.request('GET', url, headers=headers) as res:
-                    if res.status == 200:
-                        self.reporter.report(INFO, f'downloading {url} -> {path}', type=NETWORK)
-
-                        temppath = path + '~'
-                        async with aiofiles.open(temppath, 'wb') as fd:
-                            while True:
-                                chunk = await res.content.read(1024)
-                                if not chunk:
-                                    break
-                                await fd.write(chunk)
-                        shutil.move(temppath, path)
-                    else:
-                        self.reporter.report(ERROR, f'download_img: {res.status} {url}', type=NETWORK)
-        except Exception as e:
-            self.reporter.report(ERROR, f'download_img: {url} {e}', type=NETWORK)
+            fed = False
+
+            def feedback(status, retry_after=None):
+                # 1回の試行につき1回だけ伝える
+                nonlocal fed
+                fed = True
+                self.waiter.feedback(url, status, time.monotonic() - start, retry_after)
+            try:
+                async with self.semaphore:
+                    # 空きを待った時間はレイテンシに含めない
+                    start = time.monotonic()
+                    result = await self._download(url, filename, headers, host, start, feedback)
+                self._m_seconds.observe(time.monotonic() - start, host)
+                if result is not None:
+                    return result
+                # 再試行しないエラー
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError) as e:
+                if not fed:
+                    feedback(None)
+                self.reporter.report(WARN, f'download_img: {url} {e} (attempt {attempt + 1})', type=NETWORK)
+            except Exception as e:
+                self.reporter.report(ERROR, f'download_img: {url} {e}', type=NETWORK)
+                break
+        self._hosts[host]['errors'] += 1
+        self._m_errors.inc(host)
+        return None
+
+    async def _download(self, url: str, filename: str, headers: dict, host: str, start: float, feedback) -> Optional[dict]:
+        temppath = self.cacher.tmp_path(filename)
+        offset = os.path.getsize(temppath) if os.path.exists(temppath) else 0
+        meta = self._load_meta(temppath) if offset else {}
+        validator = meta.get('etag') or meta.get('last-modified')
+
+        req_headers = dict(headers)
+        if offset and validator:
+            req_headers['range'] = f'bytes={offset}-'
+            req_headers['if-range'] = validator
+
+        async with self.session.request('GET', url, headers=req_headers) as res:
+            feedback(res.status, res.headers.get('retry-after'))
+            if res.status in BACKOFF_STATUS or res.status >= 500:
+                raise DownloadError(f'{res.status}')
+            if res.status == 416:
+                # 範囲外 一時ファイルが壊れているので最初から
+                self._discard(temppath)
+                raise DownloadError('416')
+            if res.status not in (200, 206):
+                self.reporter.report(ERROR, f'download_img: {res.status} {url}', type=NETWORK)
+                return None
+
+            total = None
+            if res.status == 206:
+                m = RE_CONTENT_RANGE.match(res.headers.get('content-range', ''))
+                if m is None or int(m.group(1)) != offset:
+                    # 頼んだ位置からでない 一時ファイルを捨ててRangeなしで取り直す
+                    self._discard(temppath)
+                    raise DownloadError(f'unexpected range {res.headers.get("content-range")} for offset {offset}')
+                if m.group(2) != '*':
+                    total = int(m.group(2))
+                if offset:
+                    self._hosts[host]['resumed'] += 1
+                    self.reporter.report(INFO, f'resuming {url} from {offset}', type=NETWORK)
+            else:
+                # 200は全体
+                offset = 0
+            if total is not None:
+                expected_length = total
+            elif res.content_length is not None and res.headers.get('content-encoding', 'identity') == 'identity':
+                expected_length = offset + res.content_length
+            else:
+                expected_length = None
+            if offset == 0 and self.blobs is not None:
+                # ETagと大きさが同じものを持っていれば本文は読まない
+                digest = await self._in_thread(self.blobs.lookup_etag, res.headers.get('etag'), expected_length)
+                if digest is not None:
+                    self.reporter.report(INFO, f'duplicate of {digest} {url}', type=NETWORK)
+                    return await self._link_blob(digest, filename, url, res.headers.get('etag'))
+            digests = expected_digests(res.headers) if offset == 0 else {}
+            self._save_meta(temppath, res.headers)
+            self.reporter.report(INFO, f'downloading {url} -> {filename}', type=NETWORK)
+
+            hashers = {algo: hashlib.new(algo) for algo in set(digests) | {'sha256'}}
+            if offset:
+                await asyncio.get_event_loop().run_in_executor(None, self._hash_file, temppath, hashers.values())
+
+            received = 0
+            chunk_size = MIN_CHUNK
+            async with aiofiles.open(temppath, 'ab' if offset else 'wb') as fd:
+                while True:
+                    chunk = await res.content.read(chunk_size)
+                    if not chunk:
+                        break
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+                    await fd.write(chunk)
+                    received += len(chunk)
+                    # 読んだ分が埋まっていれば (データが溜まっている) 大きくする
+                    if len(chunk) == chunk_size and chunk_size < MAX_CHUNK:
+                        chunk_size *= 2
+                    elif len(chunk) < chunk_size // 4 and chunk_size > MIN_CHUNK:
+                        chunk_size //= 2
+
+        stats = self._hosts[host]
+        stats['bytes'] += received
+        stats['seconds'] += time.monotonic() - start
+        self._m_bytes.inc(host, value=received)
+
+        size = offset + received
+        if expected_length is not None and size != expected_length:
+            # 途中で切れた 次は続きから
+            raise DownloadError(f'incomplete {size}/{expected_length}')
+        for algo, digest in digests.items():
+            if hashers[algo].hexdigest() != digest:
+                self._discard(temppath)
+                raise DownloadError(f'{algo} mismatch')
+
+        digest = hashers['sha256'].hexdigest()
+        if self.blobs is not None:
+            await self._in_thread(self.blobs.add, temppath, digest, url, self._load_meta(temppath).get('etag'))
+        await self.cacher.acommit(filename, temppath)
+        self._discard(temppath)
+        stats['files'] += 1
+        self._m_files.inc(host)
+        return {'bytes': size, 'sha256': digest}
+
+    @staticmethod
+    def _hash_file(path: str, hashers):
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(MAX_CHUNK)
+                if not chunk:
+                    break
+                for hasher in hashers:
+                    hasher.update(chunk)
+
+    def stats(self) -> Dict[str, dict]:
+        return {
+            host: dict(s, bytes_per_sec=s['bytes'] / s['seconds'] if s['seconds'] else 0.0)
+            for host, s in self._hosts.items()
+        }
@@ -0,0 +1,220 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+import asyncio
+import os
+import time
+from cacher import read_content
+import htmlparse
+from metrics import NULL
+
+
+def _load(page: tuple):
+    kind, value = page
+    return read_content(*value) if kind == 'path' else value
+
+
+def _run_batch(fn: Callable, calls: List[tuple]) -> List[tuple]:
+    '''
+    ワーカー側で実行する
+    calls: [(page, args)] return: [(成功したか, 結果か例外, 解析にかかった秒数)]
+    '''
+    results = []
+    for page, args in calls:
+        start = time.perf_counter()
+        try:
+            results.append((True, fn(_load(page), *args), time.perf_counter() - start))
+        except Exception as e:
+            results.append((False, e, time.perf_counter() - start))
+    return results
+
+
+def _run_timed(fn: Callable, html: str, args: tuple):
+    start = time.perf_counter()
+    result = fn(html, *args)
+    return result, time.perf_counter() - start
+
+
+class PageExecutor():
+    '''
+    ページの解析関数をプロセスプールで実行する
+    キャッシュにあるページはパスだけを送り、ワーカーがファイルから読む (HTMLをpickleしない)
+    batch_size > 1 のときはbatch_delay秒以内の同じ関数の呼び出しをまとめて1回で送る
+    '''
+
+    def __init__(self, pool: Optional[Executor], by_path: bool = True, batch_size: int = 1, batch_delay: float = 0.002) -> None:
+        self.pool = pool
+        self.by_path = by_path
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._pending: Dict[Callable, list] = {}
+        self._timers: Dict[Callable, asyncio.TimerHandle] = {}
+
+        # ワーカーの呼び出し回数と解析したページ数
+        self.calls = 0
+        self.pages = 0
+        self.by_path_pages = 0
+
+    async def run(self, fn: Callable, html: str, *args, path: Optional[str] = None):
+        '''
+        fn(html, *args)を実行する pathがあればhtmlの代わりに送る
+        '''
+        result, _ = await self.run_timed(fn, html, *args, path=path)
+        return result
+
+    async def run_timed(self, fn: Callable, html: str, *args, path: Optional[str] = None):
+        '''
+        return: (結果, ワーカーでの解析の秒数)
+        '''
+        if self.by_path and path is not None:
+            page = ('path', (path, getattr(html, 'encoding', None)))
+            self.by_path_pages += 1
+        else:
+            page = ('html', html)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(fn, [])
+        pending.append((page, args, future))
+        if len(pending) >= self.batch_size:
+            self._send(fn)
+        elif fn not in self._timers:
+            self._timers[fn] = loop.call_later(self.batch_delay, self._send, fn)
+
+        ok, result, elapsed = await future
+        if not ok:
+            raise result
+        return result, elapsed
+
+    def _send(self, fn: Callable):
+        timer = self._timers.pop(fn, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(fn, [])
+        if not batch:
+            return
+        self.calls += 1
+        self.pages += len(batch)
+        calls = [(page, args) for page, args, _ in batch]
+        asyncio.get_event_loop().run_in_executor(self.pool, _run_batch, fn, calls) \
+            .add_done_callback(lambda f: self._resolve(batch, f))
+
+    @staticmethod
+    def _resolve(batch: list, f: asyncio.Future):
+        if f.cancelled() or f.exception() is not None:
+            error = f.exception() if not f.cancelled() else asyncio.CancelledError()
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, _, future), result in zip(batch, f.result()):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {'calls': self.calls, 'pages': self.pages, 'by_path': self.by_path_pages}
+
+
+class ParseDispatcher():
+    '''
+    解析関数をページの大きさと関数ごとの実測コストでどこで実行するか選ぶ
+    inline: 軽いものはイベントループでそのまま (IPCのほうが高くつく)
+    thread: lxmlはパース中にGILを手放すのでスレッドプール
+    process: 重いものやbs4はプロセスプール (キャッシュのパスで渡す)
+    プールは最初に使うときに作る
+    '''
+
+    def __init__(self,
+                 processes: int = None,
+                 threads: int = None,
+                 inline_cost: float = 0.002,
+                 thread_cost: float = 0.05,
+                 inline_bytes: int = 16 * 1024,
+                 alpha: float = 0.2) -> None:
+        '''
+        inline_cost, thread_cost: 見積もりの解析時間(秒)がこれ未満ならinline, thread
+        inline_bytes: コストを測るまではこれ以下のページをinlineで実行する
+        alpha: コストの指数移動平均の重み
+        '''
+        self.processes = processes or os.cpu_count()
+        self.threads = threads or min(4, os.cpu_count())
+        self.inline_cost = inline_cost
+        self.thread_cost = thread_cost
+        self.inline_bytes = inline_bytes
+        self.alpha = alpha
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self.pages = PageExecutor(None)
+        # 関数ごとの1文字あたりの解析時間(秒)
+        self._cost: Dict[Callable, float] = {}
+        self.counts = {'inline': 0, 'thread': 0, 'process': 0}
+        # 解析関数の実行にかかった秒数の合計
+        self.seconds = 0.0
+        self.instrument(NULL)
+
+    def instrument(self, registry):
+        self._m_parse = registry.histogram('crawler_parse_seconds', 'time spent in extractor functions', ('mode',))
+        self._m_queue = registry.histogram('crawler_parse_queue_seconds', 'time parse calls wait for a worker, including IPC', ('mode',))
+
+    @property
+    def process_pool(self) -> ProcessPoolExecutor:
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(self.processes)
+        return self._process_pool
+
+    @property
+    def thread_pool(self) -> ThreadPoolExecutor:
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(self.threads, thread_name_prefix='parser')
+        return self._thread_pool
+
+    def choose(self, fn: Callable, size: int) -> str:
+        cost = self._cost.get(fn)
+        if cost is None:
+            return 'inline' if size <= self.inline_bytes else 'process'
+        expected = cost * size
+        if expected < self.inline_cost:
+            return 'inline'
+        if expected < self.thread_cost and htmlparse.backend() == 'lxml':
+            return 'thread'
+        return 'process'
+
+    def _observe(self, fn: Callable, size: int, elapsed: float):
+        if size <= 0:
+            return
+        cost = elapsed / size
+        if fn in self._cost:
+            cost = self._cost[fn] * (1 - self.alpha) + cost * self.alpha
+        self._cost[fn] = cost
+
+    async def run(self, fn: Callable, html: str, *args, locate: Callable = None):
+        '''
+        locate() -> パス: 別プロセスで実行するときだけ呼び、キャッシュのファイルのパスを得る
+        '''
+        size = len(html) if html else 0
+        mode = self.choose(fn, size)
+        self.counts[mode] += 1
+        start = time.perf_counter()
+        if mode == 'inline':
+            result, elapsed = _run_timed(fn, html, args)
+        elif mode == 'thread':
+            result, elapsed = await asyncio.get_event_loop().run_in_executor(
+                self.thread_pool, _run_timed, fn, html, args)
+        else:
+            self.pages.pool = self.process_pool
+            path = await locate() if locate is not None else None
+            result, elapsed = await self.pages.run_timed(fn, html, *args, path=path)
+        self.seconds += elapsed
+        self._m_parse.observe(elapsed, mode)
+        self._m_queue.observe(max(time.perf_counter() - start - elapsed, 0), mode)
+        self._observe(fn, size, elapsed)
+        return result
+
+    def stats(self):
+        return dict(self.counts, seconds=self.seconds, **self.pages.stats())
+
+    def close(self):
+        for pool in (self._process_pool, self._thread_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._process_pool = None
+        self._thread_pool = None
@@ -0,0 +1,81 @@
+from typing import Iterator, Optional, Tuple
+import hashlib
+import json
+import os
+import sqlite3
+
+PENDING = 0
+INFLIGHT = 1
+DONE = 2
+
+
+class Frontier():
+    '''
+    クロールの作業単位 (メソッド名と引数) と状態をSQLiteに記録する
+    中断したあとは終わっていないものから再開できる
+    書き込みはcheckpointでまとめてコミットする
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            key TEXT PRIMARY KEY,
+            tag TEXT,
+            method TEXT,
+            args TEXT,
+            state INTEGER,
+            result TEXT)''')
+        self._db.commit()
+
+    @staticmethod
+    def make_key(method: str, args: tuple) -> str:
+        return hashlib.sha1(json.dumps([method, args], ensure_ascii=False, sort_keys=True)
+                            .encode('utf-8')).hexdigest()
+
+    def reset(self):
+        self._db.execute('DELETE FROM jobs')
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[Tuple[int, object]]:
+        '''
+        (状態, 結果) 記録がなければNone
+        '''
+        row = self._db.execute('SELECT state, result FROM jobs WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]) if row[1] is not None else None
+
+    def add(self, key: str, tag: Optional[str], method: str, args: tuple):
+        '''
+        tagがNoneのものは再開時に直接はスケジュールしない (ページの結果の記録用)
+        '''
+        self._db.execute('INSERT OR IGNORE INTO jobs (key, tag, method, args, state) VALUES (?, ?, ?, ?, ?)',
+                         (key, tag, method, json.dumps(args, ensure_ascii=False), PENDING))
+
+    def mark(self, key: str, state: int, result=None):
+        self._db.execute('UPDATE jobs SET state=?, result=? WHERE key=?',
+                         (state, json.dumps(result) if result is not None else None, key))
+
+    def unfinished(self) -> Iterator[Tuple[str, str, str, list]]:
+        '''
+        終わっていない作業 (key, tag, method, args)
+        '''
+        rows = self._db.execute('SELECT key, tag, method, args FROM jobs WHERE state!=? AND tag IS NOT NULL',
+                                (DONE,)).fetchall()
+        for key, tag, method, args in rows:
+            yield key, tag, method, json.loads(args)
+
+    def counts(self) -> dict:
+        names = {PENDING: 'pending', INFLIGHT: 'inflight', DONE: 'done'}
+        rows = self._db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return {names[state]: n for state, n in rows}
+
+    def checkpoint(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
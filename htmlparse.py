@@ -0,0 +1,89 @@
+'''
+抽出関数のHTMLパーサの切り替え
+bs4: BeautifulSoup + CSSセレクタ (従来)
+lxml: lxml.html + プリコンパイルしたXPath (速い)
+選択は環境変数で持つのでProcessPoolExecutorのワーカーにも引き継がれる
+bytes (Page) はUTF-8ならそのまま解析し、それ以外はPythonでデコードしてから解析する
+(libxml2のエンコーディングの対応はPythonと違い、euc_jis_2004などは読めない)
+'''
+from lxml import etree
+import bs4
+import lxml.html
+import os
+import threading
+from page import is_utf8, to_text
+
+BACKENDS = ('bs4', 'lxml')
+ENV = 'CRAWLER_PARSER'
+
+
+def set_backend(name: str):
+    if name not in BACKENDS:
+        raise ValueError(f'unknown parser {name}')
+    os.environ[ENV] = name
+
+
+def backend() -> str:
+    return os.environ.get(ENV, 'bs4')
+
+
+def has_class(name: str) -> str:
+    '''
+    CSSの.nameに相当するXPathの条件
+    '''
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+def xpath(expr: str) -> etree.XPath:
+    return etree.XPath(expr)
+
+
+_local = threading.local()
+
+
+def _utf8_parser() -> lxml.html.HTMLParser:
+    # パーサはスレッドごとに使い回す
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = lxml.html.HTMLParser(encoding='utf-8')
+    return parser
+
+
+def _native(html) -> bool:
+    '''
+    デコードせずにバイト列のまま渡せるか
+    '''
+    return isinstance(html, bytes) and is_utf8(getattr(html, 'encoding', 'utf-8'))
+
+
+def parse(html):
+    '''
+    空・空白だけ・コメントだけのページは空の文書を返す (bs4と同じく何も見つからない)
+    '''
+    try:
+        if _native(html):
+            return lxml.html.document_fromstring(html, parser=_utf8_parser())
+        html = to_text(html)
+        try:
+            return lxml.html.document_fromstring(html)
+        except ValueError:
+            # encoding宣言つきのstrはそのままでは読めない
+            return lxml.html.document_fromstring(html.encode('utf-8'),
+                                                 parser=lxml.html.HTMLParser(encoding='utf-8'))
+    except etree.ParserError:
+        return lxml.html.document_fromstring('<html></html>')
+
+
+def soup(html) -> bs4.BeautifulSoup:
+    if _native(html):
+        return bs4.BeautifulSoup(html, 'lxml', from_encoding='utf-8')
+    return bs4.BeautifulSoup(to_text(html), 'lxml')
+
+
+def text(elem) -> str:
+    return elem.text_content().strip()
+
+
+def first(path: etree.XPath, elem):
+    result = path(elem)
+    return result[0] if result else None
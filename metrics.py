@@ -0,0 +1,260 @@
+'''
+クロール中の計測値 (カウンタ・ゲージ・ヒストグラム) をホストやタグのラベルごとに集める
+Prometheusのテキスト形式でHTTPで公開したり、1行の進捗として定期的に表示したりできる
+無効のときはNULLを使う (何もしないので計測箇所のコストはほぼない)
+'''
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import time
+from reporter import PROGRESS, Reporter
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _label_key(item) -> tuple:
+    # ラベルの値はintとstrが混ざる (statusの200と'error'など) ので文字列で並べる
+    return tuple(map(str, item[0]))
+
+
+class Metric():
+    TYPE = ''
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, object] = {}
+
+    def expose(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        for values, value in sorted(self._values.items(), key=_label_key):
+            lines.append(f'{self.name}{_format_labels(self.labels, values)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, *labels, value: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def get(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+
+class Gauge(Metric):
+    '''
+    fnを渡すと公開するときに呼んで値を得る fn() -> {ラベルのtuple: 値}
+    '''
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), fn: Callable = None) -> None:
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def inc(self, *labels, value: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def collect(self) -> Dict[tuple, float]:
+        if self.fn is not None:
+            self._values = dict(self.fn())
+        return self._values
+
+    def total(self) -> float:
+        return sum(self.collect().values())
+
+    def expose(self) -> List[str]:
+        self.collect()
+        return super().expose()
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        # [各バケットの数..., +Inf, 合計]
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def count(self) -> int:
+        return sum(sum(entry[:-1]) for entry in self._values.values())
+
+    def sum(self) -> float:
+        return sum(entry[-1] for entry in self._values.values())
+
+    def expose(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        for values, entry in sorted(self._values.items(), key=_label_key):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), entry[:-1]):
+                cumulative += n
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, values)} {entry[-1]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, values)} {cumulative}')
+        return lines
+
+
+class Registry():
+    '''
+    同じ名前で作ると同じものを返す (複数のコレクタやDownloaderで共有する)
+    '''
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self.started = time.monotonic()
+
+    def _get(self, cls, name: str, *args, **kwargs):
+        if name not in self._metrics:
+            self._metrics[name] = cls(name, *args, **kwargs)
+        return self._metrics[name]
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...] = (), fn: Callable = None) -> Gauge:
+        return self._get(Gauge, name, help, labels, fn)
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def expose(self) -> str:
+        return ''.join(line + '\n' for metric in self._metrics.values() for line in metric.expose())
+
+
+class NullMetric():
+    def inc(self, *labels, value: float = 1):
+        pass
+
+    def set(self, value: float, *labels):
+        pass
+
+    def observe(self, value: float, *labels):
+        pass
+
+
+class NullRegistry():
+    '''
+    計測しないときのRegistry
+    '''
+    _metric = NullMetric()
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> NullMetric:
+        return self._metric
+
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...] = (), fn: Callable = None) -> NullMetric:
+        return self._metric
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: tuple = DEFAULT_BUCKETS) -> NullMetric:
+        return self._metric
+
+    def get(self, name: str) -> None:
+        return None
+
+    def expose(self) -> str:
+        return ''
+
+
+NULL = NullRegistry()
+
+
+async def serve(registry: Registry, host: str = '127.0.0.1', port: int = 9100) -> asyncio.AbstractServer:
+    '''
+    GET /metrics (パスは問わない) にPrometheusのテキスト形式で答える
+    '''
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # リクエスト行とヘッダは読み捨てる
+            while (await reader.readline()).strip():
+                pass
+            body = registry.expose().encode('utf-8')
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+class Progress():
+    '''
+    interval秒ごとに1行で進み具合を表示する
+    '''
+
+    def __init__(self, registry: Registry, reporter: Reporter, interval: float = 10) -> None:
+        self.registry = registry
+        self.reporter = reporter
+        self.interval = interval
+        self._last: Dict[str, float] = {}
+
+    def _total(self, name: str) -> float:
+        metric = self.registry.get(name)
+        if metric is None:
+            return 0
+        if isinstance(metric, Histogram):
+            return metric.count()
+        return metric.total()
+
+    def _sum(self, name: str) -> float:
+        metric = self.registry.get(name)
+        return metric.sum() if metric is not None else 0
+
+    def _rate(self, name: str) -> float:
+        value = self._total(name)
+        rate = (value - self._last.get(name, 0)) / self.interval
+        self._last[name] = value
+        return rate
+
+    def line(self) -> str:
+        elapsed = time.monotonic() - self.registry.started
+        requests = self._total('crawler_requests_total')
+        hits = self.registry.get('crawler_cache_total')
+        hit, miss = (hits.get('hit'), hits.get('miss')) if hits is not None else (0, 0)
+        latency = self.registry.get('crawler_request_seconds')
+        mean = latency.sum() / latency.count() if latency is not None and latency.count() else 0
+        return (f'[{elapsed:.0f}s] req {requests:.0f} ({self._rate("crawler_requests_total"):.1f}/s, '
+                f'{mean * 1000:.0f}ms) '
+                f'recv {self._total("crawler_response_bytes_total") / 2**20:.1f}MB '
+                f'({self._rate("crawler_response_bytes_total") / 2**10:.0f}KB/s) '
+                f'cache {hit / (hit + miss) * 100 if hit + miss else 0:.0f}% '
+                f'files {self._total("crawler_download_files_total"):.0f} '
+                f'wait {self._sum("crawler_waiter_sleep_seconds"):.0f}s '
+                f'tasks {self._total("crawler_tasks_running"):.0f} running {self._total("crawler_tasks_pending"):.0f} pending')
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.reporter.report(PROGRESS, self.line())
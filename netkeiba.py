@@ -1,21 +1,29 @@
 import asyncio
 from asyncio.locks import Semaphore
 from typing import Any, List, Optional
-import aiohttp
 from waiter import Waiter
-from reporter import Reporter
-from cacher import Cacher
+from session import SessionManager
+from reporter import Reporter, ERROR, INFO, WARN
+from cacher import AsyncCacher, Cacher, CachePolicy, LRUIndex, STORAGES, parse_size
 from collector import Collector
-import bs4
+from frontier import Frontier
+from seen import SeenSet
+from metrics import Registry
+import htmlparse
 import urllib.parse
 import argparse
-import signal
+import os
 
 SITE_ENCODING = 'euc_jis_2004'
 
 
 def get_race_urls(html):
-    doc = bs4.BeautifulSoup(html, 'lxml')
+    if htmlparse.backend() == 'lxml':
+        return [
+            'https://db.netkeiba.com' + _X_A(_X_TD(tr)[4])[0].attrib['href']
+            for tr in _X_RACE_TABLE_ROWS(htmlparse.parse(html))[1:]
+        ]
+    doc = htmlparse.soup(html)
     return [
         'https://db.netkeiba.com' + tr.select('td')[4].select_one('a')['href']
         for tr in doc.select('table.race_table_01 tr')[1:]
@@ -23,7 +31,12 @@ def get_race_urls(html):
 
 
 def get_horse_urls(html):
-    doc = bs4.BeautifulSoup(html, 'lxml')
+    if htmlparse.backend() == 'lxml':
+        return [
+            'https://db.netkeiba.com' + _X_A(_X_TD(tr)[1])[0].attrib['href']
+            for tr in _X_RACE_TABLE_ROWS(htmlparse.parse(html))[1:]
+        ]
+    doc = htmlparse.soup(html)
     return [
         'https://db.netkeiba.com' + tr.select('td')[1].select_one('a')['href']
         for tr in doc.select('table.race_table_01 tr')[1:]
@@ -31,7 +44,13 @@ def get_horse_urls(html):
 
 
 def get_nextpage_data(html):
-    doc = bs4.BeautifulSoup(html, 'lxml')
+    if htmlparse.backend() == 'lxml':
+        return {
+            input_elem.attrib['name']: input_elem.attrib['value']
+            for input_elem
+            in _X_SORT_INPUTS(htmlparse.parse(html))
+        }
+    doc = htmlparse.soup(html)
     return {
         input_elem['name']: input_elem['value']
         for input_elem
@@ -39,14 +58,27 @@ def get_nextpage_data(html):
     }
 
 
+_X_RACE_TABLE_ROWS = htmlparse.xpath(f"//tr[ancestor::table[{htmlparse.has_class('race_table_01')}]]")
+_X_TD = htmlparse.xpath('.//td')
+_X_A = htmlparse.xpath('.//a')
+_X_SORT_INPUTS = htmlparse.xpath("//form[@name='sort']/input")
+
+
 class Keiba(Collector):
-    def __init__(self, reporter, waiter, outdir, useragent) -> None:
-        super(Keiba, self).__init__()
+    def __init__(self, reporter, waiter, outdir, useragent, session: SessionManager = None,
+                 cache_backend: str = None,
+                 compression: str = None,
+                 lru: LRUIndex = None, cache_policy: CachePolicy = None, frontier: Frontier = None,
+                 seen: SeenSet = None) -> None:
+        super(Keiba, self).__init__(session)
         self.reporter: Reporter = reporter
         self.waiter = waiter
         self.outdir = outdir
         self.useragent = useragent
-        self.cacher = Cacher(self.outdir)
+        self.cacher = AsyncCacher(Cacher(self.outdir, cache_backend, compression, lru))
+        self.cache_policy = cache_policy or CachePolicy()
+        self.frontier = frontier
+        self.seen = seen
         self.semaphore = Semaphore(2)
 
     async def get_search_page(self, n: int, options: dict = {
@@ -67,104 +99,73 @@ class Keiba(Collector):
         psuedo_url = f'{url}?{urllib.parse.urlencode(options)}&page=1'
         filename = urllib.parse.quote(psuedo_url + '.html', safe='')
 
-        cache, _ = self.cacher.get(filename)
-        if cache:
-            search_result = cache
-        else:
-            await self.waiter.wait(psuedo_url)
-            print('fetching', psuedo_url)
-            async with aiohttp.request(
-                'post',
-                url=url,
-                headers={'content-type': 'application/x-www-form-urlencoded',
-                         'user-agent': self.useragent},
-                data=urllib.parse.urlencode(options)
-            ) as req:
-                content = await req.read()
-                search_result = content.decode(SITE_ENCODING)
-                if str(req.url) == url:
-                    self.cacher.set(filename, search_result)
-                else:
-                    print(f'Warning: redirected to {str(req.url)}')
-                    self.cacher.set(urllib.parse.quote(str(req.url), safe='') + '.html', search_result)
-                    return None
+        search_result, info = await self.fetch(
+            url, filename, method='post',
+            headers={'content-type': 'application/x-www-form-urlencoded'},
+            data=urllib.parse.urlencode(options),
+            encoding=SITE_ENCODING)
+        if info and info.get('realurl', url) != url:
+            self.reporter.report(WARN, f'redirected to {info["realurl"]}')
+            return None
 
         if n == 1:
             return search_result
         else:
-            data = await self.run_in_executor(get_nextpage_data, search_result)
+            data = await self.parse(get_nextpage_data, search_result)
             data['page'] = str(n)
             psuedo_url = f'{url}?{urllib.parse.urlencode(options)}&page={n}'
             filename = urllib.parse.quote(psuedo_url + '.html', safe='')
 
-            cache, _ = self.cacher.get(filename)
-            if cache:
-                result = cache
-            else:
-                await self.waiter.wait(psuedo_url)
-                print('fetching', psuedo_url)
-                async with aiohttp.request(
-                    'post',
-                    url=url,
-                    headers={'content-type': 'application/x-www-form-urlencoded',
-                             'user-agent': self.useragent},
-                    data=urllib.parse.urlencode(data, encoding=SITE_ENCODING)
-                ) as req:
-                    try:
-                        content = await req.read()
-                        result = content.decode(SITE_ENCODING)
-                        self.cacher.set(filename, result)
-                    except Exception as e:
-                        print('get_tail', e)
-                        return None
+            try:
+                result, _ = await self.fetch(
+                    url, filename, method='post',
+                    headers={'content-type': 'application/x-www-form-urlencoded'},
+                    data=urllib.parse.urlencode(data, encoding=SITE_ENCODING),
+                    encoding=SITE_ENCODING)
+            except Exception as e:
+                self.reporter.report(ERROR, f'get_tail {e}')
+                return None
             return result
 
     async def get_race_page(self, url):
         filename = urllib.parse.quote(url, safe='') + '.html'
-        cache, _ = self.cacher.get(filename, ext='')
-        if cache:
-            html = cache
-        else:
-            await self.waiter.wait(url)
-            print('fetching', url)
-            async with aiohttp.request('get', url, headers={'user-agent': self.useragent}) as req:
-                content = await req.read()
-                html = content.decode(SITE_ENCODING)
-                self.cacher.set(filename, html)
+        html, _ = await self.fetch(url, filename, encoding=SITE_ENCODING)
 
         return html
 
+    async def race_list_page(self, year, page):
+        self.reporter.report(INFO, f'page {page}')
+        html, _ = await self.async_retry(3, self.get_search_page, page, {
+            'pid': 'race_list',
+            'start_year': str(year),
+            'end_year': str(year),
+            'sort': 'date',
+            'list': '100'
+        })
+        return len([
+            await self.add_job('get_race', 'get_race_page', race_url)
+            for race_url in await self.parse(get_race_urls, html)
+        ]) == 100 if html else False
+
     async def collect(self, year, queue_size=3):
-        async def f(page):
-            print(page)
-            html, _ = await self.async_retry(3, self.get_search_page, page, {
-                'pid': 'race_list',
-                'start_year': str(year),
-                'end_year': str(year),
-                'sort': 'date',
-                'list': '100'
-            })
-            return len([
-                await self.add_future('get_race', self.get_race_page(race_url))
-                for race_url in await self.run_in_executor(get_race_urls, html)
-            ]) == 100 if html else False
-
-        await self.queued_paging(1, 1000, lambda page: f(page), queue_size=queue_size)
+        await self.queued_paging(1, 1000, lambda page: self.checkpointed('race_list_page', year, page),
+                                 queue_size=queue_size)
+
+    async def horse_list_page(self, year, page):
+        self.reporter.report(INFO, f'page {page}')
+        html, error = await self.async_retry(3, self.get_search_page, page, {
+            'pid': 'horse_list',
+            'list': '100',
+            'birthyear': year,
+        })
+        if error:
+            self.reporter.report(WARN, 'max retries exceeded')
+            return False
+        return len(await self.parse(get_horse_urls, html)) == 100 if html else False
 
     async def collect_horse(self, year, queue_size=3):
-        async def f(page):
-            print(page)
-            html, error = await self.async_retry(3, self.get_search_page, page, {
-                'pid': 'horse_list',
-                'list': '100',
-                'birthyear': year,
-            })
-            if error:
-                print('Waringn: max retries exceeded')
-                return False
-            return len(await self.run_in_executor(get_horse_urls, html)) == 100 if html else False
-
-        await self.queued_paging(1, 1000, lambda page: f(page), queue_size=queue_size)
+        await self.queued_paging(1, 1000, lambda page: self.checkpointed('horse_list_page', year, page),
+                                 queue_size=queue_size)
 
 
 if __name__ == "__main__":
@@ -175,19 +176,50 @@ if __name__ == "__main__":
     parser.add_argument('--wait', '-w', type=int, default=10, help='wait time in seconds')
     parser.add_argument('--dir', '-d', type=str, default='cache', help='cache directory')
     parser.add_argument('--useragent', '-ua', type=str, default='')
+    parser.add_argument('--cache_backend', choices=list(STORAGES.keys()), default=None, help='cache storage. default is auto detect')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=None, help='compress cached html')
+    parser.add_argument('--lru', type=str, default=None, help='in-memory index size of cached entries. `100000` entries or `512M` bytes')
+    parser.add_argument('--max_age', type=float, default=None, help='seconds until cached pages expire. default is never')
+    parser.add_argument('--revalidate', action='store_true', help='revalidate expired pages with ETag/Last-Modified')
+    parser.add_argument('--concurrency', type=int, default=None, help='max number of running tasks. default is unlimited')
+    parser.add_argument('--cache_policy', type=str, default='cache_policy.json', help='json file of max age per host')
+    parser.add_argument('--seen_capacity', type=int, default=1000000, help='expected number of jobs. sizes the in-memory filter of added jobs')
+    parser.add_argument('--metrics_port', type=int, default=None, help='serve metrics in prometheus text format on this port')
+    parser.add_argument('--progress', type=float, default=None, help='print a progress line every N seconds')
+    parser.add_argument('--resume', action='store_true', help='resume the previous run')
+    parser.add_argument('--parse_processes', type=int, default=None, help='size of the parser process pool. default is cpu count')
+    parser.add_argument('--parse_threads', type=int, default=None, help='size of the parser thread pool (lxml only)')
+    parser.add_argument('--parser', choices=htmlparse.BACKENDS, default=htmlparse.backend(), help='html parser for extractors. lxml is faster')
     args = parser.parse_args()
-    signal.signal(signal.SIGINT, lambda a, b: print('sigint') or exit(1))
+    htmlparse.set_backend(args.parser)
 
     c = Keiba(
         reporter=Reporter(1),
         waiter=Waiter([args.wait]),
         outdir=args.dir,
         useragent=args.useragent,
+        cache_backend=args.cache_backend,
+        compression=args.compression,
+        lru=LRUIndex(*parse_size(args.lru)) if args.lru else None,
+        cache_policy=CachePolicy(args.max_age, args.revalidate, args.cache_policy),
+        frontier=Frontier(os.path.join(args.dir, f'frontier-{args.type}.sqlite3')),
+        seen=SeenSet(os.path.join(args.dir, f'seen-{args.type}.sqlite3'), capacity=args.seen_capacity),
     )
+    c.scheduler.set_limit(args.concurrency)
+    if args.metrics_port is not None or args.progress:
+        c.instrument(Registry())
+    c.parser.processes = args.parse_processes or c.parser.processes
+    c.parser.threads = args.parse_threads or c.parser.threads
     if args.type == 'race':
-        asyncio.run(c.run(c.collect(args.year, queue_size=args.queue_size)))
+        asyncio.run(c.run(c.collect(args.year, queue_size=args.queue_size), resume=args.resume,
+                          metrics_port=args.metrics_port, progress=args.progress))
     elif args.type == 'horse':
-        asyncio.run(c.run(c.collect_horse(args.year, queue_size=args.queue_size)))
+        asyncio.run(c.run(c.collect_horse(args.year, queue_size=args.queue_size), resume=args.resume,
+                          metrics_port=args.metrics_port, progress=args.progress))
     else:
         print('invalid type')
         exit(1)
+    c.reporter.report(INFO, f'connections: {c.session.stats()}')
+    c.reporter.report(INFO, f'cache: {c.cacher.stats()}')
+    c.reporter.report(INFO, f'requests: {c.flights.stats()} seen: {c.seen.stats()}')
+    c.reporter.report(INFO, f'parser: {c.parser.stats()}')
@@ -0,0 +1,423 @@
+'''
+キャッシュしたnetkeibaのページから表を取り出して列ごとに型のついたデータにする
+races: レースページの結果 (race_table_01)
+horses: 馬の検索結果 (race_table_01)
+horse_results: 馬のページの戦績 (db_h_race_results)
+前回から変わっていないページ (mtime, サイズ, 内容のハッシュ) は読まない
+取り出せなかったページは数えて (failed) 次の実行で読み直す
+読み直したページの前の行は前の番号のファイルから消す (sourceごとに最新の行だけが残る)
+
+    python netkeiba_extract.py CACHE_DIR OUTDIR --jobs 8
+'''
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional
+import argparse
+import csv
+import glob
+import hashlib
+import os
+import re
+import sqlite3
+import urllib.parse
+from cacher import UNKNOWN, decompress, open_storage
+import htmlparse
+from page import Page
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# 列名と型
+TABLES = {
+    'races': [
+        ('race_id', str), ('rank', int), ('frame', int), ('number', int), ('horse', str), ('horse_id', str),
+        ('sex', str), ('age', int), ('weight', float), ('jockey', str), ('jockey_id', str), ('time', float),
+        ('margin', str), ('passing', str), ('last3f', float), ('odds', float), ('popularity', int),
+        ('body_weight', int), ('body_weight_diff', int), ('trainer', str), ('trainer_id', str),
+        ('owner', str), ('prize', float), ('source', str),
+    ],
+    'horses': [
+        ('horse_id', str), ('horse', str), ('sex', str), ('birth_year', int), ('trainer', str), ('trainer_id', str),
+        ('sire', str), ('dam', str), ('dam_sire', str), ('owner', str), ('breeder', str), ('prize', float),
+        ('source', str),
+    ],
+    'horse_results': [
+        ('horse_id', str), ('date', str), ('place', str), ('weather', str), ('race_number', int), ('race', str),
+        ('race_id', str), ('runners', int), ('frame', int), ('number', int), ('odds', float), ('popularity', int),
+        ('rank', int), ('jockey', str), ('jockey_id', str), ('weight', float), ('surface', str), ('distance', int),
+        ('going', str), ('time', float), ('margin', str), ('passing', str), ('last3f', float),
+        ('body_weight', int), ('body_weight_diff', int), ('prize', float), ('source', str),
+    ],
+}
+
+RE_RACE = re.compile(r'^https://db\.netkeiba\.com/race/(\w+)/')
+RE_HORSE = re.compile(r'^https://db\.netkeiba\.com/horse/(\w+)/')
+
+
+def to_int(text: str) -> Optional[int]:
+    m = re.search(r'-?\d+', text.replace(',', ''))
+    return int(m.group()) if m else None
+
+
+def to_float(text: str) -> Optional[float]:
+    try:
+        return float(text.replace(',', ''))
+    except ValueError:
+        return None
+
+
+def to_seconds(text: str) -> Optional[float]:
+    # 1:34.5 or 58.2
+    m = re.fullmatch(r'(?:(\d+):)?(\d+(?:\.\d+)?)', text)
+    if not m:
+        return None
+    return int(m.group(1) or 0) * 60 + float(m.group(2))
+
+
+def link_id(td, kind: str) -> Optional[str]:
+    for href in td.xpath('.//a/@href'):
+        m = re.search(rf'/{kind}/(?:result/(?:recent/)?)?(\w+)/', href)
+        if m:
+            return m.group(1)
+    return None
+
+
+def _text(name: str, convert: Callable = None):
+    def fn(td, text):
+        return {name: convert(text) if convert else text}
+    return fn
+
+
+def _linked(name: str, kind: str):
+    def fn(td, text):
+        return {name: text, f'{name}_id': link_id(td, kind)}
+    return fn
+
+
+def _sex_age(td, text):
+    return {'sex': text[:1] or None, 'age': to_int(text[1:])}
+
+
+def _body_weight(td, text):
+    # 480(+2)
+    m = re.fullmatch(r'(\d+)\(([+-]?\d+)\)', text)
+    if not m:
+        return {'body_weight': to_int(text) if text.isdigit() else None, 'body_weight_diff': None}
+    return {'body_weight': int(m.group(1)), 'body_weight_diff': int(m.group(2))}
+
+
+def _distance(td, text):
+    # 芝1600
+    m = re.fullmatch(r'(\D*)(\d+)', text)
+    if not m:
+        return {'surface': None, 'distance': None}
+    return {'surface': m.group(1) or None, 'distance': int(m.group(2))}
+
+
+def _race(td, text):
+    return {'race': text, 'race_id': link_id(td, 'race')}
+
+
+def _trainer(td, text):
+    # [東] 名前
+    return {'trainer': re.sub(r'^\[.\]\s*', '', text), 'trainer_id': link_id(td, 'trainer')}
+
+
+# 見出し -> その列の値
+HEADERS: Dict[str, Callable] = {
+    '着順': _text('rank', to_int),
+    '枠番': _text('frame', to_int),
+    '枠': _text('frame', to_int),
+    '馬番': _text('number', to_int),
+    '馬名': _linked('horse', 'horse'),
+    '性齢': _sex_age,
+    '性': _text('sex'),
+    '生年': _text('birth_year', to_int),
+    '斤量': _text('weight', to_float),
+    '騎手': _linked('jockey', 'jockey'),
+    'タイム': _text('time', to_seconds),
+    '着差': _text('margin'),
+    '通過': _text('passing'),
+    '上り': _text('last3f', to_float),
+    '単勝': _text('odds', to_float),
+    'オッズ': _text('odds', to_float),
+    '人気': _text('popularity', to_int),
+    '馬体重': _body_weight,
+    '調教師': _trainer,
+    '厩舎': _trainer,
+    '馬主': _text('owner'),
+    '生産者': _text('breeder'),
+    '父': _text('sire'),
+    '母': _text('dam'),
+    '母父': _text('dam_sire'),
+    '賞金': _text('prize', to_float),
+    '賞金(万円)': _text('prize', to_float),
+    '総賞金(万円)': _text('prize', to_float),
+    '日付': _text('date'),
+    '開催': _text('place'),
+    '天気': _text('weather'),
+    'R': _text('race_number', to_int),
+    'レース名': _race,
+    '頭数': _text('runners', to_int),
+    '距離': _distance,
+    '馬場': _text('going'),
+}
+
+_X_RACE_TABLE = htmlparse.xpath(f"//table[{htmlparse.has_class('race_table_01')}]")
+_X_HORSE_RESULTS = htmlparse.xpath(f"//table[{htmlparse.has_class('db_h_race_results')}]")
+_X_ROWS = htmlparse.xpath('.//tr')
+_X_CELLS = htmlparse.xpath('./th|./td')
+
+
+def page_kind(key: str) -> Optional[str]:
+    url = urllib.parse.unquote(key)
+    if RE_RACE.match(url):
+        return 'races'
+    if RE_HORSE.match(url):
+        return 'horse_results'
+    if 'pid=horse_list' in url:
+        return 'horses'
+    return None
+
+
+def parse_table(table, extra: dict, columns: List[str]) -> List[dict]:
+    rows = _X_ROWS(table)
+    if not rows:
+        return []
+    headers = [re.sub(r'\s', '', htmlparse.text(th)) for th in _X_CELLS(rows[0])]
+    results = []
+    for tr in rows[1:]:
+        row = dict.fromkeys(columns)
+        for header, td in zip(headers, _X_CELLS(tr)):
+            if header in HEADERS:
+                row.update(HEADERS[header](td, htmlparse.text(td)))
+        row.update(extra)
+        results.append({column: row[column] for column in columns})
+    return results
+
+
+def extract_page(kind: str, key: str, html) -> List[dict]:
+    doc = htmlparse.parse(html)
+    columns = [name for name, _ in TABLES[kind]]
+    extra = {'source': key}
+    url = urllib.parse.unquote(key)
+    if kind == 'races':
+        extra['race_id'] = RE_RACE.match(url).group(1)
+        tables = _X_RACE_TABLE(doc)[:1]
+    elif kind == 'horse_results':
+        extra['horse_id'] = RE_HORSE.match(url).group(1)
+        tables = _X_HORSE_RESULTS(doc)[:1]
+    else:
+        tables = _X_RACE_TABLE(doc)[:1]
+    return [row for table in tables for row in parse_table(table, extra, columns)]
+
+
+def _extract_chunk(items: list) -> list:
+    '''
+    ワーカー側で実行する
+    items: [(kind, key, path, エンコーディング, 前回のハッシュ)]
+    return: [(key, ハッシュ (失敗したらNone), 行 (変わっていなければNone))]
+    '''
+    results = []
+    for kind, key, path, encoding, old_digest in items:
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            digest = hashlib.sha1(content).hexdigest()
+            if digest == old_digest:
+                results.append((key, digest, None))
+                continue
+            rows = extract_page(kind, key, Page(decompress(content), encoding))
+        except Exception as e:
+            print('extract', key, e)
+            digest, rows = None, []
+        results.append((key, digest, rows))
+    return results
+
+
+class Manifest():
+    '''
+    処理済みのページのmtime, サイズ, 内容のハッシュ
+    '''
+
+    def __init__(self, path: str) -> None:
+        self._db = sqlite3.connect(path)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS pages (
+            key TEXT PRIMARY KEY,
+            mtime INTEGER,
+            size INTEGER,
+            hash TEXT)''')
+
+    def get(self, key: str):
+        return self._db.execute('SELECT mtime, size, hash FROM pages WHERE key=?', (key,)).fetchone()
+
+    def update(self, key: str, mtime: int, size: int, digest: str):
+        self._db.execute('INSERT OR REPLACE INTO pages (key, mtime, size, hash) VALUES (?, ?, ?, ?)',
+                         (key, mtime, size, digest))
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+class TableWriter():
+    '''
+    1回の実行で<table>-00000.parquet (pyarrowがなければ.csv) を1つ書く
+    '''
+
+    def __init__(self, outdir: str, table: str, format: str) -> None:
+        self.outdir = outdir
+        self.table = table
+        self.format = format
+        self.columns = TABLES[table]
+        self.rows = 0
+        self._path = None
+        self._file = None
+        self._writer = None
+
+    def _next_path(self) -> str:
+        paths = glob.glob(os.path.join(glob.escape(self.outdir), f'{self.table}-*.{self.format}'))
+        numbers = [int(os.path.basename(p)[len(self.table)+1:].split('.')[0]) for p in paths]
+        return os.path.join(self.outdir, f'{self.table}-{max(numbers, default=-1) + 1:05d}.{self.format}')
+
+    def write(self, rows: List[dict]):
+        if not rows:
+            return
+        if self._path is None:
+            self._path = self._next_path()
+        if self.format == 'parquet':
+            types = {str: pyarrow.string(), int: pyarrow.int64(), float: pyarrow.float64()}
+            schema = pyarrow.schema([(name, types[t]) for name, t in self.columns])
+            if self._writer is None:
+                self._writer = pyarrow.parquet.ParquetWriter(self._path, schema)
+            self._writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+        else:
+            if self._file is None:
+                self._file = open(self._path, 'wt', encoding='utf-8', newline='')
+                self._writer = csv.DictWriter(self._file, [name for name, _ in self.columns])
+                self._writer.writeheader()
+            self._writer.writerows(rows)
+        self.rows += len(rows)
+
+    def close(self):
+        if self.format == 'parquet' and self._writer is not None:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+
+    def prune(self, sources: set) -> int:
+        '''
+        この実行で書いたもの以外のファイルからsourceがsourcesの行を消す
+        return: 消した行の数
+        '''
+        removed = 0
+        if not sources:
+            return removed
+        for path in glob.glob(os.path.join(glob.escape(self.outdir), f'{self.table}-*.{self.format}')):
+            if path == self._path:
+                continue
+            if self.format == 'parquet':
+                table = pyarrow.parquet.read_table(path)
+                stale = pyarrow.compute.is_in(table.column('source'), value_set=pyarrow.array(list(sources)))
+                kept = table.filter(pyarrow.compute.invert(stale))
+                if kept.num_rows == table.num_rows:
+                    continue
+                removed += table.num_rows - kept.num_rows
+                pyarrow.parquet.write_table(kept, path + '~')
+            else:
+                with open(path, 'rt', encoding='utf-8', newline='') as f:
+                    rows = list(csv.DictReader(f))
+                kept = [row for row in rows if row['source'] not in sources]
+                if len(kept) == len(rows):
+                    continue
+                removed += len(rows) - len(kept)
+                with open(path + '~', 'wt', encoding='utf-8', newline='') as f:
+                    writer = csv.DictWriter(f, [name for name, _ in self.columns])
+                    writer.writeheader()
+                    writer.writerows(kept)
+            os.replace(path + '~', path)
+        return removed
+
+
+def extract(cache_dir: str, outdir: str, format: str = None, jobs: int = None,
+            chunk_size: int = 64, flush_rows: int = 100000):
+    '''
+    変わったページだけを並列に処理して表に追記する
+    読み直したページの前の行は前の番号のファイルから消す (replacedは消した行の数)
+    '''
+    format = format or ('parquet' if pyarrow is not None else 'csv')
+    if format == 'parquet' and pyarrow is None:
+        raise ImportError('pyarrow is required for parquet output')
+    os.makedirs(outdir, exist_ok=True)
+    storage = open_storage(cache_dir)
+    manifest = Manifest(os.path.join(outdir, 'manifest.sqlite3'))
+
+    todo = []
+    stats = {'pages': 0, 'unchanged': 0, 'failed': 0, 'replaced': 0}
+    for key, has_content, info in storage.entries():
+        kind = page_kind(key)
+        if kind is None or not has_content:
+            continue
+        stats['pages'] += 1
+        path = storage.path(key)
+        st = os.stat(path)
+        known = manifest.get(key)
+        if known is not None and known[0] == st.st_mtime_ns and known[1] == st.st_size:
+            stats['unchanged'] += 1
+            continue
+        # 取得したままのバイト列で保存したものは情報にエンコーディングがある
+        info = storage.read_info(key) if info is UNKNOWN else info
+        encoding = (info or {}).get('encoding')
+        todo.append(((kind, key, path, encoding, known[2] if known else None), st.st_mtime_ns, st.st_size))
+    storage.close()
+
+    writers = {table: TableWriter(outdir, table, format) for table in TABLES}
+    buffers: Dict[str, List[dict]] = {table: [] for table in TABLES}
+    stat_of = {item[1]: (mtime, size) for item, mtime, size in todo}
+    kind_of = {item[1]: item[0] for item, _, _ in todo}
+    chunks = [[item for item, _, _ in todo[i:i+chunk_size]] for i in range(0, len(todo), chunk_size)]
+    # 前にも取り出したページ 前の行を消す
+    extracted_before = {item[1] for item, _, _ in todo if item[4] is not None}
+    replaced: Dict[str, set] = {table: set() for table in TABLES}
+
+    with ProcessPoolExecutor(jobs or os.cpu_count()) as pool:
+        for results in pool.map(_extract_chunk, chunks):
+            for key, digest, rows in results:
+                if digest is None:
+                    # 処理済みにしない 次の実行で読み直す
+                    stats['failed'] += 1
+                    continue
+                manifest.update(key, *stat_of[key], digest)
+                if rows is None:
+                    stats['unchanged'] += 1
+                    continue
+                if key in extracted_before:
+                    replaced[kind_of[key]].add(key)
+                buffer = buffers[kind_of[key]]
+                buffer.extend(rows)
+                if len(buffer) >= flush_rows:
+                    writers[kind_of[key]].write(buffer)
+                    buffer.clear()
+
+    for table, writer in writers.items():
+        writer.write(buffers[table])
+        writer.close()
+        stats[table] = writer.rows
+        # 新しい行を書いてから消す 途中で止まってもmanifestが古いので次の実行でまた消す
+        stats['replaced'] += writer.prune(replaced[table])
+    # 書き終わってから処理済みにする
+    manifest.close()
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('netkeiba_extract')
+    parser.add_argument('cache_dir', help='cache directory of netkeiba.py')
+    parser.add_argument('outdir', help='output directory of tables')
+    parser.add_argument('--format', choices=['parquet', 'csv'], default=None, help='default is parquet if pyarrow is installed')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='number of processes. default is cpu count')
+    args = parser.parse_args()
+    print(extract(args.cache_dir, args.outdir, args.format, args.jobs))
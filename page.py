@@ -0,0 +1,53 @@
+'''
+取得したままのページのバイト列と、そのエンコーディング (レスポンスで宣言されたものか指定したもの)
+キャッシュにはこのまま保存し、strが必要になったときだけデコードする
+'''
+import codecs
+
+
+class Page(bytes):
+    '''
+    bytesとして扱える (そのままキャッシュに書き、別プロセスにも送れる)
+    text: デコードしたstr 最初に使ったときにデコードする
+    cached: キャッシュのファイルと同じ内容か (Collector.fetchが設定する)
+    '''
+
+    def __new__(cls, content: bytes, encoding: str = None):
+        page = super().__new__(cls, content)
+        # 知らないエンコーディング (Content-Typeの誤記など) はUTF-8として読む
+        page.encoding = encoding if encoding and is_known(encoding) else 'utf-8'
+        page._text = None
+        page.cached = False
+        return page
+
+    def __reduce__(self):
+        return (Page, (bytes(self), self.encoding))
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.decode(self.encoding, 'replace')
+        return self._text
+
+
+def is_known(encoding: str) -> bool:
+    try:
+        codecs.lookup(encoding)
+        return True
+    except LookupError:
+        return False
+
+
+def is_utf8(encoding: str) -> bool:
+    try:
+        return codecs.lookup(encoding).name in ('utf-8', 'ascii')
+    except LookupError:
+        return False
+
+
+def to_text(html) -> str:
+    if isinstance(html, Page):
+        return html.text
+    if isinstance(html, bytes):
+        return html.decode('utf-8', 'replace')
+    return html
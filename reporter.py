@@ -1,4 +1,10 @@
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple, Union
+import atexit
 import subprocess
+import sys
+import threading
+import time
 
 PROGRESS = 0
 DEBUG = 1
@@ -7,22 +13,155 @@ WARN = 3
 ERROR = 4
 FATAL = 5
 
-# リアルタイムで通知したいので同期的に
-
-
 NETWORK = '>'
 FILEIO = '.'
 
 
 class Reporter():
-    def __init__(self, loglevel, handler=None, handlelevel=3):
+    '''
+    標準出力はWARN未満のものをためておき、interval秒ごとかWARN以上・PROGRESSのときにまとめて書く
+    handlelevel以上のものはバックグラウンドのスレッドでinterval秒ごとにまとめてhandlerに渡す
+      同じメッセージは1回にまとめて回数をつけ、repeat_interval秒以内に渡したものは省く (次に渡すときに数を出す)
+    handler: 実行ファイルのパス ([handler, 最大のレベル, 改行でつないだメッセージ] で1回実行する)
+             または関数 handler([(レベル, メッセージ, 回数)]) (同じプロセスで呼ぶ)
+    '''
+
+    def __init__(self, loglevel, handler: Union[str, Callable, None] = None, handlelevel=3,
+                 interval: float = 1.0, repeat_interval: float = 60, max_messages: int = 100,
+                 buffer_lines: int = 1000):
+        '''
+        max_messages: 1回に渡すメッセージの種類の上限 超えた分は数だけ伝える
+        buffer_lines: これだけたまったらintervalを待たずに書く
+        '''
         self.loglevel = loglevel
         self.handler = handler
         self.handlelevel = handlelevel
+        self.interval = interval
+        self.repeat_interval = repeat_interval
+        self.max_messages = max_messages
+        self.buffer_lines = buffer_lines
+        self._lock = threading.Lock()
+        self._dispatch_lock = threading.Lock()
+        self._lines: List[str] = []
+        # (レベル, メッセージ) -> 回数 (出てきた順)
+        self._pending: Dict[Tuple[int, str], int] = OrderedDict()
+        # 最後にhandlerに渡した時刻と、その後に省いた回数
+        self._sent: Dict[Tuple[int, str], float] = {}
+        self._suppressed: Dict[Tuple[int, str], int] = {}
+        self._wakeup = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._closed = False
+        # 呼び出した回数と省いたメッセージの数
+        self.calls = 0
+        self.dropped = 0
 
     def report(self, level: int, message: str, end='\n', type=' ', ** args):
         if level == PROGRESS or level >= self.loglevel:
-            print(type*level, message, end=end)
+            line = f'{type*level} {message}{end}'
+            if level == PROGRESS or level >= WARN or self._closed:
+                with self._lock:
+                    self._lines.append(line)
+                self.flush_stdout()
+            else:
+                with self._lock:
+                    self._lines.append(line)
+                    full = len(self._lines) >= self.buffer_lines
+                if full:
+                    self.flush_stdout()
+                else:
+                    self._start()
 
         if level >= self.handlelevel and self.handler:
-            subprocess.run([self.handler, str(level), message])
+            key = (level, message)
+            with self._lock:
+                self._pending[key] = self._pending.get(key, 0) + 1
+            if self._closed:
+                self._dispatch()
+            else:
+                self._start()
+
+    def _start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name='reporter', daemon=True)
+            self._worker.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush_stdout()
+            self._dispatch()
+
+    def flush_stdout(self):
+        with self._lock:
+            lines, self._lines = self._lines, []
+            if lines:
+                sys.stdout.write(''.join(lines))
+                sys.stdout.flush()
+
+    def _take(self) -> List[Tuple[int, str, int]]:
+        '''
+        handlerに渡すメッセージ 最近渡したものは省く
+        '''
+        now = time.monotonic()
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        messages = []
+        for key, count in pending.items():
+            if now - self._sent.get(key, -self.repeat_interval) < self.repeat_interval:
+                self._suppressed[key] = self._suppressed.get(key, 0) + count
+                self.dropped += count
+                continue
+            count += self._suppressed.pop(key, 0)
+            self._sent[key] = now
+            messages.append((key[0], key[1], count))
+        # 古い記録は捨てる (省いた数がまだあるものは次に出てきたときに使う)
+        for key in [key for key, sent in self._sent.items() if now - sent >= self.repeat_interval and key not in self._suppressed]:
+            del self._sent[key]
+        return messages
+
+    def _dispatch(self):
+        # ワーカーとflushから同時に呼ばれても順に渡す
+        with self._dispatch_lock:
+            self._dispatch_locked()
+
+    def _dispatch_locked(self):
+        messages = self._take()
+        if not messages:
+            return
+        if len(messages) > self.max_messages:
+            rest = messages[self.max_messages:]
+            messages = messages[:self.max_messages]
+            self.dropped += sum(count for _, _, count in rest)
+            messages.append((max(level for level, _, _ in rest), f'... and {len(rest)} more messages', sum(count for _, _, count in rest)))
+        self.calls += 1
+        try:
+            if callable(self.handler):
+                self.handler(messages)
+            else:
+                text = '\n'.join(message if count == 1 else f'{message} (x{count})' for _, message, count in messages)
+                subprocess.run([self.handler, str(max(level for level, _, _ in messages)), text], timeout=60)
+        except Exception as e:
+            print('reporter handler', e, file=sys.stderr)
+
+    def flush(self):
+        '''
+        たまっているものをすぐに書き、handlerに渡す
+        '''
+        self.flush_stdout()
+        if self.handler:
+            self._dispatch()
+
+    def stats(self):
+        return {'handler_calls': self.calls, 'dropped': self.dropped}
+
+    def close(self):
+        # 以降のreportはすぐに書く
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        if self._worker is not None and self._worker is not threading.current_thread():
+            self._worker.join()
+        self.flush()
@@ -0,0 +1,196 @@
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional
+import asyncio
+import collections
+import traceback
+
+# 実行中のタスクから作られたタスク (create_taskはcontextを引き継ぐ) も元のタスクの枠で動く
+_owner: ContextVar[Optional[asyncio.Task]] = ContextVar('scheduler_task', default=None)
+
+
+class TagState():
+    def __init__(self, limit: int, backlog: int, priority: int) -> None:
+        # 同時実行数
+        self.limit = limit
+        # 待ち + 実行中の上限 これを超えるとsubmitが待たされる
+        self.backlog = backlog
+        # 大きいほど先に実行する
+        self.priority = priority
+        self.pending: Deque = collections.deque()
+        self.running = 0
+        self.space: Deque[asyncio.Future] = collections.deque()
+
+
+class Scheduler():
+    '''
+    Collector.add_futureのタスクを管理する
+    終わったタスクはすぐ手放し、全体とタグごとの同時実行数を制限して
+    優先度の高いタグから実行する
+    '''
+
+    def __init__(self, limit: Optional[int] = None, tag_limit: int = 20, backlog: int = 20) -> None:
+        self.limit = limit
+        self.tag_limit = tag_limit
+        self.backlog = backlog
+        self._tags: Dict[str, TagState] = {}
+        self._order = []
+        self._tasks: Dict[asyncio.Task, str] = {}
+        # 枠を貸しているタスク -> 待っている子の数
+        self._parked: Dict[asyncio.Task, int] = {}
+        self._running = 0
+        self._idle: Optional[asyncio.Event] = None
+
+    def _tag(self, tag: str) -> TagState:
+        if tag not in self._tags:
+            self._tags[tag] = TagState(self.tag_limit, self.backlog, 0)
+            self._sort()
+        return self._tags[tag]
+
+    def _sort(self):
+        self._order = sorted(self._tags.items(), key=lambda e: -e[1].priority)
+
+    def configure(self, tag: str, limit: int = None, backlog: int = None, priority: int = None):
+        '''
+        実行中にも変更できる
+        '''
+        state = self._tag(tag)
+        if limit is not None:
+            state.limit = limit
+        if backlog is not None:
+            state.backlog = backlog
+        if priority is not None:
+            state.priority = priority
+            self._sort()
+        self._wake(state)
+        self._dispatch()
+
+    def set_limit(self, limit: Optional[int]):
+        self.limit = limit
+        self._dispatch()
+
+    def _full(self, state: TagState) -> bool:
+        return len(state.pending) + state.running >= state.backlog
+
+    def _wake(self, state: TagState):
+        while state.space:
+            waiter = state.space.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def submit(self, tag: str, coro):
+        state = self._tag(tag)
+        owner = _owner.get()
+        parked = False
+        try:
+            while self._full(state):
+                if not parked and owner in self._tasks:
+                    # 待っている間は自分 (ページのワーカーなら親) の枠を貸す
+                    # (子タスクの空きを待つ親タスクで枠が埋まり止まるのを防ぐ)
+                    parked = True
+                    self._park(owner)
+                    continue
+                waiter = asyncio.get_event_loop().create_future()
+                state.space.append(waiter)
+                await waiter
+        except BaseException:
+            coro.close()
+            raise
+        finally:
+            if parked:
+                self._unpark(owner)
+
+        state.pending.append(coro)
+        if self._idle is not None:
+            self._idle.clear()
+        self._dispatch()
+
+    def _park(self, task: asyncio.Task):
+        count = self._parked.get(task, 0)
+        self._parked[task] = count + 1
+        if count:
+            return
+        state = self._tags[self._tasks[task]]
+        state.running -= 1
+        self._running -= 1
+        self._wake(state)
+        self._dispatch()
+
+    def _unpark(self, task: asyncio.Task):
+        count = self._parked.pop(task) - 1
+        if count:
+            self._parked[task] = count
+            return
+        if task not in self._tasks:
+            # 貸している間に終わった
+            return
+        # 上限を一時的に超えることがある
+        state = self._tags[self._tasks[task]]
+        state.running += 1
+        self._running += 1
+
+    def _dispatch(self):
+        for tag, state in self._order:
+            while state.pending and state.running < state.limit:
+                if self.limit is not None and self._running >= self.limit:
+                    return
+                self._start(tag, state, state.pending.popleft())
+
+    def _start(self, tag: str, state: TagState, coro):
+        state.running += 1
+        self._running += 1
+        task = asyncio.ensure_future(self._wrap(coro))
+        self._tasks[task] = tag
+        task.add_done_callback(self._done)
+
+    async def _wrap(self, coro):
+        _owner.set(asyncio.current_task())
+        try:
+            await coro
+        except Exception as e:
+            print('add_future', e, traceback.format_exc())
+
+    def _done(self, task: asyncio.Task):
+        state = self._tags[self._tasks.pop(task)]
+        # 枠を貸しているものはすでに数えていない
+        if task not in self._parked:
+            state.running -= 1
+            self._running -= 1
+        self._wake(state)
+        self._dispatch()
+        if self._idle is not None and self.in_flight() == 0 and self.queued() == 0:
+            self._idle.set()
+
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    def queued(self) -> int:
+        return sum(len(state.pending) for state in self._tags.values())
+
+    async def join(self):
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        while self.in_flight() or self.queued():
+            self._idle.clear()
+            await self._idle.wait()
+
+    async def cancel(self):
+        for task in list(self._tasks):
+            task.cancel()
+        for state in self._tags.values():
+            while state.pending:
+                state.pending.popleft().close()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, dict]:
+        stats = defaultdict(dict)
+        for tag, state in self._tags.items():
+            stats[tag] = {
+                'pending': len(state.pending),
+                'running': state.running,
+                'waiting': sum(1 for w in state.space if not w.done()),
+                'limit': state.limit,
+                'priority': state.priority,
+            }
+        return dict(stats)
@@ -0,0 +1,147 @@
+from typing import Iterable
+import hashlib
+import math
+import os
+import sqlite3
+import struct
+
+
+class SeenSet():
+    '''
+    一度見たキー (URLや作業) の集合
+    メモリにはBloomフィルタだけを持ち、ヒットしたときだけSQLiteの表で確かめる
+    初めてのキーはほとんどフィルタだけで判定できる
+    フィルタは<path>.bloomに保存し、次回はそれを読み込む
+    '''
+    HEADER = struct.Struct('<QQQ')
+
+    def __init__(self, path: str, capacity: int = 1000000, error_rate: float = 0.001) -> None:
+        '''
+        capacity: フィルタの想定件数 超えたら倍の大きさで作り直す
+        error_rate: フィルタの偽陽性率 (偽陽性はSQLiteで確かめるので結果は常に正確)
+        '''
+        self.path = path
+        self.error_rate = error_rate
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY) WITHOUT ROWID')
+        self._db.commit()
+        self.count = self._db.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+        self.checks = 0
+        # フィルタで確かめずに済んだ数とSQLiteで確かめた結果
+        self.filtered = 0
+        self.duplicates = 0
+        self.false_positives = 0
+        if not self._load():
+            self._build(max(capacity, self.count * 2))
+
+    @property
+    def bloom_path(self) -> str:
+        return self.path + '.bloom'
+
+    @staticmethod
+    def _digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+    def _size(self, capacity: int):
+        bits = max(64, int(-capacity * math.log(self.error_rate) / math.log(2) ** 2))
+        hashes = max(1, round(bits / capacity * math.log(2)))
+        return bits, hashes
+
+    def _indexes(self, digest: bytes) -> Iterable[int]:
+        # double hashing
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self._bits for i in range(self._hashes))
+
+    def _set(self, digest: bytes):
+        bloom = self._bloom
+        for i in self._indexes(digest):
+            bloom[i >> 3] |= 1 << (i & 7)
+
+    def _test(self, digest: bytes) -> bool:
+        bloom = self._bloom
+        return all(bloom[i >> 3] & (1 << (i & 7)) for i in self._indexes(digest))
+
+    def _build(self, capacity: int):
+        # SQLiteのキーからフィルタを作る
+        self.capacity = capacity
+        self._bits, self._hashes = self._size(capacity)
+        self._bloom = bytearray((self._bits + 7) // 8)
+        for (digest,) in self._db.execute('SELECT key FROM seen'):
+            self._set(digest)
+
+    def _load(self) -> bool:
+        # 保存したときと件数が違えば (途中で落ちたなど) 使わない
+        try:
+            with open(self.bloom_path, 'rb') as f:
+                capacity, hashes, count = self.HEADER.unpack(f.read(self.HEADER.size))
+                bloom = bytearray(f.read())
+        except (OSError, struct.error):
+            return False
+        bits, _ = self._size(capacity)
+        if count != self.count or len(bloom) != (bits + 7) // 8:
+            return False
+        self.capacity, self._bits, self._hashes, self._bloom = capacity, bits, hashes, bloom
+        return True
+
+    def _save(self):
+        temppath = self.bloom_path + '.tmp'
+        with open(temppath, 'wb') as f:
+            f.write(self.HEADER.pack(self.capacity, self._hashes, self.count))
+            f.write(self._bloom)
+        os.replace(temppath, self.bloom_path)
+
+    def add(self, key: str) -> bool:
+        '''
+        return: 初めてのキーか (すでにあればFalse)
+        '''
+        self.checks += 1
+        digest = self._digest(key)
+        if self._test(digest):
+            if self._db.execute('SELECT 1 FROM seen WHERE key=?', (digest,)).fetchone():
+                self.duplicates += 1
+                return False
+            self.false_positives += 1
+        else:
+            self.filtered += 1
+        self._db.execute('INSERT INTO seen (key) VALUES (?)', (digest,))
+        self._set(digest)
+        self.count += 1
+        if self.count > self.capacity:
+            self._build(self.capacity * 2)
+        return True
+
+    def __contains__(self, key: str) -> bool:
+        digest = self._digest(key)
+        return self._test(digest) and \
+            self._db.execute('SELECT 1 FROM seen WHERE key=?', (digest,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def reset(self):
+        self._db.execute('DELETE FROM seen')
+        self._db.commit()
+        self.count = 0
+        self._bloom = bytearray(len(self._bloom))
+        self._save()
+
+    def checkpoint(self):
+        self._db.commit()
+        self._save()
+
+    def stats(self):
+        return {
+            'keys': self.count,
+            'checks': self.checks,
+            'filtered': self.filtered,
+            'duplicates': self.duplicates,
+            'false_positives': self.false_positives,
+            'bloom_bytes': len(self._bloom),
+        }
+
+    def close(self):
+        self.checkpoint()
+        self._db.close()
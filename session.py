@@ -0,0 +1,90 @@
+from typing import Dict, Optional
+import urllib.parse
+import aiohttp
+
+
+class SessionManager():
+    '''
+    全コレクタとDownloaderで共有するaiohttp.ClientSession
+    コネクションプール・keep-alive・DNSキャッシュを使い回す
+    '''
+
+    def __init__(self,
+                 limit: int = 100,
+                 limit_per_host: int = 4,
+                 keepalive_timeout: float = 30,
+                 ttl_dns_cache: Optional[int] = 300,
+                 connector_options: dict = None,
+                 rewrite: Dict[str, str] = None) -> None:
+        '''
+        rewrite: {ホスト名: 'http://127.0.0.1:8080'} そのホストへのリクエストを別のサーバーに送る
+                 元のホスト名はHostヘッダで送る (ベンチマーク用のサーバーなど)
+        '''
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.connector_options = connector_options or {}
+        self.rewrite = rewrite or {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        # 新規接続数と再利用された接続数
+        self.opened = 0
+        self.reused = 0
+
+    async def _on_connection_create_end(self, session, ctx, params):
+        self.opened += 1
+
+    async def _on_connection_reuseconn(self, session, ctx, params):
+        self.reused += 1
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # イベントループ内で最初に使われたときに作る
+        if self._session is None or self._session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_connection_create_end)
+            trace.on_connection_reuseconn.append(self._on_connection_reuseconn)
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=self.ttl_dns_cache is not None,
+                ttl_dns_cache=self.ttl_dns_cache,
+                **self.connector_options)
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+        return self._session
+
+    def request(self, method: str, url: str, **kwargs):
+        if self.rewrite:
+            url, kwargs = self._rewrite(url, kwargs)
+        return self.session.request(method, url, **kwargs)
+
+    def original_url(self, url: str, realurl: str) -> str:
+        '''
+        rewriteしたリクエストのレスポンスのURL (リダイレクト先) を元のホストのURLに戻す
+        '''
+        u = urllib.parse.urlsplit(url)
+        if u.hostname not in self.rewrite:
+            return realurl
+        real = urllib.parse.urlsplit(realurl)
+        if real.netloc != urllib.parse.urlsplit(self.rewrite[u.hostname]).netloc:
+            return realurl
+        return real._replace(scheme=u.scheme, netloc=u.netloc).geturl()
+
+    def _rewrite(self, url: str, kwargs: dict):
+        u = urllib.parse.urlsplit(url)
+        if u.hostname not in self.rewrite:
+            return url, kwargs
+        base = urllib.parse.urlsplit(self.rewrite[u.hostname])
+        headers = dict(kwargs.get('headers') or {})
+        headers['host'] = u.netloc
+        return u._replace(scheme=base.scheme, netloc=base.netloc).geturl(), dict(kwargs, headers=headers)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self):
+        return {'opened': self.opened, 'reused': self.reused}
@@ -0,0 +1,70 @@
+from typing import Dict
+import asyncio
+import hashlib
+import urllib.parse
+
+
+def request_key(method: str, url: str, data=None) -> str:
+    '''
+    同じリクエストとみなすためのキー
+    スキームとホストは小文字、デフォルトのポートとフラグメントは除き、クエリは並べ替える
+    POSTの本文も含める
+    '''
+    u = urllib.parse.urlsplit(url)
+    netloc = (u.hostname or '').lower()
+    if u.port and not (u.scheme == 'http' and u.port == 80 or u.scheme == 'https' and u.port == 443):
+        netloc += f':{u.port}'
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(u.query, keep_blank_values=True)))
+    key = f'{method.upper()} {urllib.parse.urlunsplit((u.scheme.lower(), netloc, u.path or "/", query, ""))}'
+    if data is not None:
+        if isinstance(data, dict):
+            data = urllib.parse.urlencode(sorted(data.items()))
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        key += ' ' + hashlib.sha1(data).hexdigest()
+    return key
+
+
+class SingleFlight():
+    '''
+    同じキーの処理が実行中なら新しく始めずにその結果を待って共有する
+    '''
+
+    def __init__(self) -> None:
+        self._flights: Dict[str, asyncio.Future] = {}
+        self.calls = 0
+        # 実行中のものに相乗りした数
+        self.coalesced = 0
+
+    async def do(self, key: str, fn, *args, **kwargs):
+        while key in self._flights:
+            self.coalesced += 1
+            flight = self._flights[key]
+            try:
+                return await asyncio.shield(flight)
+            except asyncio.CancelledError:
+                # 先に始めたほうが中断されただけなら自分で実行する
+                if not flight.cancelled():
+                    raise
+                self.coalesced -= 1
+
+        self.calls += 1
+        flight = asyncio.get_event_loop().create_future()
+        # 待っている人がいなくても例外が未取得の警告を出さない
+        flight.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._flights[key] = flight
+        try:
+            result = await fn(*args, **kwargs)
+            flight.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            del self._flights[key]
+
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced}
@@ -0,0 +1,182 @@
+from typing import List, Optional
+import asyncio
+import glob
+import json
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('ndjson', 'parquet')
+
+
+class RecordSink():
+    '''
+    レコードをまとめて<name>-00000.ndjson (またはParquet) に追記する
+    ファイルがmax_bytesを超えたら次のファイルに切り替える
+    keyが同じレコードは最初のものだけ書く (既存のファイルの分も含む)
+    '''
+
+    def __init__(self, directory: str, name: str, key: str = None, format: str = 'ndjson',
+                 max_bytes: int = 64 * 1024 * 1024, flush_records: int = 1000, flush_interval: float = 5.0) -> None:
+        '''
+        key: 重複を除くためのフィールド Noneなら除かない
+        flush_records件たまるか、最初の未書き込みのレコードからflush_interval秒たったら書き込む
+        '''
+        if format not in FORMATS:
+            raise ValueError(f'unknown format {format}')
+        if format == 'parquet' and pyarrow is None:
+            raise ImportError('pyarrow is required for parquet output')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.key = key
+        self.format = format
+        self.max_bytes = max_bytes
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self._buffer: List[dict] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._seen = set()
+        self._part = 0
+        self._file = None
+        self._writer = None
+        self._schema = None
+        self.written = 0
+        self.duplicates = 0
+        self._load()
+
+    def _ext(self) -> str:
+        return 'ndjson' if self.format == 'ndjson' else 'parquet'
+
+    def _paths(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(glob.escape(self.directory), f'{glob.escape(self.name)}-*.{self._ext()}')))
+
+    def _load(self):
+        # 既存のファイルのkeyを読み、その次の番号のファイルから書く
+        paths = self._paths()
+        for path in paths:
+            if self.format == 'ndjson':
+                # 最後のファイルは書きかけの行を確かめるためkeyがなくても読む
+                if self.key is not None or path == paths[-1]:
+                    self._load_ndjson(path)
+            elif self.key is not None or path == paths[-1]:
+                self._load_parquet(path)
+        if paths:
+            self._part = int(os.path.basename(paths[-1])[len(self.name)+1:].split('.')[0]) + 1
+
+    def _load_ndjson(self, path: str):
+        with open(path, 'r+b') as f:
+            offset = 0
+            for line in iter(f.readline, b''):
+                try:
+                    record = json.loads(line) if line.strip() else None
+                except ValueError:
+                    if f.read(1):
+                        raise
+                    # 書き込み中に止まった最後の行は切り詰める
+                    print(f'sink: truncated a broken last line of {path}')
+                    f.truncate(offset)
+                    break
+                if record is not None and self.key is not None:
+                    self._seen.add(record.get(self.key))
+                offset += len(line)
+
+    def _load_parquet(self, path: str):
+        try:
+            if self.key is None:
+                pyarrow.parquet.read_metadata(path)
+            else:
+                table = pyarrow.parquet.read_table(path, columns=[self.key])
+                self._seen.update(table.column(self.key).to_pylist())
+        except (pyarrow.ArrowInvalid, OSError) as e:
+            # 書き込み中に止まってフッターがない 読めないので別の名前にして残す
+            print(f'sink: moved a broken part {path} to {path}.broken ({e})')
+            os.replace(path, path + '.broken')
+
+    def _path(self) -> str:
+        return os.path.join(self.directory, f'{self.name}-{self._part:05d}.{self._ext()}')
+
+    def write(self, record: dict) -> bool:
+        '''
+        return: 書いたか (重複ならFalse)
+        '''
+        if self.key is not None:
+            value = record.get(self.key)
+            if value in self._seen:
+                self.duplicates += 1
+                return False
+            self._seen.add(value)
+        self._buffer.append(record)
+        if len(self._buffer) >= self.flush_records:
+            self.flush()
+        elif self._timer is None:
+            try:
+                self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+            except RuntimeError:
+                # イベントループの外ではcloseかflush_recordsで書く
+                pass
+        return True
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        records, self._buffer = self._buffer, []
+        if not records:
+            return
+        if self.format == 'ndjson':
+            self._write_ndjson(records)
+        else:
+            self._write_parquet(records)
+        self.written += len(records)
+
+    def _write_ndjson(self, records: List[dict]):
+        if self._file is None:
+            self._file = open(self._path(), 'at', encoding='utf-8')
+        self._file.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _write_parquet(self, records: List[dict]):
+        # 入れ子の値はJSON文字列の列にする ないキーはnull
+        rows = [{k: json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else v
+                 for k, v in record.items()} for record in records]
+        names = list(dict.fromkeys(k for row in rows for k in row))
+        if self._schema is not None and not set(names) <= set(self._schema.names):
+            # 新しいキーが出てきたら列を増やして次のファイルに書く
+            self._rotate()
+            names = list(dict.fromkeys(self._schema.names + names))
+            self._schema = None
+        if self._schema is None:
+            schema = pyarrow.Table.from_pylist([{k: row.get(k) for k in names} for row in rows]).schema
+            # 値がすべてnullの列は文字列にしておく
+            self._schema = pyarrow.schema([
+                field.with_type(pyarrow.string()) if pyarrow.types.is_null(field.type) else field
+                for field in schema])
+        table = pyarrow.Table.from_pylist(rows, schema=self._schema)
+        if self._writer is None:
+            self._writer = pyarrow.parquet.ParquetWriter(self._path(), self._schema)
+        self._writer.write_table(table)
+        if os.path.getsize(self._path()) >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._part += 1
+
+    def stats(self):
+        return {'written': self.written, 'duplicates': self.duplicates}
+
+    def close(self):
+        self.flush()
+        self._rotate()
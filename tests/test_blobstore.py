@@ -0,0 +1,42 @@
+import os
+import sqlite3
+from blobstore import BlobStore
+
+
+def write(path: str, content: bytes) -> str:
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def urls(directory: str) -> list:
+    db = sqlite3.connect(os.path.join(directory, BlobStore.INDEX))
+    try:
+        return [row[0] for row in db.execute('SELECT url FROM urls ORDER BY url')]
+    finally:
+        db.close()
+
+
+def test_records_are_committed_in_batches(tmp_path):
+    '''
+    記録はcommit_records件ごとにまとめて書き、書くまでも同じBlobStoreからは見える
+    '''
+    blobs_dir = os.path.join(tmp_path, 'blobs')
+    blobs = BlobStore(blobs_dir, commit_records=3, commit_interval=60)
+    assert blobs._db.execute('PRAGMA busy_timeout').fetchone()[0] == BlobStore.BUSY_TIMEOUT * 1000
+
+    blobs.add(write(os.path.join(tmp_path, 'a'), b'a'), 'aa' * 32, 'https://x/a', '"a"')
+    blobs.add(write(os.path.join(tmp_path, 'b'), b'b'), 'bb' * 32, 'https://x/b')
+    assert urls(blobs_dir) == []
+    assert blobs.lookup_url('https://x/a') == 'aa' * 32
+    assert blobs.lookup_etag('"a"', 1) == 'aa' * 32
+
+    blobs.add(write(os.path.join(tmp_path, 'c'), b'c'), 'cc' * 32, 'https://x/c')
+    assert urls(blobs_dir) == ['https://x/a', 'https://x/b', 'https://x/c']
+
+    # 同じ内容はリンクにする
+    blobs.add(write(os.path.join(tmp_path, 'd'), b'a'), 'aa' * 32, 'https://x/d')
+    assert os.path.samefile(os.path.join(tmp_path, 'd'), blobs.blob_path('aa' * 32))
+    blobs.close()
+    assert urls(blobs_dir)[-1] == 'https://x/d'
+    assert BlobStore(blobs_dir).lookup_url('https://x/d') == 'aa' * 32
@@ -0,0 +1,67 @@
+import asyncio
+import multiprocessing
+from cacher import AsyncCacher, Cacher, LRUIndex
+
+WORKERS = 4
+ENTRIES = 200
+
+
+def _write(cache_dir: str, index: int):
+    async def main():
+        cacher = AsyncCacher(Cacher(cache_dir, 'sharded', lru=LRUIndex(shared=True)), shared=True)
+        for i in range(ENTRIES):
+            await cacher.aset(f'w{index}-{i}', f'content {index} {i}', {'status': 200})
+            # 他のワーカーの分も読む
+            await cacher.aget(f'w{(index + 1) % WORKERS}-{i}')
+        await cacher.close()
+    asyncio.run(main())
+
+
+def test_workers_share_cache(tmp_path):
+    '''
+    複数のプロセスが同じインデックスに書き込んでもロックで失敗しない
+    '''
+    Cacher(str(tmp_path), 'sharded').close()
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_write, args=(str(tmp_path), i)) for i in range(WORKERS)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    cacher = Cacher(str(tmp_path))
+    assert sum(has_content for _, has_content, _ in cacher.storage.entries()) == WORKERS * ENTRIES
+    assert cacher.get('w3-199') == ('content 3 199', {'status': 200})
+
+
+def test_shared_lru_sees_other_writers(tmp_path):
+    '''
+    共有するキャッシュではwarmしてもないkeyを記憶しない
+    '''
+    Cacher(str(tmp_path), 'sharded').set('a', 'a')
+    reader = Cacher(str(tmp_path), lru=LRUIndex(shared=True))
+    assert not reader.lru.complete
+    assert not reader.exists('b')
+    writer = Cacher(str(tmp_path))
+    writer.set('b', 'b', {'status': 200})
+    writer.close()
+    assert reader.exists('b')
+    assert reader.get('b') == ('b', {'status': 200})
+
+
+def test_shared_writes_commit_immediately(tmp_path):
+    '''
+    共有するインデックスではflushを待たずにコミットし、書き込みのロックを持ち続けない
+    '''
+    async def main():
+        cacher = AsyncCacher(Cacher(str(tmp_path), 'sharded'), fsync_interval=60, shared=True)
+        await cacher.aset('a', 'a')
+        other = Cacher(str(tmp_path))
+        assert other.exists('a')
+        # 他のプロセスもすぐに書ける
+        other.storage._db.execute('PRAGMA busy_timeout=0')
+        other.set('b', 'b')
+        other.close()
+        await cacher.close()
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+from cluster import ClusterClient, Coordinator, run_cluster, shard_of, shard_path
+from collector import Collector
+from reporter import Reporter
+from waiter import Waiter
+
+
+class ChainCollector(Collector):
+    '''
+    0から9の作業が、それぞれ10を足した作業を追加する
+    '''
+
+    def __init__(self, index: int) -> None:
+        super().__init__()
+        self.reporter = Reporter(5)
+        self.index = index
+        self.calls = []
+
+    async def item(self, n):
+        await asyncio.sleep(0.01)
+        self.calls.append(n)
+        if n < 10:
+            await self.add_job('item', 'item', n + 10)
+
+    async def root(self):
+        for n in range(10):
+            await self.add_job('item', 'item', n)
+
+
+def test_shard_path():
+    '''
+    ワーカーごとのファイルは番号を付けて分ける
+    '''
+    assert shard_path('out/frontier.sqlite3', None) == 'out/frontier.sqlite3'
+    assert shard_path('out/frontier.sqlite3', 1) == 'out/frontier-1.sqlite3'
+
+
+def test_run_cluster_routes_jobs_and_stops(tmp_path):
+    '''
+    作業はkeyの担当のワーカーで1回ずつ行い、全員が暇になったら終わる
+    '''
+    def make(index, waiter):
+        return ChainCollector(index)
+
+    def finish(collector):
+        with open(os.path.join(tmp_path, f'calls-{collector.index}.json'), 'wt') as f:
+            json.dump({'calls': collector.calls, 'sent': collector.cluster.sent,
+                       'received': collector.cluster.received}, f)
+
+    coordinator = run_cluster(make, lambda c: c.root(), 2, Waiter(['0']),
+                              os.path.join(tmp_path, 'cluster.sock'), finish)
+    results = []
+    for index in range(2):
+        with open(os.path.join(tmp_path, f'calls-{index}.json'), 'rt') as f:
+            results.append(json.load(f))
+    for index, result in enumerate(results):
+        assert all(shard_of(str(n), 2) == index for n in result['calls'])
+    assert sorted(results[0]['calls'] + results[1]['calls']) == list(range(20))
+    # 送った作業はすべて受け取られている
+    assert coordinator._routed == coordinator._received == [r['received'] for r in results]
+    assert sum(r['sent'] for r in results) == sum(coordinator._routed)
+    assert not os.path.exists(os.path.join(tmp_path, 'cluster.sock'))
+
+
+def test_job_waits_for_late_worker(tmp_path):
+    '''
+    まだ接続していないワーカーへの作業は接続したときに送り、受け取られるまで終わらない
+    '''
+    path = os.path.join(tmp_path, 'cluster.sock')
+    # 1番が担当するキー
+    key = next(n for n in range(100) if shard_of(str(n), 2) == 1)
+
+    async def main():
+        coordinator = Coordinator(path, 2, Waiter(['0']))
+        server = asyncio.ensure_future(coordinator.serve(timeout=5))
+        collectors = [ChainCollector(index) for index in range(2)]
+        clients = []
+        for index, collector in enumerate(collectors):
+            client = ClusterClient(path, index, 2)
+            client.collector = collector
+            collector.cluster = client
+            clients.append(client)
+
+        await clients[0].start()
+        await collectors[0].add_job('item', 'item', key + 10)
+        first = asyncio.ensure_future(clients[0].join(collectors[0].scheduler))
+        await asyncio.sleep(0.2)
+        # 0番は暇だが、1番への作業が残っている
+        assert not first.done() and not server.done()
+
+        await clients[1].start()
+        await clients[1].join(collectors[1].scheduler)
+        await first
+        for client in clients:
+            await client.close()
+        await asyncio.wait_for(server, 5)
+        assert collectors[1].calls == [key + 10]
+        assert coordinator._routed == coordinator._received == [0, 1]
+    asyncio.run(main())
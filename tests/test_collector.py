@@ -0,0 +1,77 @@
+import asyncio
+import threading
+from aiohttp import web
+from cacher import AsyncCacher, Cacher
+from collector import Collector
+from page import Page
+from reporter import Reporter
+from waiter import Waiter
+import htmlparse
+
+
+def _text(html):
+    return html.text if isinstance(html, Page) else html
+
+
+def test_parse_by_path_only_for_cached_pages(tmp_path):
+    '''
+    別プロセスにパスで送るのはキャッシュに書いた (読んだ) ページだけで、パスはループの外で探す
+    '''
+    async def main():
+        c = Collector()
+        c.cacher = AsyncCacher(Cacher(str(tmp_path)))
+        c.parser.processes = 1
+        # 測るまではすべて別プロセス
+        c.parser.inline_bytes = -1
+        threads = []
+        content_path = c.cacher.cacher.content_path
+        c.cacher.cacher.content_path = lambda filename: threads.append(threading.current_thread()) or content_path(filename)
+        # 前に書いた古い内容
+        c.cacher.cacher.set('page', Page(b'old'))
+        try:
+            # キャッシュに書かなかったレスポンス
+            assert await c.parse(_text, Page(b'new'), filename='page') == 'new'
+            assert threads == [] and c.parser.pages.by_path_pages == 0
+
+            c.parser._cost.clear()
+            content, info = await c.cacher.aget('page', binary=True)
+            page = Page(content)
+            page.cached = True
+            assert await c.parse(_text, page, filename='page') == 'old'
+            assert c.parser.pages.by_path_pages == 1
+            assert threads and threading.main_thread() not in threads
+        finally:
+            c.parser.close()
+            await c.cacher.close()
+    asyncio.run(main())
+
+
+def test_fetch_with_bogus_charset(tmp_path):
+    '''
+    Content-Typeのcharsetが使えないエンコーディングでも解析できるページを返す
+    '''
+    async def handler(request):
+        return web.Response(body='<p>日本語</p>'.encode('utf-8'), headers={'Content-Type': 'text/html; charset=x-bogus'})
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        c = Collector()
+        c.cacher = AsyncCacher(Cacher(str(tmp_path)))
+        c.reporter = Reporter(0)
+        c.waiter = Waiter(['0'])
+        c.semaphore = asyncio.Semaphore(1)
+        try:
+            content, info = await c.fetch(f'http://127.0.0.1:{port}/', 'page')
+            assert content.encoding == info['encoding'] == 'utf-8'
+            assert htmlparse.text(htmlparse.parse(content).xpath('//p')[0]) == '日本語'
+        finally:
+            await c.session.close()
+            await c.cacher.close()
+            await runner.cleanup()
+    asyncio.run(main())
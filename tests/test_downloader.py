@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import os
+import threading
+from aiohttp import web
+from blobstore import BlobStore
+from cacher import AsyncCacher, Cacher
+from downloader import Downloader
+from reporter import Reporter
+from session import SessionManager
+from waiter import Waiter
+
+BODY = bytes(range(256)) * 40
+
+
+class RecordingWaiter(Waiter):
+    def __init__(self):
+        super().__init__(['0'])
+        self.statuses = []
+        self.latencies = []
+
+    def feedback(self, url, status, latency, retry_after=None):
+        self.statuses.append(status)
+        self.latencies.append(latency)
+
+
+async def serve(handler):
+    app = web.Application()
+    app.router.add_get('/file', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/file'
+
+
+async def download(tmp_path, handler, prepare=None, busy: float = 0):
+    '''
+    busy: この秒数だけ先にsemaphoreを使っておく
+    '''
+    runner, url = await serve(handler)
+    waiter = RecordingWaiter()
+    session = SessionManager()
+    cacher = AsyncCacher(Cacher(str(tmp_path)))
+    semaphore = asyncio.Semaphore(1)
+    try:
+        downloader = Downloader(waiter, semaphore, Reporter(0), session, cacher, retries=2, backoff=0)
+        if prepare is not None:
+            prepare(cacher)
+
+        async def hold():
+            async with semaphore:
+                await asyncio.sleep(busy)
+        holder = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        result = await downloader.download_file(url, 'file.bin')
+        await holder
+        await cacher.close()
+        return result, waiter, cacher
+    finally:
+        await session.close()
+        await runner.cleanup()
+
+
+def test_feedback_once_per_attempt(tmp_path):
+    '''
+    503で失敗した試行もWaiterに伝えるのは1回だけ
+    '''
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return web.Response(status=503)
+        return web.Response(body=BODY)
+
+    result, waiter, _ = asyncio.run(download(tmp_path, handler))
+    assert result['bytes'] == len(BODY)
+    assert waiter.statuses == [503, 200]
+
+
+def test_mismatched_range_restarts(tmp_path):
+    '''
+    続きを頼んだのに違う位置からの206が返ったら、一時ファイルを捨ててRangeなしで取り直す
+    '''
+    requests = []
+
+    async def handler(request):
+        requests.append(dict(request.headers))
+        if 'Range' in request.headers:
+            # 頼んだ位置 (100) ではなく先頭から返す
+            return web.Response(status=206, body=BODY[:500],
+                                headers={'Content-Range': f'bytes 0-499/{len(BODY)}', 'ETag': '"v1"'})
+        return web.Response(body=BODY, headers={'ETag': '"v1"'})
+
+    def prepare(cacher):
+        temppath = cacher.tmp_path('file.bin')
+        with open(temppath, 'wb') as f:
+            f.write(BODY[:100])
+        with open(temppath + '~', 'wt') as f:
+            f.write('{"etag": "\\"v1\\""}')
+
+    result, waiter, cacher = asyncio.run(download(tmp_path, handler, prepare))
+    assert result == {'bytes': len(BODY), 'sha256': hashlib.sha256(BODY).hexdigest()}
+    assert len(requests) == 2
+    assert 'Range' not in requests[1] and 'If-Range' not in requests[1]
+    with open(cacher.content_path('file.bin'), 'rb') as f:
+        assert f.read() == BODY
+    assert not os.path.exists(cacher.tmp_path('file.bin'))
+
+
+def test_latency_excludes_semaphore_wait(tmp_path):
+    '''
+    ほかのダウンロードが空くのを待った時間はWaiterに伝えるレイテンシに入れない
+    '''
+    async def handler(request):
+        return web.Response(body=BODY)
+
+    result, waiter, _ = asyncio.run(download(tmp_path, handler, busy=0.5))
+    assert result['bytes'] == len(BODY)
+    assert waiter.statuses == [200]
+    assert waiter.latencies[0] < 0.3
+
+
+def test_blobs_off_the_loop(tmp_path):
+    '''
+    BlobStoreはイベントループのスレッドでは使わない
+    '''
+    threads = []
+
+    class RecordingBlobStore(BlobStore):
+        def lookup_url(self, url):
+            threads.append(threading.current_thread())
+            return super().lookup_url(url)
+
+        def add(self, *args):
+            threads.append(threading.current_thread())
+            return super().add(*args)
+
+    async def handler(request):
+        return web.Response(body=BODY)
+
+    async def main():
+        runner, url = await serve(handler)
+        session = SessionManager()
+        cacher = AsyncCacher(Cacher(str(tmp_path)))
+        blobs = RecordingBlobStore(os.path.join(tmp_path, 'blobs'))
+        try:
+            downloader = Downloader(RecordingWaiter(), asyncio.Semaphore(1), Reporter(0), session, cacher,
+                                    backoff=0, blobs=blobs)
+            assert (await downloader.download_file(url, 'a.bin'))['bytes'] == len(BODY)
+            # 2回目はURLから分かる
+            assert (await downloader.download_file(url, 'b.bin'))['bytes'] == len(BODY)
+        finally:
+            blobs.close()
+            await cacher.close()
+            await session.close()
+            await runner.cleanup()
+        assert blobs.url_hits == 1
+        assert len(threads) == 3 and threading.main_thread() not in threads
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+import json
+import os
+import urllib.parse
+import warnings
+import pytest
+import htmlparse
+import netkeiba_extract
+from bench.parsers import EXTRACTORS, extract_all
+from page import Page
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), 'pages')
+
+
+def load_pages() -> dict:
+    '''
+    tests/pages/の保存したページ (bench.serverで作ったもの) {名前: (URL, Page)}
+    '''
+    with open(os.path.join(PAGES_DIR, 'pages.json'), 'rt', encoding='utf-8') as f:
+        index = json.load(f)
+    pages = {}
+    for name, entry in index.items():
+        with open(os.path.join(PAGES_DIR, f'{name}.html'), 'rb') as f:
+            pages[name] = (entry['url'], Page(f.read(), entry['encoding']))
+    return pages
+
+
+PAGES = load_pages()
+
+
+@pytest.fixture(params=htmlparse.BACKENDS)
+def backend(request):
+    htmlparse.set_backend(request.param)
+    yield request.param
+    htmlparse.set_backend('bs4')
+
+
+def golden() -> dict:
+    with open(os.path.join(PAGES_DIR, 'golden.json'), 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('name', sorted(PAGES))
+def test_extractors_match_golden(name, backend):
+    '''
+    どちらのバックエンドでも全抽出関数がゴールデンファイル (bs4の結果) と同じ結果を返す
+    '''
+    warnings.filterwarnings('ignore')
+    _, html = PAGES[name]
+    assert extract_all(html) == golden()[name]
+
+
+def test_golden_covers_every_extractor():
+    # どの抽出関数も少なくとも1つのページで空でない結果を返す
+    results = golden()
+    for extractor in EXTRACTORS:
+        assert any(results[name][extractor] not in ([], {}, None, {'error': True}) for name in results), extractor
+
+
+@pytest.mark.parametrize('name', ['netkeiba-race', 'netkeiba-horse', 'netkeiba-horse_list'])
+def test_extract_page_backends(name):
+    '''
+    netkeiba_extractの表の取り出しもバックエンドによらない (EUC-JIS-2004のページ)
+    '''
+    url, html = PAGES[name]
+    key = urllib.parse.quote(url, safe='')
+    kind = netkeiba_extract.page_kind(key)
+    results = {}
+    for backend in htmlparse.BACKENDS:
+        htmlparse.set_backend(backend)
+        results[backend] = netkeiba_extract.extract_page(kind, key, html)
+    htmlparse.set_backend('bs4')
+    assert results['lxml'] == results['bs4']
+    assert results['lxml']
+    if name == 'netkeiba-race':
+        # EUC-JPにない文字
+        assert results['lxml'][1]['jockey'] == '髙田潤'
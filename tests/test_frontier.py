@@ -0,0 +1,71 @@
+import asyncio
+import os
+import signal
+from collector import Collector
+from frontier import DONE, Frontier
+from reporter import Reporter
+
+
+class JobCollector(Collector):
+    def __init__(self, path: str, block: bool = False):
+        super().__init__()
+        self.reporter = Reporter(5)
+        self.frontier = Frontier(path)
+        self.block = block
+        self.calls = []
+
+    async def page(self, n):
+        self.calls.append(('page', n))
+        return {'items': [n * 10, n * 10 + 1]}
+
+    async def item(self, n):
+        self.calls.append(('item', n))
+        if self.block:
+            await asyncio.sleep(3600)
+
+    async def root(self):
+        result = await self.checkpointed('page', 1)
+        for n in result['items']:
+            await self.add_job('item', 'item', n)
+
+
+def test_resume_uses_checkpointed_result(tmp_path):
+    '''
+    再開時はcheckpointedの記録した結果を返し、終わった作業はもう一度行わない
+    '''
+    path = os.path.join(tmp_path, 'frontier.sqlite3')
+    c = JobCollector(path)
+    asyncio.run(c.run(c.root()))
+    assert sorted(c.calls) == [('item', 10), ('item', 11), ('page', 1)]
+
+    c = JobCollector(path)
+    asyncio.run(c.run(c.root(), resume=True))
+    assert c.calls == []
+    frontier = Frontier(path)
+    assert frontier.get(Frontier.make_key('page', (1,))) == (DONE, {'items': [10, 11]})
+    assert frontier.counts() == {'done': 3}
+    frontier.close()
+
+
+def test_sigint_leaves_inflight_jobs_to_resume(tmp_path):
+    '''
+    SIGINTで止めると実行中の作業はINFLIGHTのまま残り、--resumeでその作業だけを行う
+    '''
+    path = os.path.join(tmp_path, 'frontier.sqlite3')
+    c = JobCollector(path, block=True)
+
+    async def interrupted():
+        asyncio.get_event_loop().call_later(0.2, os.kill, os.getpid(), signal.SIGINT)
+        await c.run(c.root())
+    asyncio.run(interrupted())
+    assert sorted(c.calls) == [('item', 10), ('item', 11), ('page', 1)]
+    frontier = Frontier(path)
+    assert frontier.counts() == {'done': 1, 'inflight': 2}
+    frontier.close()
+
+    c = JobCollector(path)
+    asyncio.run(c.run(c.root(), resume=True))
+    assert sorted(c.calls) == [('item', 10), ('item', 11)]
+    frontier = Frontier(path)
+    assert frontier.counts() == {'done': 3}
+    frontier.close()
@@ -0,0 +1,21 @@
+import htmlparse
+from bench.parsers import EDGE_PAGES, extract_all
+
+
+def test_edge_pages_match_bs4():
+    '''
+    空やコメントだけのページでlxmlもbs4と同じ (空の) 結果を返す
+    '''
+    for key, html in EDGE_PAGES.items():
+        results = {}
+        for backend in htmlparse.BACKENDS:
+            htmlparse.set_backend(backend)
+            results[backend] = extract_all(html)
+        htmlparse.set_backend('bs4')
+        assert results['lxml'] == results['bs4'], key
+        assert not any(isinstance(r, dict) and r.get('error') for r in results['lxml'].values()), key
+
+
+def test_parse_empty_document():
+    for html in (b'', '', '   ', '<!-- x -->'):
+        assert htmlparse.parse(html).xpath('//a') == []
@@ -0,0 +1,19 @@
+from metrics import Registry
+
+
+def test_expose_mixed_label_values():
+    '''
+    statusのラベルにintと'error'が混ざっても公開できる
+    '''
+    registry = Registry()
+    requests = registry.counter('crawler_requests_total', 'responses by status', ('host', 'status'))
+    latency = registry.histogram('crawler_latency_seconds', 'latency', ('host', 'status'))
+    requests.inc('wear.jp', 200)
+    requests.inc('wear.jp', 'error')
+    requests.inc('wear.jp', None)
+    latency.observe(0.1, 'wear.jp', 200)
+    latency.observe(0.2, 'wear.jp', 'error')
+    text = registry.expose()
+    assert 'crawler_requests_total{host="wear.jp",status="200"} 1' in text
+    assert 'crawler_requests_total{host="wear.jp",status="error"} 1' in text
+    assert 'crawler_latency_seconds_count{host="wear.jp",status="error"} 1' in text
@@ -0,0 +1,72 @@
+import csv
+import glob
+import os
+import urllib.parse
+import pytest
+from cacher import COMPRESS_HEADER, Cacher
+from netkeiba_extract import extract, pyarrow
+
+KEY = urllib.parse.quote('https://db.netkeiba.com/race/202001010101/', safe='')
+PAGE = '''<html><body><table class="race_table_01">
+<tr><th>着順</th><th>馬名</th><th>タイム</th></tr>
+<tr><td>1</td><td><a href="/horse/2017100001/">アイウエオ</a></td><td>1:34.5</td></tr>
+</table></body></html>'''
+
+
+def test_failed_page_is_retried(tmp_path):
+    '''
+    取り出せなかったページはmanifestに入れず、次の実行で読み直す
+    '''
+    cache_dir = os.path.join(tmp_path, 'cache')
+    outdir = os.path.join(tmp_path, 'out')
+    cacher = Cacher(cache_dir)
+    # 壊れた圧縮エントリ
+    cacher.set(KEY, COMPRESS_HEADER + b'gzip\nbroken', content_type='application/octet-stream')
+
+    stats = extract(cache_dir, outdir, format='csv', jobs=1)
+    assert stats['failed'] == 1 and stats['races'] == 0
+    stats = extract(cache_dir, outdir, format='csv', jobs=1)
+    assert stats['failed'] == 1 and stats['unchanged'] == 0
+
+    cacher.set(KEY, PAGE)
+    stats = extract(cache_dir, outdir, format='csv', jobs=1)
+    assert stats['failed'] == 0 and stats['races'] == 1
+    stats = extract(cache_dir, outdir, format='csv', jobs=1)
+    assert stats['unchanged'] == 1
+
+
+def read_rows(outdir: str, format: str) -> list:
+    rows = []
+    for path in sorted(glob.glob(os.path.join(outdir, f'races-*.{format}'))):
+        if format == 'parquet':
+            rows += pyarrow.parquet.read_table(path).to_pylist()
+        else:
+            with open(path, 'rt', encoding='utf-8', newline='') as f:
+                rows += list(csv.DictReader(f))
+    return rows
+
+
+@pytest.mark.parametrize('format', ['csv', 'parquet'])
+def test_changed_page_replaces_rows(tmp_path, format):
+    '''
+    変わったページを読み直したら前のファイルの行は消え、sourceごとに最新の行だけが残る
+    '''
+    if format == 'parquet':
+        pytest.importorskip('pyarrow')
+    cache_dir = os.path.join(tmp_path, 'cache')
+    outdir = os.path.join(tmp_path, 'out')
+    cacher = Cacher(cache_dir)
+    other = urllib.parse.quote('https://db.netkeiba.com/race/202001010102/', safe='')
+    cacher.set(KEY, PAGE)
+    cacher.set(other, PAGE)
+    assert extract(cache_dir, outdir, format=format, jobs=1)['races'] == 2
+
+    second = '<tr><td>2</td><td><a href="/horse/2017100002/">カキクケコ</a></td><td>1:35.0</td></tr>'
+    cacher.set(KEY, PAGE.replace('</table>', second + '</table>'))
+    stats = extract(cache_dir, outdir, format=format, jobs=1)
+    assert stats['races'] == 2 and stats['replaced'] == 1
+
+    rows = read_rows(outdir, format)
+    assert sorted((row['source'], row['horse']) for row in rows) == sorted([
+        (KEY, 'アイウエオ'), (KEY, 'カキクケコ'), (other, 'アイウエオ')])
+    assert len(glob.glob(os.path.join(outdir, f'races-*.{format}'))) == 2
@@ -0,0 +1,15 @@
+import htmlparse
+from page import Page
+
+
+def test_unknown_encoding_falls_back_to_utf8():
+    page = Page('<p>日本語</p>'.encode('utf-8'), 'x-bogus')
+    assert page.encoding == 'utf-8'
+    assert page.text == '<p>日本語</p>'
+    assert htmlparse.text(htmlparse.parse(page).xpath('//p')[0]) == '日本語'
+
+
+def test_known_encoding_is_kept():
+    page = Page('競馬'.encode('euc_jis_2004'), 'euc_jis_2004')
+    assert page.encoding == 'euc_jis_2004'
+    assert page.text == '競馬'
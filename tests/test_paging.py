@@ -0,0 +1,76 @@
+import asyncio
+import math
+from collector import Collector
+from reporter import Reporter
+
+
+def make_collector() -> Collector:
+    c = Collector()
+    c.reporter = Reporter(5)
+    return c
+
+
+def test_queued_paging_cancels_pages_past_the_end():
+    '''
+    あるページがFalseを返したら、それより先の取得中のページはすぐ止める
+    '''
+    started, finished = [], []
+
+    async def page(p):
+        started.append(p)
+        # 最後より先のページは遅い
+        await asyncio.sleep(0.01 if p <= 5 else 5)
+        finished.append(p)
+        return p < 5
+
+    async def main():
+        c = make_collector()
+        await asyncio.wait_for(c.queued_paging(1, 100, page, queue_size=4), 2)
+    asyncio.run(main())
+    assert sorted(finished) == [1, 2, 3, 4, 5]
+    assert max(started) > 5
+    assert max(started) < 100
+
+
+def test_probe_last_page():
+    '''
+    指数探索と二分探索で最後のページを求め、範囲の外は調べない
+    '''
+    async def probe(last, pagestart=1, pageend=100):
+        probed = []
+
+        async def exists(p):
+            probed.append(p)
+            return p <= last
+        c = make_collector()
+        return await c.probe_last_page(pagestart, pageend, exists), probed
+
+    for last in (1, 2, 3, 7, 8, 50, 99, 100):
+        found, probed = asyncio.run(probe(last))
+        assert found == last, last
+        assert all(1 <= p <= 100 for p in probed)
+        assert len(probed) <= 2 * math.ceil(math.log2(100)) + 1, (last, probed)
+
+    # 最初のページもない
+    found, probed = asyncio.run(probe(0))
+    assert found == 0 and probed == [1]
+    # 範囲の終わりまである
+    found, probed = asyncio.run(probe(500, 3, 40))
+    assert found == 40 and max(probed) == 40 and min(probed) == 3
+
+
+def test_probed_paging_fetches_up_to_last_page():
+    fetched = []
+
+    async def exists(p):
+        return p <= 13
+
+    async def page(p):
+        fetched.append(p)
+        return True
+
+    async def main():
+        c = make_collector()
+        await c.probed_paging(1, 100, page, exists, concurrency=4)
+    asyncio.run(main())
+    assert sorted(fetched) == list(range(1, 14))
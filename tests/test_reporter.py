@@ -0,0 +1,24 @@
+import asyncio
+from collector import Collector
+from reporter import INFO, Reporter
+
+
+def test_collector_errors_keep_order(capsys):
+    '''
+    ページの失敗もReporterを通すので、ためてあるINFOより先に出ない
+    '''
+    async def main():
+        c = Collector()
+        c.reporter = Reporter(INFO, interval=60)
+
+        async def page(p):
+            c.reporter.report(INFO, f'page {p}')
+            if p == 2:
+                raise ValueError('broken page')
+            return True
+
+        await c.queued_paging(1, 2, page)
+        c.reporter.close()
+    asyncio.run(main())
+    out = capsys.readouterr().out
+    assert out.index('page 1') < out.index('page 2') < out.index('queued_paging') < out.index('broken page')
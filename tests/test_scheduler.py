@@ -0,0 +1,154 @@
+import asyncio
+from collector import Collector
+from reporter import Reporter
+from scheduler import Scheduler
+
+
+def test_nested_paging_under_global_limit():
+    '''
+    ページのワーカー (create_task) が画像の空きを待つ間も親の枠を貸し、全体の上限で止まらない
+    '''
+    async def main():
+        c = Collector()
+        c.reporter = Reporter(5)
+        c.scheduler.set_limit(3)
+        c.scheduler.configure('gallery', priority=1)
+        c.scheduler.configure('image', priority=0)
+        submitted, done = [], []
+
+        async def image(key):
+            await asyncio.sleep(0.001)
+            done.append(key)
+
+        async def gallery_page(g, p):
+            for i in range(10):
+                await c.add_future('image', image((g, p, i)))
+                # 最後より先のページはadd_futureの途中で止められる
+                submitted.append((g, p, i))
+            return p < 4
+
+        async def gallery(g):
+            await c.queued_paging(1, 10, lambda p: gallery_page(g, p))
+
+        async def user_page(p):
+            for g in range(10):
+                await c.add_future('gallery', gallery((p, g)))
+            return p < 3
+
+        try:
+            await asyncio.wait_for(c.run(c.queued_paging(1, 10, user_page)), 20)
+        finally:
+            await c.session.close()
+        return submitted, done
+
+    submitted, done = asyncio.run(main())
+    assert len(submitted) >= 3 * 10 * 4 * 10
+    assert sorted(done) == sorted(submitted)
+
+
+def test_priority_order():
+    '''
+    空きができたら優先度の高いタグから実行する
+    '''
+    async def main():
+        scheduler = Scheduler(limit=1)
+        scheduler.configure('image', priority=0)
+        scheduler.configure('page', priority=1)
+        order = []
+        release = asyncio.Event()
+
+        async def job(name):
+            order.append(name)
+
+        async def blocker():
+            await release.wait()
+
+        await scheduler.submit('image', blocker())
+        for i in range(3):
+            await scheduler.submit('image', job(f'image{i}'))
+            await scheduler.submit('page', job(f'page{i}'))
+        assert scheduler.queued() == 6
+        release.set()
+        await scheduler.join()
+        return order
+
+    assert asyncio.run(main()) == ['page0', 'page1', 'page2', 'image0', 'image1', 'image2']
+
+
+def test_tag_limit():
+    '''
+    タグごとの同時実行数を超えず、実行中に上限を上げれば待っていたものを始める
+    '''
+    async def main():
+        scheduler = Scheduler()
+        scheduler.configure('image', limit=2, backlog=10)
+        running, peaks = 0, []
+        release = asyncio.Event()
+
+        async def job():
+            nonlocal running
+            running += 1
+            peaks.append(running)
+            await release.wait()
+            running -= 1
+
+        for _ in range(6):
+            await scheduler.submit('image', job())
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()['image']['running'] == 2 and scheduler.queued() == 4
+        scheduler.configure('image', limit=4)
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()['image']['running'] == 4
+        release.set()
+        await scheduler.join()
+        return peaks
+
+    assert max(asyncio.run(main())) == 4
+
+
+def test_backlog_blocks_submit():
+    '''
+    待ち + 実行中がbacklogに達したらsubmitは空くまで待つ
+    '''
+    async def main():
+        scheduler = Scheduler()
+        scheduler.configure('page', limit=1, backlog=2)
+        release = asyncio.Event()
+
+        async def job():
+            await release.wait()
+
+        await scheduler.submit('page', job())
+        await scheduler.submit('page', job())
+        third = asyncio.ensure_future(scheduler.submit('page', job()))
+        await asyncio.sleep(0.01)
+        assert not third.done()
+        assert scheduler.stats()['page']['waiting'] == 1
+        release.set()
+        await asyncio.wait_for(third, 1)
+        await scheduler.join()
+        assert scheduler.in_flight() == 0 and scheduler.queued() == 0
+    asyncio.run(main())
+
+
+def test_cancel_closes_pending():
+    '''
+    cancelは実行中のタスクを止め、まだ始めていないコルーチンも閉じる
+    '''
+    async def main():
+        scheduler = Scheduler(limit=1)
+        started = []
+
+        async def job(i):
+            started.append(i)
+            await asyncio.sleep(3600)
+
+        coros = [job(i) for i in range(3)]
+        for coro in coros:
+            await scheduler.submit('page', coro)
+        await asyncio.sleep(0.01)
+        await scheduler.cancel()
+        assert started == [0]
+        assert scheduler.in_flight() == 0 and scheduler.queued() == 0
+        assert all(coro.cr_frame is None for coro in coros)
+    asyncio.run(main())
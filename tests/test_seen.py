@@ -0,0 +1,110 @@
+import os
+from seen import SeenSet
+
+
+def test_add_reports_new_keys(tmp_path):
+    '''
+    初めてのキーだけTrueを返し、重複はSQLiteで確かめる
+    '''
+    seen = SeenSet(os.path.join(tmp_path, 'seen.sqlite3'))
+    assert seen.add('https://wear.jp/a/')
+    assert seen.add('https://wear.jp/b/')
+    assert not seen.add('https://wear.jp/a/')
+    assert 'https://wear.jp/b/' in seen and 'https://wear.jp/c/' not in seen
+    assert len(seen) == 2
+    stats = seen.stats()
+    assert stats['checks'] == 3 and stats['duplicates'] == 1
+    assert stats['filtered'] + stats['false_positives'] == 2
+    seen.close()
+
+
+def test_bloom_is_loaded_on_reopen(tmp_path):
+    '''
+    closeで保存したフィルタを次回はそのまま使う
+    '''
+    path = os.path.join(tmp_path, 'seen.sqlite3')
+    seen = SeenSet(path)
+    for i in range(100):
+        seen.add(str(i))
+    bloom = bytes(seen._bloom)
+    seen.close()
+    assert os.path.exists(path + '.bloom')
+
+    seen = SeenSet(path)
+    assert seen._load() and bytes(seen._bloom) == bloom
+    assert len(seen) == 100
+    assert not seen.add('0') and seen.add('100')
+    seen.close()
+
+
+def test_stale_bloom_is_rebuilt(tmp_path):
+    '''
+    保存したあとに増えたキーがあれば (checkpointの前に落ちたなど) フィルタをSQLiteから作り直す
+    '''
+    path = os.path.join(tmp_path, 'seen.sqlite3')
+    seen = SeenSet(path)
+    seen.add('a')
+    seen.checkpoint()
+    seen.add('b')
+    # フィルタを保存せずに止まる
+    seen._db.commit()
+    seen._db.close()
+
+    seen = SeenSet(path)
+    assert len(seen) == 2
+    assert not seen._load()
+    assert 'b' in seen
+    assert not seen.add('b')
+    seen.close()
+
+
+def test_broken_bloom_is_rebuilt(tmp_path):
+    '''
+    壊れたフィルタのファイルは使わない
+    '''
+    path = os.path.join(tmp_path, 'seen.sqlite3')
+    seen = SeenSet(path)
+    seen.add('a')
+    seen.close()
+    with open(path + '.bloom', 'r+b') as f:
+        f.truncate(10)
+
+    seen = SeenSet(path)
+    assert not seen.add('a')
+    seen.close()
+
+
+def test_grows_past_capacity(tmp_path):
+    '''
+    想定件数を超えたら大きいフィルタに作り直し、保存して読み直せる
+    '''
+    path = os.path.join(tmp_path, 'seen.sqlite3')
+    seen = SeenSet(path, capacity=10)
+    size = len(seen._bloom)
+    for i in range(25):
+        assert seen.add(str(i))
+    assert seen.capacity == 40 and len(seen._bloom) > size
+    assert all(str(i) in seen for i in range(25))
+    seen.close()
+
+    seen = SeenSet(path, capacity=10)
+    assert seen.capacity == 40
+    assert not any(seen.add(str(i)) for i in range(25))
+    seen.close()
+
+
+def test_reset(tmp_path):
+    '''
+    resetしたら空から数え直し、保存したフィルタも空になる
+    '''
+    path = os.path.join(tmp_path, 'seen.sqlite3')
+    seen = SeenSet(path)
+    seen.add('a')
+    seen.reset()
+    assert len(seen) == 0 and 'a' not in seen
+    assert seen.add('a')
+    seen.close()
+
+    seen = SeenSet(path)
+    assert len(seen) == 1 and seen._load()
+    seen.close()
@@ -0,0 +1,99 @@
+import asyncio
+import pytest
+from singleflight import SingleFlight, request_key
+
+
+def test_concurrent_calls_share_one_flight():
+    '''
+    同じkeyの同時の呼び出しは1回だけ実行して結果を分け合う
+    '''
+    calls = []
+
+    async def fetch(url):
+        calls.append(url)
+        await asyncio.sleep(0.01)
+        return f'body of {url}'
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(*[flights.do('k', fetch, 'u') for _ in range(5)])
+        assert results == ['body of u'] * 5
+        assert flights.stats() == {'calls': 1, 'coalesced': 4}
+        # 終わったら次は新しく実行する
+        assert await flights.do('k', fetch, 'u') == 'body of u'
+        assert flights.stats()['calls'] == 2
+    asyncio.run(main())
+    assert calls == ['u', 'u']
+
+
+def test_exception_is_shared():
+    '''
+    失敗したら待っていたほうにも同じ例外を返す
+    '''
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError('boom')
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(*[flights.do('k', fail) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+        assert flights.stats() == {'calls': 1, 'coalesced': 2}
+    asyncio.run(main())
+
+
+def test_cancelled_leader_hands_off_to_waiter():
+    '''
+    先に始めたほうが中断されたら、待っていたほうが自分で実行する
+    '''
+    calls = []
+
+    async def fetch(who):
+        calls.append(who)
+        await asyncio.sleep(0.05)
+        return who
+
+    async def main():
+        flights = SingleFlight()
+        leader = asyncio.ensure_future(flights.do('k', fetch, 'leader'))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(flights.do('k', fetch, 'waiter'))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        assert await waiter == 'waiter'
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert flights.stats() == {'calls': 2, 'coalesced': 0}
+    asyncio.run(main())
+    assert calls == ['leader', 'waiter']
+
+
+def test_cancelled_waiter_does_not_cancel_leader():
+    '''
+    待っているほうが中断されても、先に始めたほうは続ける
+    '''
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return 'ok'
+
+    async def main():
+        flights = SingleFlight()
+        leader = asyncio.ensure_future(flights.do('k', fetch))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(flights.do('k', fetch))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        assert await leader == 'ok'
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+    asyncio.run(main())
+
+
+def test_request_key_normalizes():
+    '''
+    スキーム、ホスト、デフォルトのポート、クエリの順番、フラグメントの違いは同じリクエストとみなす
+    '''
+    assert request_key('get', 'HTTPS://Wear.JP:443/a?b=2&a=1#top') == request_key('GET', 'https://wear.jp/a?a=1&b=2')
+    assert request_key('get', 'http://wear.jp:8080/') != request_key('get', 'http://wear.jp/')
+    assert request_key('post', 'https://db.netkeiba.com/', 'a=1') == request_key('POST', 'https://db.netkeiba.com/', {'a': '1'})
+    assert request_key('post', 'https://db.netkeiba.com/', 'a=1') != request_key('post', 'https://db.netkeiba.com/', 'a=2')
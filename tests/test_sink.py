@@ -0,0 +1,60 @@
+import json
+import os
+import pytest
+from sink import RecordSink
+
+
+def test_truncated_last_line(tmp_path):
+    '''
+    書き込み中に止まったファイルの最後の行は切り詰め、それまでのkeyは重複として扱う
+    '''
+    path = os.path.join(tmp_path, 'records-00000.ndjson')
+    with open(path, 'wt') as f:
+        f.write('{"snapid": "1"}\n{"snapid": "2", "li')
+
+    sink = RecordSink(str(tmp_path), 'records', key='snapid')
+    with open(path, 'rt') as f:
+        assert f.read() == '{"snapid": "1"}\n'
+    assert not sink.write({'snapid': '1'})
+    assert sink.write({'snapid': '2'})
+    sink.close()
+
+    records = []
+    for name in sorted(os.listdir(tmp_path)):
+        with open(os.path.join(tmp_path, name), 'rt') as f:
+            records += [json.loads(line) for line in f]
+    assert records == [{'snapid': '1'}, {'snapid': '2'}]
+
+
+def test_broken_line_in_the_middle(tmp_path):
+    '''
+    途中の行が壊れているのは書きかけではないのでエラーにする
+    '''
+    with open(os.path.join(tmp_path, 'records-00000.ndjson'), 'wt') as f:
+        f.write('{"snapid": "1"}\n{"snapid": \n{"snapid": "3"}\n')
+    with pytest.raises(ValueError):
+        RecordSink(str(tmp_path), 'records', key='snapid')
+
+
+def test_parquet_without_footer(tmp_path):
+    '''
+    書き込み中に止まったParquet (フッターがない) は別の名前にして、次の番号のファイルから書く
+    '''
+    pytest.importorskip('pyarrow')
+    sink = RecordSink(str(tmp_path), 'records', key='snapid', format='parquet')
+    sink.write({'snapid': '1'})
+    path = sink._path()
+    sink.close()
+    # closeの前に止まったようにフッターを削る
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) // 2)
+
+    sink = RecordSink(str(tmp_path), 'records', key='snapid', format='parquet')
+    assert os.path.exists(path + '.broken') and not os.path.exists(path)
+    assert sink._path() != path
+    assert sink.write({'snapid': '1'})
+    sink.close()
+
+    sink = RecordSink(str(tmp_path), 'records', key='snapid', format='parquet')
+    assert not sink.write({'snapid': '1'})
+    sink.close()
@@ -0,0 +1,28 @@
+from waiter import AdaptiveWaiter
+
+URL = 'https://wear.jp/'
+
+
+def test_adaptive_burst():
+    '''
+    429/503でburstも減らし、成功が続けば設定したburstまで戻す
+    '''
+    waiter = AdaptiveWaiter(rate=1, burst=8)
+    bucket = waiter._bucket('wear.jp')
+    waiter.feedback(URL, 503, 0.1, 0)
+    assert bucket.burst == 4
+    waiter.feedback(URL, 429, 0.1, 0)
+    waiter.feedback(URL, None, 0.1, 0)
+    waiter.feedback(URL, 503, 0.1, 0)
+    assert bucket.burst == 1
+    for _ in range(5):
+        waiter.feedback(URL, 200, 0.1, None)
+    assert 1 < bucket.burst < 8
+    for _ in range(100):
+        waiter.feedback(URL, 200, 0.1, None)
+    assert bucket.burst == 8
+    # 減らしたburstを超えてトークンをためない
+    waiter.feedback(URL, 503, 0.1, 0)
+    bucket.last -= 100
+    bucket.reserve()
+    assert bucket.tokens <= 4 - 1
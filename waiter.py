@@ -1,20 +1,32 @@
 from collections import namedtuple
+from email.utils import parsedate_to_datetime
 import random
-from typing import Dict, List
+from typing import Dict, List, Optional
 import urllib.parse
 import time
 import asyncio
 import os
 import json
+from metrics import NULL
 
+# サーバーから控えるよう求められたステータス
+BACKOFF_STATUS = (429, 503)
 
-class LockTime():
-    def __init__(self) -> None:
-        self.lock = asyncio.Lock()
-        self.time = time.time()
 
-    def update_time(self, t=None):
-        self.time = t or time.time()
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    '''
+    Retry-Afterヘッダ (秒数またはHTTP-date) を秒数にする
+    '''
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
 
 
 class Waiter():
@@ -32,6 +44,10 @@ class Waiter():
                 self._waitlist['*'] = select_waiter(default_wait)
             else:
                 self._waitlist['*'] = DefaultWaiter()
+        self.instrument(NULL)
+
+    def instrument(self, registry):
+        self._m_sleep = registry.histogram('crawler_waiter_sleep_seconds', 'time spent waiting for a send slot', ('host',))
 
     async def wait(self, url: str):
         parsed_url = urllib.parse.urlparse(url)
@@ -42,31 +58,54 @@ class Waiter():
         else:
             waiter: DefaultWaiter = self._waitlist['*']
 
+        start = time.monotonic()
         await waiter.wait(url)
+        self._m_sleep.observe(time.monotonic() - start, host)
+
+    def feedback(self, url: str, status: Optional[int], latency: float, retry_after: str = None):
+        '''
+        レスポンスの結果を伝える
+        status: 例外のときはNone
+        '''
+        host = urllib.parse.urlparse(url).hostname
+
+        if host in self._waitlist:
+            waiter: DefaultWaiter = self._waitlist[host]
+        else:
+            waiter: DefaultWaiter = self._waitlist['*']
+
+        waiter.feedback(url, status, latency, parse_retry_after(retry_after))
 
 
 class DefaultWaiter():
+    '''
+    ホストごとに次に送ってよい時刻を持ち、呼び出し側がその枠を予約してから待つ
+    予約はawaitをはさまずに行うのでロックはいらない
+    '''
+
     def __init__(self):
-        self._table: Dict[str, LockTime] = {}
+        self._next: Dict[str, float] = {}
 
     async def wait(self, url: str):
         await self._wait(url, 0)
 
-    async def _wait(self, url: str, sec: int):
-        host = urllib.parse.urlparse(url).hostname
+    def feedback(self, url: str, status: Optional[int], latency: float, retry_after: Optional[float]):
+        pass
 
-        if host in self._table:
-            await self._table[host].lock.acquire()
-            now = time.time()
-            if now > self._table[host].time + sec:
-                self._table[host].update_time(now)
-            else:
-                ws = max(sec - (now - self._table[host].time), 0)
-                await asyncio.sleep(ws)
-                self._table[host].update_time()
-            self._table[host].lock.release()
-        else:
-            self._table[host] = LockTime()
+    def reserve(self, host: str, sec: float) -> float:
+        '''
+        送信枠を予約して待つ秒数を返す
+        '''
+        now = time.monotonic()
+        slot = max(now, self._next.get(host, now))
+        self._next[host] = slot + sec
+        return slot - now
+
+    async def _wait(self, url: str, sec: float):
+        host = urllib.parse.urlparse(url).hostname
+        delay = self.reserve(host, sec)
+        if delay > 0:
+            await asyncio.sleep(delay)
 
 
 class ConstWaiter(DefaultWaiter):
@@ -85,11 +124,106 @@ class RandomWaiter(DefaultWaiter):
         self.max = max
 
     async def wait(self, url: str):
-        await self._wait(url, random.randrange(self.min, self.max))
+        await self._wait(url, random.uniform(self.min, self.max))
+
+
+class TokenBucket():
+    '''
+    呼び出し側が送信時刻を予約するトークンバケット
+    トークンが足りなければ負債として持ち越し、その分だけ待つ
+    '''
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        return delay + max(self.blocked_until - now, 0)
+
+    def block(self, sec: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + sec)
+        self.tokens = min(self.tokens, 0)
+
+
+class AdaptiveWaiter(DefaultWaiter):
+    '''
+    ホストごとのトークンバケットをAIMDで調整する
+    成功するたびにrateを加算で増やし、429/503・エラー・レイテンシの悪化で乗算で減らす
+    burstも同じように減らし、成功が続けば設定したburstまで戻す
+    Retry-Afterがあればその間は送らない
+    '''
+
+    def __init__(self, rate: float = 1, burst: float = 1, max_rate: float = 10, min_rate: float = 0.05,
+                 increase: float = 0.05, decrease: float = 0.5, latency_factor: float = 3,
+                 burst_increase: float = 0.1):
+        '''
+        burst: burstの最大値 減らしても1より小さくはしない
+        burst_increase: 成功1回でburstを増やす量
+        '''
+        super(AdaptiveWaiter, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.burst_increase = burst_increase
+        self._buckets: Dict[str, TokenBucket] = {}
+        # ホストごとのレイテンシの基準値 (ゆっくり追従する最小値)
+        self._base_latency: Dict[str, float] = {}
+
+    def _bucket(self, host: str) -> TokenBucket:
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.rate, self.burst)
+        return self._buckets[host]
+
+    async def wait(self, url: str):
+        host = urllib.parse.urlparse(url).hostname
+        delay = self._bucket(host).reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def feedback(self, url: str, status: Optional[int], latency: float, retry_after: Optional[float]):
+        host = urllib.parse.urlparse(url).hostname
+        bucket = self._bucket(host)
+
+        if status is None or status in BACKOFF_STATUS or status >= 500:
+            bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+            bucket.burst = max(1, bucket.burst * self.decrease)
+            bucket.block(retry_after if retry_after is not None else 1 / bucket.rate)
+            return
+
+        base = self._base_latency.get(host)
+        if base is None or latency < base:
+            self._base_latency[host] = latency
+        else:
+            self._base_latency[host] = base * 1.01
+        if base is not None and latency > base * self.latency_factor:
+            # サーバーが遅くなってきたら控えめに減らす
+            bucket.rate = max(self.min_rate, bucket.rate * (1 + self.decrease) / 2)
+            bucket.burst = max(1, bucket.burst * (1 + self.decrease) / 2)
+        else:
+            bucket.rate = min(self.max_rate, bucket.rate + self.increase)
+            bucket.burst = min(self.burst, bucket.burst + self.burst_increase)
+
+    def rates(self) -> Dict[str, float]:
+        return {host: bucket.rate for host, bucket in self._buckets.items()}
 
 
 def select_waiter(wargs: list = [1]):
-    if (len(wargs) == 1):
+    if len(wargs) >= 1 and wargs[0] == 'adaptive':
+        # adaptive [rate [burst [max_rate]]]
+        return AdaptiveWaiter(*map(float, wargs[1:4]))
+    elif (len(wargs) == 1):
         return ConstWaiter(float(wargs[0]))
     elif (len(wargs) == 2 and wargs[0] == 'const'):
         return ConstWaiter(float(wargs[1]))
@@ -1,15 +1,20 @@
-import json
-import os
 import argparse
+import os
 from asyncio.locks import Semaphore
 from collector import Collector
 import asyncio
 from downloader import Downloader
-from reporter import Reporter, INFO, NETWORK
-from cacher import Cacher, tmp_save
+from reporter import Reporter, INFO
+from cacher import AsyncCacher, Cacher, CachePolicy, LRUIndex, STORAGES, parse_size
 from waiter import Waiter
-import aiohttp
-import bs4
+from frontier import Frontier
+from seen import SeenSet
+from cluster import run_cluster, shard_path
+from metrics import Registry
+from session import SessionManager
+from sink import FORMATS, RecordSink
+from blobstore import BlobStore
+import htmlparse
 import urllib.parse
 
 
@@ -18,7 +23,13 @@ def parse_gallely(html, userdata):
     ギャラリーページからデータと画像URL取得
     別プロセスで処理
     '''
-    doc = bs4.BeautifulSoup(html, 'lxml')
+    if htmlparse.backend() == 'lxml':
+        return parse_gallely_lxml(html, userdata)
+    return parse_gallely_bs4(html, userdata)
+
+
+def parse_gallely_bs4(html, userdata):
+    doc = htmlparse.soup(html)
     results = []
     for e in doc.select('.like_mark'):
         link = 'https:' + e.select_one('.img img')['data-originalretina']
@@ -54,8 +65,14 @@ def parse_user(html):
     ユーザー一覧ページから各ユーザーページへのリンクとユーザーデータ取得
     別プロセスで処理
     '''
+    if htmlparse.backend() == 'lxml':
+        return parse_user_lxml(html)
+    return parse_user_bs4(html)
+
+
+def parse_user_bs4(html):
     results = []
-    doc = bs4.BeautifulSoup(html, 'lxml')
+    doc = htmlparse.soup(html)
     for e in doc.select('#list_1column li.list'):
         link = 'https://wear.jp' + e.select_one('.over')['href']
         type_e = e.select_one('h3.name span')
@@ -89,89 +106,217 @@ def parse_user(html):
     return results
 
 
+# lxml版 bs4版と同じ結果を返す
+# CSSの子孫セレクタは祖先側が要素の外にあってもマッチするのでancestor::で書く
+_X_LIKE_MARK = htmlparse.xpath(f"//*[{htmlparse.has_class('like_mark')}]")
+_X_IMG = htmlparse.xpath(f".//img[ancestor::*[{htmlparse.has_class('img')}]]")
+_X_SAVE = htmlparse.xpath(f".//span[ancestor::*[{htmlparse.has_class('btn_save')}]]")
+_X_LIKE = htmlparse.xpath(f".//span[ancestor::*[{htmlparse.has_class('btn_like')}]]")
+_X_OVER = htmlparse.xpath(f".//*[{htmlparse.has_class('over')}]")
+_X_NAMEFIRST = htmlparse.xpath(f".//*[{htmlparse.has_class('namefirst')}]")
+_X_HEIGHT = htmlparse.xpath(f".//*[{htmlparse.has_class('height')}]")
+_X_USER = htmlparse.xpath(f"//li[{htmlparse.has_class('list')}][ancestor::*[@id='list_1column']]")
+_X_NAME = htmlparse.xpath(f".//h3[{htmlparse.has_class('name')}]")
+_X_NAME_SPAN = htmlparse.xpath(f".//span[ancestor::h3[{htmlparse.has_class('name')}]]")
+_X_SHOPNAME = htmlparse.xpath(f".//*[{htmlparse.has_class('shopname')}]")
+_X_INFO = htmlparse.xpath(f".//li[ancestor::ul[{htmlparse.has_class('info')}]]")
+_X_META = htmlparse.xpath(f".//li[ancestor::ul[{htmlparse.has_class('meta')}]]")
+_X_BRANDS = htmlparse.xpath(f".//li[ancestor::ul[ancestor::*[{htmlparse.has_class('fav_brand')}]]]")
+
+
+def parse_gallely_lxml(html, userdata):
+    doc = htmlparse.parse(html)
+    results = []
+    for e in _X_LIKE_MARK(doc):
+        link = 'https:' + _X_IMG(e)[0].attrib['data-originalretina']
+        data = {
+            'snapid': e.attrib['data-snapid'],
+            'saves': int(htmlparse.text(_X_SAVE(e)[0])),
+            'likes': int(htmlparse.text(_X_LIKE(e)[0])),
+            'link': _X_OVER(e)[0].attrib['href']
+        }
+
+        if userdata:
+            data['user'] = userdata
+
+        elem_first_name = htmlparse.first(_X_NAMEFIRST, e)
+        if elem_first_name is not None:
+            data['first_name'] = htmlparse.text(elem_first_name)
+
+        elem_height = htmlparse.first(_X_HEIGHT, e)
+        if elem_height is not None:
+            data['height'] = htmlparse.text(elem_height)
+        data['url'] = link
+
+        results.append((link, data))
+
+    return results
+
+
+def parse_user_lxml(html):
+    results = []
+    doc = htmlparse.parse(html)
+    for e in _X_USER(doc):
+        href = _X_OVER(e)[0].attrib['href']
+        link = 'https://wear.jp' + href
+        type_e = htmlparse.first(_X_NAME_SPAN, e)
+        if type_e is None:
+            user_type = 'normal'
+        elif 'wearista' in type_e.attrib['class'].split():
+            user_type = 'wearista'
+        elif 'shopstaff' in type_e.attrib['class'].split():
+            user_type = 'shopstaff'
+        else:
+            user_type = ''
+
+        shopname_e = htmlparse.first(_X_SHOPNAME, e)
+        if shopname_e is None:
+            shopname = ''
+        else:
+            shopname = htmlparse.text(shopname_e)
+
+        data = {
+            'userid': href.replace('/', ''),
+            'name': htmlparse.text(_X_NAME(e)[0]),
+            'info': [htmlparse.text(li) for li in _X_INFO(e)],
+            'meta': [htmlparse.text(li) for li in _X_META(e)],
+            'brands': [htmlparse.text(li) for li in _X_BRANDS(e)],
+            'user_type': user_type,
+            'shopname': shopname,
+        }
+
+        results.append((link, data))
+
+    return results
+
+
 class WearCollector(Collector):
     def __init__(self,
                  reporter: Reporter,
                  waiter: Waiter,
                  outdir: str,
-                 useragent: str = ''):
-        super(WearCollector, self).__init__()
+                 useragent: str = '',
+                 session: SessionManager = None,
+                 cache_backend: str = None,
+                 compression: str = None,
+                 lru: LRUIndex = None,
+                 shared_cache: bool = False,
+                 cache_policy: CachePolicy = None,
+                 frontier: Frontier = None,
+                 seen: SeenSet = None,
+                 paging_mode: str = 'window',
+                 records: str = 'ndjson',
+                 records_dir: str = None,
+                 sidecar: bool = False):
+        super(WearCollector, self).__init__(session)
         self.reporter: Reporter = reporter
         self.waiter = waiter
         self.outdir = outdir
         self.useragent = useragent
-        self.cacher = Cacher(self.outdir)
+        # shared_cache: 複数プロセスで同じキャッシュに書き込む
+        self.cacher = AsyncCacher(Cacher(self.outdir, cache_backend, compression, lru), shared=shared_cache)
+        self.cache_policy = cache_policy or CachePolicy()
+        self.frontier = frontier
+        self.seen = seen
+        # window: 数ページずつ順に取得 probe: 最後のページを探してから並列に取得
+        self.paging_mode = paging_mode
+        # ユーザーとスナップのデータはoutdir/records/にまとめて書く
+        records_dir = records_dir or os.path.join(outdir, 'records')
+        self.user_sink = RecordSink(records_dir, 'users', key='userid', format=records)
+        self.gallery_sink = RecordSink(records_dir, 'gallery', key='snapid', format=records)
+        self.sinks += [self.user_sink, self.gallery_sink]
+        # 従来どおり画像ごとの情報にも保存する
+        self.sidecar = sidecar
         # 非同期処理の同時接続数制御
         self.semaphore = Semaphore(2)
+        # ページの取得を画像のダウンロードより優先する
+        self.scheduler.configure('gallery', priority=1)
+        self.scheduler.configure('image', priority=0)
         # ファイルダウンローダ
-        self.downloader = Downloader(self.waiter, self.semaphore, self.reporter)
+        # 同じ画像は別のURLでも1つだけ保存する
+        self.blobs = BlobStore(os.path.join(outdir, 'blobs'))
+        self.downloader = Downloader(self.waiter, self.semaphore, self.reporter, self.session, self.cacher,
+                                     blobs=self.blobs, flights=self.flights)
 
-    async def download_user_page(self, url: str, page_num):
+    def shard_key(self, method: str, args):
+        # ギャラリーはユーザーごとに振り分け、画像は見つけたワーカーで落とす
+        if method == 'download_image':
+            return None
+        return super().shard_key(method, args)
+
+    @staticmethod
+    def page_filename(url: str, page_num: int = None) -> str:
+        if page_num is not None:
+            url = url + f'?pageno={page_num}'
+        return urllib.parse.quote(url, safe='') + '.html'
+
+    async def fetch_page(self, url: str, page_num: int):
+        '''
+        return: (html, ページがあるか)
+        最後のページより先は?pagenoのないURLにリダイレクトされる
+        '''
         url = url + f'?pageno={page_num}'
 
         # キャッシュがあれば使う
-        filename = urllib.parse.quote(url, safe='') + '.html'
-        content, info = self.cacher.get(filename)
-        if content and info:
-            html = content
-            realurl = info.get('realurl')
-            self.reporter.report(INFO, f'use cache {url}')
+        html, info = await self.fetch(url, self.page_filename(url))
+        realurl = (info or {}).get('realurl', url)
+
+        return html, page_num < 2 or realurl.count('?pageno') > 0
+
+    async def page_exists(self, url: str, page_num: int):
+        _, exists = await self.fetch_page(url, page_num)
+        return exists
+
+    async def paging(self, url: str, pagestart: int, pageend: int, mkcorofn):
+        if self.paging_mode == 'probe':
+            await self.probed_paging(
+                pagestart, pageend, mkcorofn,
+                lambda page: self.page_exists(url, page))
         else:
-            await self.waiter.wait(url)
-            async with self.semaphore:
-                self.reporter.report(INFO, f'fetching {url}', type=NETWORK)
-                async with aiohttp.request('get', url, headers={'user-agent': self.useragent}) as res:
-                    html = await res.text()
-                    realurl = str(res.url)
-                    self.cacher.set(filename, html, {'status': res.status, 'realurl': realurl})
+            await self.queued_paging(pagestart, pageend, mkcorofn)
+
+    async def download_user_page(self, url: str, page_num):
+        html, exists = await self.fetch_page(url, page_num)
 
         # 終了条件
-        if page_num >= 2 and realurl.count('?pageno') == 0:
+        if not exists:
             return False
         else:
-            for url, data in await self.run_in_executor(parse_user, html):
-                await self.add_future('gallery', self.gallery_collector(url, 1, 501, userdata=data))
+            for url, data in await self.parse(parse_user, html, filename=self.page_filename(url, page_num)):
+                self.user_sink.write(dict(data, url=url))
+                await self.add_job('gallery', 'gallery_collector', url, 1, 501, data)
             return True
 
     async def user_collector(self, url: str, pagestart: int, pageend: int):
-        await self.queued_paging(
-            pagestart, pageend,
-            lambda page: self.download_user_page(url, page))
+        await self.paging(
+            url, pagestart, pageend,
+            lambda page: self.checkpointed('download_user_page', url, page))
 
     async def download_gallery_page(self, url: str, page_num: int, userdata=None):
-        url = url + f'?pageno={page_num}'
-        filename = urllib.parse.quote(url, safe='') + '.html'
-        content, info = self.cacher.get(filename)
-        if content and info:
-            html = content
-            realurl = info.get('realurl')
-            self.reporter.report(INFO, f'use cache {url}')
-        else:
-            await self.waiter.wait(url)
-            async with self.semaphore:
-                self.reporter.report(INFO, f'fetching {url}', type=NETWORK)
-                async with aiohttp.request('get', url, headers={'user-agent': self.useragent}) as res:
-                    html = await res.text()
-                    realurl = str(res.url)
-                    self.cacher.set(filename, html, {'status': res.status, 'realurl': realurl})
+        html, exists = await self.fetch_page(url, page_num)
 
         # 終了条件
-        if page_num >= 2 and realurl.count('?pageno') == 0:
+        if not exists:
             return False
         else:
-            for url, data in await self.run_in_executor(parse_gallely, html, userdata):
+            for url, data in await self.parse(parse_gallely, html, userdata, filename=self.page_filename(url, page_num)):
                 imagefile = urllib.parse.quote(url, safe='')
-                tmp_save(os.path.join(self.outdir, imagefile+'.json'), json.dumps(data))
-                imagepath = os.path.join(self.outdir, imagefile)
-                if not os.path.exists(imagepath):
-                    await self.add_future('image', self.downloader.download_file(
-                        url, imagepath, headers={'user-agent': self.useragent}))
+                self.gallery_sink.write(data)
+                if self.sidecar:
+                    await self.cacher.aset_info(imagefile, data)
+                await self.add_job('image', 'download_image', url, imagefile)
             return True
 
+    async def download_image(self, url: str, imagefile: str):
+        # 前回までに保存したもの
+        if await self.cacher.aexists(imagefile):
+            return
+        await self.downloader.download_file(url, imagefile, headers={'user-agent': self.useragent})
+
     async def gallery_collector(self, url: str, pagestart: int, pageend: int, userdata=None):
-        await self.queued_paging(
-            pagestart, pageend,
-            lambda page: self.download_gallery_page(url, page, userdata=userdata))
+        await self.paging(
+            url, pagestart, pageend,
+            lambda page: self.checkpointed('download_gallery_page', url, page, userdata))
 
 
 if __name__ == "__main__":
@@ -183,16 +328,73 @@ if __name__ == "__main__":
     parser.add_argument('--useragent', '-ua', type=str, default='')
     parser.add_argument('--waitlist', '-wl', type=str, default='wait.json')
     parser.add_argument('--outdir', '-o', type=str, required=True)
+    parser.add_argument('--cache_backend', choices=list(STORAGES.keys()), default=None, help='cache storage. default is auto detect')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=None, help='compress cached html')
+    parser.add_argument('--lru', type=str, default=None, help='in-memory index size of cached entries. `100000` entries or `512M` bytes')
+    parser.add_argument('--max_age', type=float, default=None, help='seconds until cached pages expire. default is never')
+    parser.add_argument('--revalidate', action='store_true', help='revalidate expired pages with ETag/Last-Modified')
+    parser.add_argument('--concurrency', type=int, default=None, help='max number of running tasks. default is unlimited')
+    parser.add_argument('--cache_policy', type=str, default='cache_policy.json', help='json file of max age per host')
+    parser.add_argument('--paging', choices=['window', 'probe'], default='window', help='probe: find the last page first, then fetch pages in parallel')
+    parser.add_argument('--metrics_port', type=int, default=None, help='serve metrics in prometheus text format on this port')
+    parser.add_argument('--progress', type=float, default=None, help='print a progress line every N seconds')
+    parser.add_argument('--resume', action='store_true', help='resume the previous run')
+    parser.add_argument('--seen_capacity', type=int, default=1000000, help='expected number of jobs. sizes the in-memory filter of added jobs')
+    parser.add_argument('--records', choices=FORMATS, default='ndjson', help='format of user and snap records in OUTDIR/records')
+    parser.add_argument('--sidecar', action='store_true', help='also save snap data as info of each image (legacy)')
+    parser.add_argument('--workers', type=int, default=None, help='run N worker processes sharded by user. waits per host are kept across them')
+    parser.add_argument('--parse_batch', type=int, default=1, help='number of pages sent to a parser process at once')
+    parser.add_argument('--parse_processes', type=int, default=None, help='size of the parser process pool. default is cpu count')
+    parser.add_argument('--parse_threads', type=int, default=None, help='size of the parser thread pool (lxml only)')
+    parser.add_argument('--parser', choices=htmlparse.BACKENDS, default=htmlparse.backend(), help='html parser for extractors. lxml is faster')
     parser.add_argument('--loglevel', '-ll', default=2, type=int, help='log level')
-    parser.add_argument('--wait', '-w', default='5', nargs='+', type=str, help='interval for http requests. default is none. `-w 0.5` `-w random 1 2.5`')
+    parser.add_argument('--wait', '-w', default='5', nargs='+', type=str, help='interval for http requests. default is none. `-w 0.5` `-w random 1 2.5` `-w adaptive 1 2 5` (rate burst max_rate)')
     args = parser.parse_args()
+    htmlparse.set_backend(args.parser)
+
+    def make(index: int = None, waiter=None) -> WearCollector:
+        # 複数プロセスのときはワーカーごとにfrontier・seen・recordsを分ける キャッシュは共有する
+        c = WearCollector(
+            reporter=Reporter(args.loglevel),
+            waiter=waiter or Waiter(args.wait, args.waitlist),
+            outdir=args.outdir,
+            useragent=args.useragent,
+            cache_backend=args.cache_backend,
+            compression=args.compression,
+            lru=LRUIndex(*parse_size(args.lru), shared=index is not None) if args.lru else None,
+            shared_cache=index is not None,
+            cache_policy=CachePolicy(args.max_age, args.revalidate, args.cache_policy),
+            frontier=Frontier(shard_path(os.path.join(args.outdir, 'frontier.sqlite3'), index)),
+            seen=SeenSet(shard_path(os.path.join(args.outdir, 'seen.sqlite3'), index), capacity=args.seen_capacity),
+            paging_mode=args.paging,
+            records=args.records,
+            records_dir=None if index is None else os.path.join(args.outdir, 'records', f'w{index}'),
+            sidecar=args.sidecar,
+        )
+        c.scheduler.set_limit(args.concurrency)
+        if args.metrics_port is not None or args.progress:
+            c.instrument(Registry())
+        c.parser.processes = args.parse_processes or (c.parser.processes if index is None else max(1, c.parser.processes // args.workers))
+        c.parser.threads = args.parse_threads or c.parser.threads
+        c.parser.pages.batch_size = args.parse_batch
+        return c
+
+    def report(c: WearCollector):
+        c.reporter.report(INFO, f'connections: {c.session.stats()}')
+        c.reporter.report(INFO, f'cache: {c.cacher.stats()}')
+        c.reporter.report(INFO, f'requests: {c.flights.stats()} seen: {c.seen.stats()}')
+        c.reporter.report(INFO, f'parser: {c.parser.stats()}')
+        c.reporter.report(INFO, f'downloads: {c.downloader.stats()} blobs: {c.blobs.stats()}')
+        c.reporter.report(INFO, f'records: users {c.user_sink.stats()} gallery {c.gallery_sink.stats()}')
 
-    c = WearCollector(
-        reporter=Reporter(args.loglevel),
-        waiter=Waiter(args.wait, args.waitlist),
-        outdir=args.outdir,
-        useragent=args.useragent
-    )
-    asyncio.run(
-        c.run(c.user_collector(args.url, args.pagestart, args.pageend))
-    )
+    if args.workers:
+        run_cluster(make, lambda c: c.user_collector(args.url, args.pagestart, args.pageend), args.workers,
+                    Waiter(args.wait, args.waitlist), os.path.join(args.outdir, 'cluster.sock'), report,
+                    resume=args.resume, metrics_port=args.metrics_port, progress=args.progress)
+    else:
+        c = make()
+        asyncio.run(
+            c.run(c.user_collector(args.url, args.pagestart, args.pageend), resume=args.resume,
+                  metrics_port=args.metrics_port, progress=args.progress)
+        )
+        report(c)